@@ -27,7 +27,7 @@ export const Editor = () => {
       maxTokens: 256,
       stoppingSequence: '### Human:',
     });
-  const { html, onChange, onSubmit, onCancel } =
+  const { html, error, onChange, onSubmit, onCancel } =
     useModelPlayground(generationParams);
 
   React.useEffect(() => {
@@ -58,6 +58,12 @@ export const Editor = () => {
           response, meaning the next request will be delayed regardless.
         </AlertDescription>
       </Alert>
+      {error && (
+        <Alert variant="destructive" className="my-5">
+          <AlertTitle>Generation failed</AlertTitle>
+          <AlertDescription>{error}</AlertDescription>
+        </Alert>
+      )}
       <div className="grid gap-12 grid-cols-[1fr_300px]">
         <ContentEditableDiv
           value={html}
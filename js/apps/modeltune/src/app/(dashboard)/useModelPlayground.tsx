@@ -56,11 +56,13 @@ export const useModelPlayground = ({
   stoppingSequence,
 }: GenerationParams): {
   html: string;
+  error?: string;
   onChange: (html: string) => void;
   onSubmit: () => void;
   onCancel: () => void;
 } => {
   const [html, setHtml] = React.useState(TEMPLATE_TEXT);
+  const [error, setError] = React.useState<string>();
 
   // const [fnId, setFnId] = React.useState();
   const url = 'https://nealcorp--gpt-service-web.modal.run/generate';
@@ -69,6 +71,7 @@ export const useModelPlayground = ({
   const submit = async (options: RequestInit, initial?: string) => {
     const controller = new AbortController();
     setController(controller);
+    setError(undefined);
     // setFnId(undefined);
 
     try {
@@ -77,11 +80,13 @@ export const useModelPlayground = ({
         signal: controller.signal,
       });
       if (!resp.ok || !resp.body) {
-        throw resp.statusText;
+        throw new Error(resp.statusText || `Request failed (${resp.status})`);
       }
 
       const reader = resp.body.getReader();
       const decoder = new TextDecoder();
+      let buffer = '';
+      let completion = '';
 
       while (true) {
         const { value, done } = await reader.read();
@@ -92,17 +97,33 @@ export const useModelPlayground = ({
         // const fnId = resp.headers.get('Modal-Call-Id');
         // setFnId(fnId);
 
-        const prediction = decoder.decode(value);
+        // server-sent events, separated by a blank line
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop() ?? '';
+
+        for (const event of events) {
+          const lines = event.split('\n');
+          const data = lines.find((line) => line.startsWith('data: '));
+          if (!data) {
+            continue;
+          }
+          if (lines.includes('event: delta')) {
+            completion += JSON.parse(data.slice('data: '.length)).text;
+          } else if (lines.includes('event: error')) {
+            setError(JSON.parse(data.slice('data: '.length)).error);
+          }
+        }
+
         if (initial) {
-          const [_, newTokens] = prediction.split(initial);
-          setHtml(`${initial}<mark>${newTokens}</mark>`);
+          setHtml(`${initial}<mark>${completion}</mark>`);
         } else {
-          setHtml(`<mark>${prediction}</mark>`);
+          setHtml(`<mark>${completion}</mark>`);
         }
       }
     } catch (err: any) {
       if (err.name !== 'AbortError') {
-        // setState(prevState => ({ ...prevState, ...{ error: err } }));
+        setError(err.message ?? String(err));
       }
     }
   };
@@ -153,6 +174,7 @@ export const useModelPlayground = ({
 
   return {
     html,
+    error,
     onChange,
     onSubmit,
     onCancel,
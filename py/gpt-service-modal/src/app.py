@@ -4,7 +4,6 @@ API routes for transcription, language model generation and text-to-speech.
 """
 
 import json
-import os
 from pathlib import Path
 from typing import List, Literal, Optional, TypedDict
 
@@ -12,7 +11,8 @@ import modal
 
 from .common import finetunes_volume, stub
 from .download import download_model
-from .inference import Inference
+from .inference import Inference, Trainer
+from .streaming import GenerationStore
 
 
 class Message(TypedDict):
@@ -27,7 +27,7 @@ def train_finetune(
     model_name: str,
     job_data: dict,
 ):
-    remote = Inference.remote(base_model_repo_id)
+    remote = Trainer.remote(base_model_repo_id)
     remote.train.call(
         dataset_repo_id,
         prompt_template,
@@ -44,16 +44,22 @@ def train_finetune(
     shared_volumes={
         "/finetunes": finetunes_volume,
     },
+    # generation buffers and metrics live in this container's memory, so a
+    # single container serves every request and resuming can find the buffer
+    concurrency_limit=1,
+    allow_concurrent_inputs=100,
 )
 @modal.asgi_app()
 def web():
     import asyncio
     import time
 
-    from fastapi import BackgroundTasks, Depends, FastAPI, Query, Request
+    from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query, Request
     from fastapi.middleware.cors import CORSMiddleware
     from fastapi.responses import Response, StreamingResponse
     from fastapi.staticfiles import StaticFiles
+    from gpt.metrics import MetricsRegistry
+    from gpt.registry import FinetuneRegistry
     from pydantic import BaseModel
 
     web_app = FastAPI()
@@ -62,8 +68,36 @@ def web():
         allow_origins=["*"],
         allow_methods=["POST", "GET", "DELETE"],
         allow_headers=["*"],
+        expose_headers=["X-Generation-Id"],
     )
 
+    generations = GenerationStore()
+    finetunes = FinetuneRegistry("/finetunes")
+    metrics = MetricsRegistry()
+
+    def metric_labels(repo_id: str, lora: Optional[str]) -> dict:
+        # adapter names come from clients, only registered ones get a series of
+        # their own so the label can't grow without bound
+        adapter = ""
+        if lora:
+            name = f"{repo_id.replace('/', '--')}/{lora.replace('/', '--')}"
+            adapter = lora if name in finetunes else "other"
+        return {"repo_id": repo_id, "adapter": adapter}
+
+    def record_metrics(items, repo_id: str, lora: Optional[str]):
+        # usage arrives as the last item, after the text
+        labels = metric_labels(repo_id, lora)
+        try:
+            for item in items:
+                if isinstance(item, dict):
+                    metrics.record_generation(item, **labels)
+                    # the caches belong to the model, not the adapter
+                    metrics.record_caches(item.get("caches", {}), repo_id=repo_id)
+                yield item
+        except Exception:
+            metrics.inc("gpt_request_errors_total", **labels)
+            raise
+
     class StatsRequest(BaseModel):
         repo_id: str = Query("")
         model_path: str = Query("")
@@ -74,6 +108,15 @@ def web():
         content: str
 
         generation_args: dict
+        # stream the full text so far on every token instead of SSE deltas
+        cumulative: bool = False
+
+    class BatchGenerationRequest(BaseModel):
+        repo_id: str
+        lora: Optional[str]
+        prompts: List[str]
+
+        generation_args: dict = {}
 
     class TrainRequest(BaseModel):
         base_model_repo_id: str
@@ -90,26 +133,122 @@ def web():
 
         remote = Inference.remote(body.repo_id)
 
-        def generate_cummulative():
-            full = ""
-            for text in remote.predict.call(
-                content,
-                generation_args=body.generation_args,
-                lora=body.lora,
-            ):
-                full += text
-                print(text, end="", flush=True)
-                yield full
+        if body.cumulative:
+
+            def generate_cummulative():
+                full = ""
+                for text in record_metrics(
+                    remote.predict.call(
+                        content,
+                        generation_args=body.generation_args,
+                        lora=body.lora,
+                        stream_usage=True,
+                    ),
+                    body.repo_id,
+                    body.lora,
+                ):
+                    if isinstance(text, dict):
+                        continue
+                    full += text
+                    print(text, end="", flush=True)
+                    yield full
+
+            return StreamingResponse(
+                generate_cummulative(),
+                media_type="text/event-stream",
+            )
+
+        generation = generations.start(
+            lambda: record_metrics(
+                remote.predict.call(
+                    content,
+                    generation_args=body.generation_args,
+                    lora=body.lora,
+                    echo_prompt=False,
+                    stream_usage=True,
+                ),
+                body.repo_id,
+                body.lora,
+            )
+        )
+
+        return StreamingResponse(
+            generation.events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Generation-Id": generation.id},
+        )
+
+    @web_app.post("/generate/batch")
+    def generate_batch(body: BatchGenerationRequest):
+        # waits for every completion, so this runs in the threadpool rather than
+        # on the event loop
+        labels = metric_labels(body.repo_id, body.lora)
+        try:
+            result = Inference.remote(body.repo_id).generate_batch.call(
+                body.prompts, generation_args=body.generation_args, lora=body.lora
+            )
+        except Exception:
+            metrics.inc("gpt_request_errors_total", len(body.prompts), **labels)
+            raise
+
+        for usage in result["usage"]:
+            metrics.record_generation(usage, **labels)
+        return result
+
+    @web_app.get("/generate/{generation_id}")
+    async def resume_generation(
+        generation_id: str, request: Request, offset: Optional[int] = None
+    ):
+        generation = generations.get(generation_id)
+        if generation is None:
+            raise HTTPException(status_code=404, detail="Unknown generation")
+
+        last_event_id = request.headers.get("last-event-id")
+        from_seq = int(last_event_id) + 1 if last_event_id else 0
 
         return StreamingResponse(
-            generate_cummulative(),
+            generation.events(from_seq, offset),
             media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Generation-Id": generation.id},
+        )
+
+    @web_app.get("/metrics")
+    async def get_metrics():
+        return Response(
+            metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
         )
 
+    @web_app.get("/startup")
+    def startup_report(repo_id: str):
+        # boots a container for the model if none is running, which takes a while,
+        # so this runs in the threadpool rather than on the event loop
+        return Inference.remote(repo_id).startup_report.call()
+
     @web_app.get("/finetunes")
-    async def list_finetunes(base_model_repo_id: str):
-        finetunes_path = f"/finetunes/{base_model_repo_id.replace('/', '--')}"
-        return os.listdir(finetunes_path) if os.path.exists(finetunes_path) else []
+    async def list_finetunes(
+        base_model_repo_id: str,
+        dataset_repo_id: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = Query(None, ge=1),
+        details: bool = False,
+    ):
+        # names only by default, which is what the playground picks from
+        page = finetunes.list(
+            base_model=base_model_repo_id,
+            dataset=dataset_repo_id,
+            offset=offset,
+            limit=limit,
+        )
+        if details:
+            return page
+        return [entry["name"].split("/", 1)[1] for entry in page["finetunes"]]
+
+    @web_app.get("/finetunes/{name:path}")
+    async def get_finetune(name: str):
+        finetune = finetunes.get(name)
+        if finetune is None:
+            raise HTTPException(status_code=404, detail="Unknown finetune")
+        return finetune
 
     @web_app.post("/train")
     async def train(body: TrainRequest, background_tasks: BackgroundTasks):
@@ -19,4 +19,9 @@ stub.inference_image = (
     .run_commands("pip install ../gpt")
 )
 
-stub.download_image = modal.Image.debian_slim().pip_install("huggingface_hub")
+stub.download_image = (
+    modal.Image.debian_slim()
+    .pip_install("huggingface_hub", "requests")
+    .copy_local_dir("../../py/gpt", "/gpt")
+    .run_commands("pip install ../gpt")
+)
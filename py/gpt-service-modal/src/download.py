@@ -5,7 +5,7 @@ import modal
 from .common import models_volume, stub
 
 if stub.is_inside():
-    from huggingface_hub import login, snapshot_download
+    from gpt.downloader import download_snapshot
 
 
 @stub.function(
@@ -16,5 +16,6 @@ if stub.is_inside():
         "/models": models_volume,
     },
 )
-def download_model(*args, **kwargs):
-    snapshot_download(*args, **kwargs)
+def download_model(repo_id: str, local_dir: str, **kwargs):
+    # the directory only appears once every file is downloaded and verified
+    return download_snapshot(repo_id, local_dir, **kwargs)
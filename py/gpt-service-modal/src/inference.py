@@ -9,8 +9,7 @@ from .common import finetunes_volume, models_volume, stub
 from .download import download_model
 from .inngest import Inngest
 
-
-@stub.cls(
+CONTAINER_ARGS = dict(
     cloud="gcp",
     gpu="A100",
     image=stub.inference_image,
@@ -22,9 +21,47 @@ from .inngest import Inngest
         "/models": models_volume,
         "/finetunes": finetunes_volume,
     },
+)
+
+# the store key of the preprocessing cache, /models/datasets/.tokenized
+TOKENIZED_DATASETS = ".tokenized"
+
+
+def load_llm(repo_id: str, profiler):
+    """
+    Loads the model of `repo_id` from the models volume, downloading it first if
+    needed. Returns the store holding its lease and the `LLM`.
+    """
+    from gpt.model_store import ModelStore
+
+    with profiler.phase("import"):
+        from gpt.llm import LLM
+
+    # the model is leased, so other containers never evict it while loaded
+    store = ModelStore()
+    with profiler.phase("download") as info:
+        info["cached"] = True
+
+        def download(path):
+            info["cached"] = False
+            download_model(repo_id, local_dir=path)
+
+        model_path = store.ensure(repo_id, download)
+
+    llm = LLM()
+    llm.load_model(model_path, profiler=profiler)
+    # count the snapshot written on the first load
+    store.add(repo_id)
+    return store, llm
+
+
+@stub.cls(
+    **CONTAINER_ARGS,
     concurrency_limit=1,
+    # concurrent predict calls are batched together by the generation scheduler
+    allow_concurrent_inputs=8,
     container_idle_timeout=180,
-    timeout=60 * 60 * 24,  # training takes a long time
+    timeout=60 * 60 * 24,  # offline batches can take a long time
 )
 class Inference(ClsMixin):
     def __init__(
@@ -35,19 +72,86 @@ class Inference(ClsMixin):
         self.repo_id = repo_id
 
     def __enter__(self):
-        from gpt.llm import LLM
+        from gpt.profiling import StartupProfiler
 
-        # download model
-        model_path = f"/models/{self.repo_id.replace('/', '--')}"
-        if not os.path.exists(model_path):
-            download_model(
-                self.repo_id, local_dir=model_path, local_dir_use_symlinks=False
-            )
+        self.profiler = StartupProfiler()
+        self.store, self.llm = load_llm(self.repo_id, self.profiler)
+
+        with self.profiler.phase("warmup"):
+            self.llm.warmup()
+
+        self.profiler.print_report()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.store.close()
+
+    @modal.method()
+    def startup_report(self):
+        return self.profiler.report()
+
+    @modal.method(is_generator=True)
+    def predict(
+        self,
+        prompt,
+        generation_args={},
+        lora=None,
+        echo_prompt=True,
+        stream_usage=False,
+    ):
+        from gpt.llm import GenerationArgs
+
+        # adapters are routed per request, so finetunes share the same batch
+        usage = {}
+        yield from self.llm.generate_streaming(
+            generation_args,
+            prompt,
+            self._lora_path(lora),
+            echo_prompt=echo_prompt,
+            usage=usage,
+        )
+
+        if stream_usage:
+            yield usage
+
+    @modal.method()
+    def generate_batch(self, prompts, generation_args={}, lora=None):
+        """
+        Completes every prompt through the generation scheduler, for offline
+        work like evaluations where nothing needs to stream.
+        """
+        usage = []
+        completions = self.llm.generate_batch(
+            prompts, generation_args, self._lora_path(lora), usage=usage
+        )
+        return {"completions": completions, "usage": usage}
+
+    def _lora_path(self, lora):
+        if lora is None:
+            return None
+        return f"/finetunes/{self.repo_id.replace('/', '--')}/{lora.replace('/', '--')}"
+
+
+@stub.cls(
+    **CONTAINER_ARGS,
+    # training puts the model in train mode and turns off its KV cache, so it
+    # never shares a container with generation
+    allow_concurrent_inputs=1,
+    container_idle_timeout=60,
+    timeout=60 * 60 * 24,  # training takes a long time
+)
+class Trainer(ClsMixin):
+    def __init__(self, repo_id: str):
+        self.repo_id = repo_id
+
+    def __enter__(self):
+        from gpt.profiling import StartupProfiler
+
+        self.store, self.llm = load_llm(self.repo_id, StartupProfiler())
 
-        self.llm = LLM()
-        self.llm.load_model(model_path)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.store.close()
 
-    @modal.method()  # training jobs can take a long time
+    @modal.method()
     def train(
         self,
         dataset_repo_id: str,
@@ -56,42 +160,54 @@ class Inference(ClsMixin):
         job_data,
     ):
         import wandb
+        from gpt.registry import FinetuneRegistry
 
         wandb_key = job_data.get("wandb_key", None)
 
-        dataset_path = f"/models/datasets/{dataset_repo_id.replace('/', '--')}"
-        if not os.path.exists(dataset_path):
-            download_model(
-                dataset_repo_id,
-                repo_type="dataset",
-                local_dir=dataset_path,
-                local_dir_use_symlinks=False,
-            )
+        dataset_path = self.store.ensure(
+            dataset_repo_id,
+            lambda path: download_model(
+                dataset_repo_id, repo_type="dataset", local_dir=path
+            ),
+            repo_type="dataset",
+        )
+        # tokenized datasets are a store entry of their own, so they count
+        # towards the budget and are evicted with everything else
+        tokenized_path = self.store.ensure(
+            TOKENIZED_DATASETS, os.makedirs, repo_type="dataset"
+        )
 
         if wandb_key:
             wandb.login(key=wandb_key)
 
         inngest = Inngest(job_data["job_id"], job_data["env"])
 
-        self.llm.train(
-            dataset_path,
-            prompt_template,
-            f"/finetunes/{output_name}",
-            on_log=lambda l: inngest.post_log(l),
-            on_step=lambda s, d=None: inngest.post_step(s, d),
-            train_args={"report_to_wandb": wandb_key is not None},
-        )
-
-    @modal.method(is_generator=True)
-    def predict(self, prompt, generation_args={}, lora=None):
-        from gpt.llm import GenerationArgs
-        from peft import PeftModel
-
-        if isinstance(self.llm.model, PeftModel):
-            self.llm.remove_lora()
-
-        if lora is not None:
-            lora_path = f"/finetunes/{self.repo_id.replace('/', '--')}/{lora.replace('/', '--')}"
-            self.llm.apply_lora(lora_path)
-
-        return self.llm.generate_streaming(generation_args, prompt)
+        try:
+            self.llm.train(
+                dataset_path,
+                prompt_template,
+                f"/finetunes/{output_name}",
+                on_log=lambda l: inngest.post_log(l),
+                on_step=lambda s, d=None: inngest.post_step(s, d),
+                on_metrics=lambda m: inngest.post_metrics(m),
+                train_args={
+                    "report_to_wandb": wandb_key is not None,
+                    "preprocessing_cache_dir": tokenized_path,
+                    "packing": job_data.get("packing", "pack"),
+                    "streaming": job_data.get("streaming", False),
+                    "max_samples": job_data.get("max_samples"),
+                    "max_tokens": job_data.get("max_tokens"),
+                },
+                metadata={"base_model": self.repo_id, "dataset": dataset_repo_id},
+            )
+            FinetuneRegistry("/finetunes").add(output_name)
+        except Exception as e:
+            inngest.post_step("JOB_FAILED", {"error": str(e)})
+            raise
+        finally:
+            # events are sent in the background, make sure the tail gets out
+            inngest.close()
+            self.store.release(dataset_repo_id, repo_type="dataset")
+            self.store.release(TOKENIZED_DATASETS, repo_type="dataset")
+            self.store.add(TOKENIZED_DATASETS, repo_type="dataset")
+            self.store.evict()
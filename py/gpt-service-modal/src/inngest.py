@@ -1,27 +1,78 @@
+import itertools
 import os
+import threading
+import time
+from collections import deque
 
 import requests
 
+FLUSH_INTERVAL = 1.0
+MAX_QUEUE_SIZE = 10_000
+MAX_BATCH_SIZE = 100
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 10
+
 
 class Inngest:
-    def __init__(self, job_id, inngest_env=None):
-        self.endpoint = "https://inn.gs/e"
+    """
+    Posts training events to Inngest from a background thread, so callers (the
+    trainer callbacks) never wait on the network.
+
+    Logs and metrics are queued up to `max_queue_size` (dropping the oldest when
+    full) and sent in batches, one request per `flush_interval` at most, over a
+    pooled session with retries and exponential backoff. Steps are never dropped
+    and are sent right away.
+    `close` waits for the queue to drain, so the last events of a job get out.
+    """
+
+    def __init__(
+        self,
+        job_id,
+        inngest_env=None,
+        endpoint="https://inn.gs/e",
+        flush_interval=FLUSH_INTERVAL,
+        max_queue_size=MAX_QUEUE_SIZE,
+        max_retries=MAX_RETRIES,
+    ):
+        self.endpoint = endpoint
         self.event_key = os.environ.get("INNGEST_EVENT_KEY", None)
         self.env = inngest_env
         self.job_id = job_id
 
-    def post_event(self, name, data):
-        if self.event_key:
-            r = requests.post(
-                f"{self.endpoint}/{self.event_key}",
-                json={
-                    "name": name,
-                    "data": data,
-                },
-                headers={"x-inngest-env": self.env} if self.env else None,
-            )
-        else:
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.dropped = 0
+
+        self._session = requests.Session()
+        # events are numbered so the two queues can be sent in order
+        self._queue = deque(maxlen=max_queue_size)
+        self._steps = deque()
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self._urgent = False
+        self._in_flight = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def post_event(self, name, data, urgent=False):
+        """
+        Queues an event. Urgent events are sent right away and never dropped.
+        """
+        if not self.event_key:
             print(f"No event key set. Skipping {name} with data {data}")
+            return
+
+        with self._cv:
+            event = (next(self._seq), {"name": name, "data": data})
+            if urgent:
+                self._steps.append(event)
+            else:
+                if len(self._queue) == self._queue.maxlen:
+                    self.dropped += 1
+                self._queue.append(event)
+            self._urgent = self._urgent or urgent
+            self._cv.notify_all()
 
     def post_log(self, log):
         self.post_event(
@@ -32,6 +83,15 @@ class Inngest:
             },
         )
 
+    def post_metrics(self, metrics):
+        self.post_event(
+            "training/metrics.create",
+            {
+                "jobId": self.job_id,
+                "metrics": metrics,
+            },
+        )
+
     def post_step(self, step_type, data=None):
         payload = {
             "jobId": self.job_id,
@@ -43,4 +103,81 @@ class Inngest:
         self.post_event(
             "training/step.create",
             payload,
+            urgent=True,
         )
+
+    def flush(self, timeout=30.0) -> bool:
+        """
+        Waits until every queued event has been sent (or given up on).
+        """
+        with self._cv:
+            self._urgent = True
+            self._cv.notify_all()
+            return self._cv.wait_for(
+                lambda: not self._pending() and not self._in_flight, timeout=timeout
+            )
+
+    def close(self, timeout=30.0):
+        self.flush(timeout)
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+        self._thread.join(timeout)
+        self._session.close()
+
+    def _run(self):
+        while True:
+            with self._cv:
+                self._cv.wait_for(lambda: self._pending() or self._closed)
+                if self._closed and not self._pending():
+                    return
+
+                # let logs accumulate for an interval unless something is urgent
+                deadline = time.monotonic() + self.flush_interval
+                while not self._urgent and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._pending() >= MAX_BATCH_SIZE:
+                        break
+                    self._cv.wait(remaining)
+
+                batch = [
+                    self._pop() for _ in range(min(self._pending(), MAX_BATCH_SIZE))
+                ]
+                self._urgent = bool(self._pending()) and self._urgent
+                self._in_flight = len(batch)
+
+            try:
+                self._send(batch)
+            finally:
+                with self._cv:
+                    self._in_flight = 0
+                    self._cv.notify_all()
+
+    def _pending(self):
+        return len(self._queue) + len(self._steps)
+
+    def _pop(self):
+        if not self._steps or (self._queue and self._queue[0][0] < self._steps[0][0]):
+            return self._queue.popleft()[1]
+        return self._steps.popleft()[1]
+
+    def _send(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                r = self._session.post(
+                    f"{self.endpoint}/{self.event_key}",
+                    json=batch,
+                    headers={"x-inngest-env": self.env} if self.env else None,
+                    timeout=REQUEST_TIMEOUT,
+                )
+                if r.status_code < 500 and r.status_code != 429:
+                    if not r.ok:
+                        print(f"Inngest rejected {len(batch)} events: {r.text}")
+                    return
+            except requests.RequestException as e:
+                print(f"Failed to post {len(batch)} events to Inngest: {e}")
+
+            if attempt < self.max_retries:
+                time.sleep(min(0.5 * 2**attempt, 30))
+
+        print(f"Giving up on {len(batch)} events after {self.max_retries} retries")
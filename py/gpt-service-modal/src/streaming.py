@@ -0,0 +1,201 @@
+"""
+Server-sent events protocol for streaming generations.
+
+Every generation gets an id and a buffer of the text deltas produced so far, so
+a client which drops its connection can resume from the last event it saw (or
+from a character offset) instead of starting the generation over.
+"""
+
+import json
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+GENERATION_TTL = 10 * 60
+# cold starts load the model before the first token, so allow for that
+GENERATION_STALL_TIMEOUT = 5 * 60
+
+
+def sse_event(event: str, data: dict, id: Optional[int] = None) -> str:
+    lines = []
+    if id is not None:
+        lines.append(f"id: {id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+class Generation:
+    def __init__(self, generation_id: str):
+        self.id = generation_id
+        self.deltas: List[str] = []
+        self.offsets: List[int] = []
+        self.length = 0
+        self.usage: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.done = False
+
+        self.started_at = time.monotonic()
+        self.updated_at = self.started_at
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._cv = threading.Condition()
+
+    def append(self, text: str):
+        with self._cv:
+            self.updated_at = time.monotonic()
+            if self.first_token_at is None:
+                self.first_token_at = self.updated_at
+            self.offsets.append(self.length)
+            self.deltas.append(text)
+            self.length += len(text)
+            self._cv.notify_all()
+
+    def finish(self, usage: Optional[dict] = None, error: Optional[str] = None):
+        with self._cv:
+            if self.done:
+                return
+            self.usage = usage
+            self.error = error
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._cv.notify_all()
+
+    def timing(self) -> dict:
+        end = self.finished_at or time.monotonic()
+        duration = end - self.started_at
+        completion_tokens = (self.usage or {}).get("completion_tokens", 0)
+        return {
+            "time_to_first_token": (
+                self.first_token_at - self.started_at
+                if self.first_token_at is not None
+                else None
+            ),
+            "duration": duration,
+            "tokens_per_second": completion_tokens / duration if duration else 0.0,
+        }
+
+    def events(self, from_seq: int = 0, offset: Optional[int] = None) -> Iterator[str]:
+        """
+        Yields SSE events starting at delta `from_seq`, or at character `offset`
+        into the generated text, until the generation finishes.
+        """
+        yield sse_event("generation", {"generation_id": self.id})
+
+        seq = from_seq
+        if offset is not None:
+            with self._cv:
+                seq = next(
+                    (i for i, start in enumerate(self.offsets) if start >= offset),
+                    len(self.deltas),
+                )
+                # the delta straddling the offset is sent partially
+                partial = None
+                if seq and self.offsets[seq - 1] + len(self.deltas[seq - 1]) > offset:
+                    partial = self.deltas[seq - 1][offset - self.offsets[seq - 1] :]
+
+            if partial:
+                yield sse_event(
+                    "delta",
+                    {"seq": seq - 1, "offset": offset, "text": partial},
+                    id=seq - 1,
+                )
+
+        while True:
+            with self._cv:
+                self._cv.wait_for(lambda: seq < len(self.deltas) or self.done)
+                pending = list(
+                    zip(
+                        range(seq, len(self.deltas)),
+                        self.offsets[seq:],
+                        self.deltas[seq:],
+                    )
+                )
+                done = self.done
+
+            for i, start, text in pending:
+                yield sse_event(
+                    "delta", {"seq": i, "offset": start, "text": text}, id=i
+                )
+            seq += len(pending)
+
+            if done:
+                if self.error is not None:
+                    yield sse_event("error", {"error": self.error})
+                yield sse_event(
+                    "done",
+                    {
+                        "length": self.length,
+                        "usage": self.usage,
+                        "timing": self.timing(),
+                    },
+                )
+                return
+
+
+class GenerationStore:
+    """
+    In-memory buffers for recent generations, expired `GENERATION_TTL` seconds
+    after they finish. A generation which produces nothing for
+    `GENERATION_STALL_TIMEOUT` seconds is finished with an error first.
+
+    The buffers only exist in the container which started the generation, so
+    resuming relies on the web app running in a single container.
+    """
+
+    def __init__(
+        self,
+        ttl: float = GENERATION_TTL,
+        stall_timeout: float = GENERATION_STALL_TIMEOUT,
+    ):
+        self.ttl = ttl
+        self.stall_timeout = stall_timeout
+        self._generations: Dict[str, Generation] = {}
+        self._lock = threading.Lock()
+
+    def start(self, produce: Callable[[], Iterable[Union[str, dict]]]) -> Generation:
+        """
+        Runs `produce` in a background thread, buffering the text it yields. A
+        dict yielded by `produce` is taken as the usage of the generation.
+        """
+        self._expire()
+        generation = Generation(uuid.uuid4().hex)
+        with self._lock:
+            self._generations[generation.id] = generation
+
+        def run():
+            usage = None
+            try:
+                for item in produce():
+                    # expired as stalled, nobody is listening anymore
+                    if generation.done:
+                        return
+                    if isinstance(item, dict):
+                        usage = item
+                    elif item:
+                        generation.append(item)
+            except Exception as e:
+                generation.finish(usage, error=str(e))
+            else:
+                generation.finish(usage)
+
+        threading.Thread(target=run, daemon=True).start()
+        return generation
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        self._expire()
+        with self._lock:
+            return self._generations.get(generation_id)
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            for generation_id, generation in list(self._generations.items()):
+                if (
+                    not generation.done
+                    and now - generation.updated_at > self.stall_timeout
+                ):
+                    generation.finish(error="Generation stalled")
+                if generation.done and now - generation.finished_at > self.ttl:
+                    del self._generations[generation_id]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the service modules are imported as the `src` package, like modal does
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
@@ -0,0 +1,127 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from src.inngest import Inngest
+
+
+class Endpoint:
+    """
+    Local stand-in for the Inngest event API, recording each request's events.
+    Answers `failures` requests with a 500 before accepting any.
+    """
+
+    def __init__(self, failures: int = 0, delay: float = 0.0):
+        self.batches = []
+        self.failures = failures
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                time.sleep(delay)
+                if endpoint.failures:
+                    endpoint.failures -= 1
+                    self.send_response(500)
+                else:
+                    endpoint.batches.append(json.loads(body))
+                    self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def events(self):
+        return [event for batch in self.batches for event in batch]
+
+
+@pytest.fixture(autouse=True)
+def event_key(monkeypatch):
+    monkeypatch.setenv("INNGEST_EVENT_KEY", "key")
+
+
+def emitter(endpoint: Endpoint, **kwargs) -> Inngest:
+    return Inngest("job", endpoint=endpoint.url, **kwargs)
+
+
+def test_logs_are_sent_in_batches_and_in_order():
+    endpoint = Endpoint()
+    inngest = emitter(endpoint, flush_interval=0.2)
+    for i in range(250):
+        inngest.post_log(str(i))
+    inngest.close()
+
+    assert [event["data"]["log"] for event in endpoint.events] == [
+        str(i) for i in range(250)
+    ]
+    assert len(endpoint.batches) < 10
+
+
+def test_final_steps_dont_wait_for_the_network():
+    endpoint = Endpoint(delay=0.5)
+    inngest = emitter(endpoint)
+
+    start = time.monotonic()
+    inngest.post_log("done")
+    inngest.post_step("JOB_COMPLETED")
+    assert time.monotonic() - start < 0.1
+
+    inngest.close()
+    assert [event["name"] for event in endpoint.events] == [
+        "training/log.create",
+        "training/step.create",
+    ]
+
+
+def test_failed_requests_are_retried():
+    endpoint = Endpoint(failures=2)
+    inngest = emitter(endpoint, max_retries=3)
+    inngest.post_step("JOB_STARTED")
+    inngest.close()
+
+    assert [event["data"]["stepType"] for event in endpoint.events] == ["JOB_STARTED"]
+
+
+def test_oldest_events_are_dropped_when_the_queue_is_full():
+    endpoint = Endpoint(delay=0.2)
+    inngest = emitter(endpoint, max_queue_size=10)
+    # the first event goes out right away and holds up the rest
+    inngest.post_step("JOB_STARTED")
+    time.sleep(0.05)
+    for i in range(20):
+        inngest.post_log(str(i))
+    inngest.close()
+
+    assert inngest.dropped == 10
+    assert [event["data"].get("log") for event in endpoint.events[1:]] == [
+        str(i) for i in range(10, 20)
+    ]
+
+
+def test_steps_are_kept_when_the_queue_is_full():
+    endpoint = Endpoint(delay=0.2)
+    inngest = emitter(endpoint, max_queue_size=10)
+    inngest.post_step("JOB_STARTED")
+    time.sleep(0.05)
+    inngest.post_step("TRAINING")
+    for i in range(20):
+        inngest.post_log(str(i))
+    inngest.post_step("JOB_COMPLETED")
+    inngest.close()
+
+    assert inngest.dropped == 10
+    sent = [
+        event["data"].get("stepType", event["data"].get("log"))
+        for event in endpoint.events
+    ]
+    logs = [str(i) for i in range(10, 20)]
+    assert sent == ["JOB_STARTED", "TRAINING", *logs, "JOB_COMPLETED"]
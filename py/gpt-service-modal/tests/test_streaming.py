@@ -0,0 +1,56 @@
+import json
+import threading
+import time
+
+from src.streaming import GenerationStore
+
+
+def parse(events):
+    parsed = []
+    for event in events:
+        lines = event.strip().split("\n")
+        name = next(line for line in lines if line.startswith("event: "))
+        data = next(line for line in lines if line.startswith("data: "))
+        parsed.append((name[len("event: ") :], json.loads(data[len("data: ") :])))
+    return parsed
+
+
+def test_generation_streams_deltas_and_usage():
+    store = GenerationStore()
+    generation = store.start(lambda: iter(["Hello", ", world", {"total_tokens": 3}]))
+
+    events = parse(generation.events())
+
+    assert [name for name, _ in events] == ["generation", "delta", "delta", "done"]
+    assert events[-1][1]["usage"] == {"total_tokens": 3}
+    assert store.get(generation.id) is generation
+
+
+def test_stalled_generations_are_finished_with_an_error_and_expired():
+    release, closed = threading.Event(), threading.Event()
+
+    def produce():
+        try:
+            yield "Hello"
+            release.wait(5)
+            yield ", world"
+        finally:
+            closed.set()
+
+    store = GenerationStore(ttl=60, stall_timeout=0)
+    generation = store.start(produce)
+    while not generation.deltas:
+        time.sleep(0.01)
+
+    assert store.get(generation.id) is generation
+    events = parse(generation.events())
+    assert [name for name, _ in events] == ["generation", "delta", "error", "done"]
+    assert events[2][1] == {"error": "Generation stalled"}
+
+    # output arriving after the generation stalled is dropped
+    release.set()
+    assert closed.wait(5)
+    assert generation.deltas == ["Hello"]
+
+    store.ttl = 0
+    assert store.get(generation.id) is None
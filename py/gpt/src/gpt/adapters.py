@@ -0,0 +1,154 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+import torch
+from peft.tuners.lora import LoraLayer
+
+MAX_RESIDENT_ADAPTERS = 8
+MAX_RESIDENT_ADAPTER_BYTES = 2 * 1024**3
+
+
+def adapter_name(lora_path: str) -> str:
+    # peft keeps adapters in ModuleDicts, so names can't contain dots
+    return lora_path.rstrip("/").split("/")[-1].replace(".", "_")
+
+
+class AdapterCache:
+    """
+    Bookkeeping for the LoRA adapters which are resident on the model.
+
+    Adapters are kept in least recently used order and evicted once either the
+    number of adapters or their total size goes over budget. Loading and
+    unloading the weights is left to the caller.
+    """
+
+    def __init__(
+        self,
+        max_adapters: int = MAX_RESIDENT_ADAPTERS,
+        max_bytes: Optional[int] = MAX_RESIDENT_ADAPTER_BYTES,
+    ):
+        self.max_adapters = max_adapters
+        self.max_bytes = max_bytes
+
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sizes
+
+    def __len__(self) -> int:
+        return len(self._sizes)
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def get(self, name: str) -> bool:
+        if name in self._sizes:
+            self._sizes.move_to_end(name)
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def put(self, name: str, size: int, pinned: Iterable[str] = ()) -> List[str]:
+        """
+        Records a newly loaded adapter, returning the names of the adapters which
+        should be unloaded to stay within budget. Neither the new adapter nor any
+        `pinned` ones (e.g. in use by running requests) are evicted.
+        """
+        self._sizes[name] = size
+        self._sizes.move_to_end(name)
+
+        keep = {name, *pinned}
+        evicted = []
+        for candidate in list(self._sizes):
+            if not self._over_budget():
+                break
+            if candidate in keep:
+                continue
+            del self._sizes[candidate]
+            evicted.append(candidate)
+            self.evictions += 1
+
+        return evicted
+
+    def _over_budget(self) -> bool:
+        return len(self._sizes) > self.max_adapters or (
+            self.max_bytes is not None and self.size > self.max_bytes
+        )
+
+    def clear(self):
+        self._sizes.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "adapters": len(self._sizes),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class AdapterRouter:
+    """
+    Applies a different LoRA adapter (or none) to each row of a batch.
+
+    peft only supports a single active adapter, so its own adapter layers are
+    disabled and a forward hook on every LoRA layer adds the delta of each row's
+    adapter instead. Outside of `route` the hooks do nothing.
+    """
+
+    def __init__(self):
+        self._handles = []
+        self._groups: List[tuple] = []
+
+    def attach(self, model):
+        self.detach()
+        model.base_model.disable_adapter_layers()
+        for module in model.modules():
+            if isinstance(module, LoraLayer):
+                self._handles.append(module.register_forward_hook(self._hook))
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    @contextmanager
+    def route(self, row_adapters: List[Optional[str]]):
+        groups = {}
+        for row, name in enumerate(row_adapters):
+            if name is not None:
+                groups.setdefault(name, []).append(row)
+        self._groups = [(name, torch.tensor(rows), {}) for name, rows in groups.items()]
+        try:
+            yield
+        finally:
+            self._groups = []
+
+    def _hook(self, module, inputs, output):
+        if not self._groups:
+            return None
+
+        x = inputs[0]
+        for name, rows, rows_by_device in self._groups:
+            if name not in module.lora_A:
+                continue
+            if x.device not in rows_by_device:
+                rows_by_device[x.device] = rows.to(x.device)
+            index = rows_by_device[x.device]
+
+            lora_A = module.lora_A[name]
+            delta = module.lora_B[name](
+                lora_A(x.index_select(0, index).to(lora_A.weight.dtype))
+            )
+            output = output.index_add(
+                0, index, (delta * module.scaling[name]).to(output.dtype)
+            )
+        return output
@@ -0,0 +1,354 @@
+"""
+Benchmarks of the hot paths of `LLM`: streaming generation, stop checking,
+dataset preprocessing and LoRA training steps.
+
+Everything runs against a tiny randomly initialized Llama and a word level
+tokenizer built in a temporary directory, so no network or GPU is needed and the
+numbers measure our own overheads rather than the model's. They are only
+comparable between runs on the same machine.
+
+    python -m gpt.benchmark --output results.json
+    python -m gpt.benchmark --baseline results.json --tolerance 0.15
+
+With a baseline, the exit code is 1 if any metric got worse by more than the
+tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import torch
+import transformers
+from peft import LoraConfig, TaskType, get_peft_model
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import (
+    AutoModelForCausalLM,
+    LlamaConfig,
+    LlamaForCausalLM,
+    PreTrainedTokenizerFast,
+)
+
+from . import utils
+from .llm import (
+    CUTOFF_LEN,
+    LEARNING_RATE,
+    LLM,
+    LORA_ALPHA,
+    LORA_DROPOUT,
+    LORA_R,
+    MICRO_BATCH_SIZE,
+)
+from .preprocessing import tokenize_dataset
+
+VOCAB_SIZE = 2000
+PROMPT_LENGTHS = (16, 128, 512)
+NEW_TOKENS = 64
+PROMPT_TEMPLATE = "### Human: {{instruction}}\n### Assistant: {{output}}"
+
+# metric name: {"value", "unit", "higher_is_better"}
+Results = Dict[str, dict]
+
+
+def build_tiny_model(path: str, vocab_size: int = VOCAB_SIZE, seed: int = 0):
+    """
+    Saves a randomly initialized Llama and a matching tokenizer to `path`, where
+    `LLM.load_model` can load them. Words are "w0".."w<n>".
+    """
+    torch.manual_seed(seed)
+
+    vocab = {f"w{i}": i for i in range(vocab_size - 3)}
+    for i, token in enumerate(["<unk>", "<s>", "</s>"]):
+        vocab[token] = vocab_size - 3 + i
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token="<unk>",
+        bos_token="<s>",
+        eos_token="</s>",
+        model_max_length=2048,
+    ).save_pretrained(path)
+
+    LlamaForCausalLM(
+        LlamaConfig(
+            vocab_size=vocab_size,
+            hidden_size=128,
+            intermediate_size=256,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            max_position_embeddings=2048,
+            bos_token_id=vocab_size - 2,
+            eos_token_id=vocab_size - 1,
+        )
+    ).save_pretrained(path)
+
+
+def random_text(words: int, rng: random.Random) -> str:
+    return " ".join(f"w{rng.randrange(VOCAB_SIZE - 3)}" for _ in range(words))
+
+
+def bench_generation(
+    llm: LLM,
+    prompt_lengths=PROMPT_LENGTHS,
+    new_tokens: int = NEW_TOKENS,
+    repeats: int = 5,
+) -> Results:
+    rng = random.Random(0)
+    results = {}
+    for length in prompt_lengths:
+        ttft, decode, total = [], [], []
+        for _ in range(repeats):
+            usage = {}
+            start = time.perf_counter()
+            for _ in llm.generate_streaming(
+                {
+                    "max_new_tokens": new_tokens,
+                    "do_sample": False,
+                    # never stop early, every run generates the same number of tokens
+                    "eos_token_id": -1,
+                    "stopping_sequence": None,
+                },
+                random_text(length, rng),
+                echo_prompt=False,
+                usage=usage,
+            ):
+                pass
+            elapsed = time.perf_counter() - start
+
+            timing = usage["timing"]
+            ttft.append(timing["time_to_first_token"])
+            if timing["generation"]:
+                decode.append(timing["inter_token"]["count"] / timing["generation"])
+            total.append(usage["completion_tokens"] / elapsed)
+
+        prefix = f"generation.prompt_{length}"
+        results[f"{prefix}.ttft_ms"] = _metric(1000 * _median(ttft), "ms", False)
+        results[f"{prefix}.decode_tokens_per_second"] = _metric(
+            _median(decode), "tokens/s", True
+        )
+        results[f"{prefix}.tokens_per_second"] = _metric(
+            _median(total), "tokens/s", True
+        )
+    return results
+
+
+def bench_stop(tokenizer, tokens: int = 5000, repeats: int = 5) -> Results:
+    rng = random.Random(0)
+    token_ids = [rng.randrange(VOCAB_SIZE - 3) for _ in range(tokens)]
+
+    def per_token(stop: utils.Stop) -> float:
+        times = []
+        for _ in range(repeats):
+            row = stop.add_row()
+            start = time.perf_counter()
+            for token_id in token_ids:
+                stop.step(row, [token_id])
+            times.append((time.perf_counter() - start) / tokens)
+        return _median(times)
+
+    baseline = per_token(utils.Stop(tokenizer, None))
+    with_stops = per_token(
+        utils.Stop(tokenizer, ["### Human:", "w1 w2 w3"], [[1, 2, 3]])
+    )
+    return {
+        "stop.step_us_per_token": _metric(1e6 * with_stops, "us", False),
+        "stop.overhead_us_per_token": _metric(
+            1e6 * (with_stops - baseline), "us", False
+        ),
+    }
+
+
+def bench_preprocessing(tokenizer, directory: str, rows: int = 20_000) -> Results:
+    import datasets
+
+    rng = random.Random(0)
+    dataset_path = os.path.join(directory, "dataset")
+    os.makedirs(dataset_path, exist_ok=True)
+    with open(os.path.join(dataset_path, "train.jsonl"), "w") as f:
+        for _ in range(rows):
+            row = {
+                "instruction": random_text(rng.randint(8, 64), rng),
+                "output": random_text(rng.randint(8, 128), rng),
+            }
+            f.write(json.dumps(row) + "\n")
+
+    # loading the raw files isn't what's being measured
+    datasets.load_dataset(dataset_path)
+    datasets.disable_caching()
+    try:
+        start = time.perf_counter()
+        data = tokenize_dataset(
+            dataset_path, PROMPT_TEMPLATE, tokenizer, max_length=CUTOFF_LEN
+        )
+        elapsed = time.perf_counter() - start
+    finally:
+        datasets.enable_caching()
+
+    return {
+        "preprocessing.rows_per_second": _metric(len(data) / elapsed, "rows/s", True)
+    }
+
+
+def bench_lora(model_path: str, steps: int = 20, warmup: int = 2) -> Results:
+    model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=torch.float32)
+    model = get_peft_model(
+        model,
+        LoraConfig(
+            r=LORA_R,
+            lora_alpha=LORA_ALPHA,
+            target_modules=["q_proj", "v_proj"],
+            lora_dropout=LORA_DROPOUT,
+            bias="none",
+            task_type=TaskType.CAUSAL_LM,
+        ),
+    )
+    model.train()
+    optimizer = torch.optim.AdamW(
+        [p for p in model.parameters() if p.requires_grad], lr=LEARNING_RATE
+    )
+
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(
+        VOCAB_SIZE - 3, (MICRO_BATCH_SIZE, CUTOFF_LEN), generator=generator
+    )
+
+    def step():
+        loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    for _ in range(warmup):
+        step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "lora.steps_per_second": _metric(steps / elapsed, "steps/s", True),
+        "lora.tokens_per_second": _metric(
+            steps * input_ids.numel() / elapsed, "tokens/s", True
+        ),
+    }
+
+
+def run(quick: bool = False) -> dict:
+    torch.manual_seed(0)
+    results: Results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.join(directory, "model")
+        build_tiny_model(model_path)
+
+        llm = LLM()
+        llm.load_model(model_path, quantization="fp32", snapshot=False)
+
+        results.update(
+            bench_generation(
+                llm,
+                prompt_lengths=PROMPT_LENGTHS[:1] if quick else PROMPT_LENGTHS,
+                repeats=2 if quick else 5,
+            )
+        )
+        results.update(bench_stop(llm.tokenizer, tokens=1000 if quick else 5000))
+        results.update(
+            bench_preprocessing(
+                llm.tokenizer, directory, rows=2000 if quick else 20_000
+            )
+        )
+        results.update(bench_lora(model_path, steps=3 if quick else 20))
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "threads": torch.get_num_threads(),
+        },
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[dict]:
+    """
+    Returns the change of every metric in both runs, with `regression` set for
+    those which got worse by more than `tolerance` (a fraction).
+    """
+    changes = []
+    for name, metric in results["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+
+        change = (
+            (metric["value"] - before["value"]) / abs(before["value"])
+            if before["value"]
+            else 0.0
+        )
+        worse = -change if metric["higher_is_better"] else change
+        changes.append(
+            {
+                "metric": name,
+                "baseline": before["value"],
+                "value": metric["value"],
+                "change": round(change, 4),
+                # overheads near zero swing wildly in relative terms
+                "regression": worse > tolerance and abs(before["value"]) > 1e-3,
+            }
+        )
+    return changes
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.15,
+        help="relative change allowed before a metric counts as a regression",
+    )
+    parser.add_argument("--quick", action="store_true", help="fewer, shorter runs")
+    args = parser.parse_args(argv)
+
+    results = run(quick=args.quick)
+    if args.baseline:
+        with open(args.baseline) as f:
+            results["comparison"] = compare(results, json.load(f), args.tolerance)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+    regressions = [c for c in results.get("comparison", []) if c["regression"]]
+    for change in regressions:
+        print(
+            f"Regression in {change['metric']}: {change['baseline']:.4g} -> "
+            f"{change['value']:.4g} ({change['change']:+.1%})",
+            file=sys.stderr,
+        )
+    return 1 if regressions else 0
+
+
+def _metric(value: float, unit: str, higher_is_better: bool) -> dict:
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def _median(values: List[float]) -> float:
+    return statistics.median(values) if values else 0.0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
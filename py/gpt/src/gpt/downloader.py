@@ -0,0 +1,344 @@
+"""
+Downloads Hugging Face repo snapshots into a plain directory.
+
+Files are fetched concurrently in fixed size chunks with range requests. Every
+finished chunk is recorded next to the partial file, so a download interrupted
+by a crash resumes from the chunks it already has. Finished files are checked
+against the size and hash the hub reports for them, and the snapshot is built in
+a staging directory which is only renamed to its final path once complete, so a
+model directory which exists is always a whole one.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from typing import Callable, Dict, List, Optional, Sequence
+
+import requests
+from huggingface_hub import HfApi, HfFolder, hf_hub_url
+
+DOWNLOAD_WORKERS = 8
+CHUNK_SIZE = 64 * 1024**2
+MAX_RETRIES = 3
+REQUEST_TIMEOUT = (10, 60)
+
+STAGING_SUFFIX = ".partial"
+INCOMPLETE_SUFFIX = ".incomplete"
+CHUNKS_SUFFIX = ".chunks"
+MANIFEST_NAME = ".download.json"
+
+
+class RemoteFile:
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        size: int,
+        sha256: Optional[str] = None,
+        git_sha1: Optional[str] = None,
+        commit: Optional[str] = None,
+    ):
+        self.name = name
+        self.url = url
+        self.size = size
+        # lfs files are identified by the sha256 of their content, others by
+        # their git blob id
+        self.sha256 = sha256
+        self.git_sha1 = git_sha1
+        # the commit `url` is pinned to
+        self.commit = commit
+
+    def chunks(self, chunk_size: int) -> List[range]:
+        return [
+            range(start, min(start + chunk_size, self.size))
+            for start in range(0, max(self.size, 1), chunk_size)
+        ]
+
+
+class DownloadError(Exception):
+    pass
+
+
+class SnapshotDownloader:
+    def __init__(
+        self,
+        token: Optional[str] = None,
+        max_workers: int = DOWNLOAD_WORKERS,
+        chunk_size: int = CHUNK_SIZE,
+        endpoint: Optional[str] = None,
+        on_progress: Optional[Callable[[dict], None]] = None,
+    ):
+        self.token = token or HfFolder.get_token()
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.endpoint = endpoint
+        self.on_progress = on_progress or _print_progress
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        # indices of the chunks of each file which are on disk
+        self._done: Dict[str, set] = {}
+        self._downloaded = 0
+        self._resumed = 0
+        self._total = 0
+        self._started_at = 0.0
+        self._last_report = 0.0
+
+    def list_files(
+        self,
+        repo_id: str,
+        repo_type: Optional[str] = None,
+        revision: Optional[str] = None,
+    ) -> List[RemoteFile]:
+        info = HfApi(endpoint=self.endpoint).repo_info(
+            repo_id,
+            repo_type=repo_type,
+            revision=revision,
+            files_metadata=True,
+            token=self.token,
+        )
+
+        files = []
+        for sibling in info.siblings:
+            lfs = sibling.lfs
+            # older hub clients return lfs info as a dict
+            sha256 = (
+                lfs.get("sha256")
+                if isinstance(lfs, dict)
+                else getattr(lfs, "sha256", None)
+            )
+            files.append(
+                RemoteFile(
+                    sibling.rfilename,
+                    hf_hub_url(
+                        repo_id,
+                        sibling.rfilename,
+                        repo_type=repo_type,
+                        # pin the commit, so files can't change mid download
+                        revision=info.sha,
+                        endpoint=self.endpoint,
+                    ),
+                    sibling.size,
+                    sha256=sha256,
+                    git_sha1=None if lfs else sibling.blob_id,
+                    commit=info.sha,
+                )
+            )
+        return files
+
+    def download(
+        self,
+        repo_id: str,
+        local_dir: str,
+        repo_type: Optional[str] = None,
+        revision: Optional[str] = None,
+        allow_patterns: Optional[Sequence[str]] = None,
+        ignore_patterns: Optional[Sequence[str]] = None,
+        files: Optional[List[RemoteFile]] = None,
+    ) -> dict:
+        """
+        Downloads the files of a repo (or the given `files`) into `local_dir`, and
+        returns the download stats. Does nothing if `local_dir` already exists.
+        """
+        if os.path.exists(local_dir):
+            return {"cached": True}
+
+        if files is None:
+            files = self.list_files(repo_id, repo_type, revision)
+        files = [
+            f
+            for f in files
+            if (not allow_patterns or any(fnmatch(f.name, p) for p in allow_patterns))
+            and not any(fnmatch(f.name, p) for p in ignore_patterns or ())
+        ]
+
+        staging_dir = f"{local_dir.rstrip(os.sep)}{STAGING_SUFFIX}"
+        os.makedirs(staging_dir, exist_ok=True)
+
+        self._downloaded = 0
+        self._resumed = 0
+        self._total = sum(f.size for f in files)
+        self._started_at = self._last_report = time.monotonic()
+
+        pending = [f for f in files if not self._is_complete(staging_dir, f)]
+        self._resumed += sum(f.size for f in files if f not in pending)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            tasks = []
+            for f in pending:
+                done = self._prepare(staging_dir, f)
+                for i, chunk in enumerate(f.chunks(self.chunk_size)):
+                    if i in done:
+                        self._resumed += len(chunk)
+                    else:
+                        tasks.append(
+                            pool.submit(self._fetch_chunk, staging_dir, f, i, chunk)
+                        )
+
+            # re-raises the first chunk which failed after its retries
+            for task in tasks:
+                task.result()
+
+        for f in pending:
+            self._finish(staging_dir, f)
+
+        # record the commit the files came from rather than a branch name, or
+        # None for the default branch
+        commit = next((f.commit for f in files if f.commit), revision)
+        stats = self._stats()
+        with open(os.path.join(staging_dir, MANIFEST_NAME), "w") as manifest:
+            json.dump(
+                {
+                    "repo_id": repo_id,
+                    "repo_type": repo_type,
+                    "revision": commit,
+                    "files": {
+                        f.name: {
+                            "size": f.size,
+                            "sha256": f.sha256,
+                            "git_sha1": f.git_sha1,
+                        }
+                        for f in files
+                    },
+                    "stats": stats,
+                },
+                manifest,
+            )
+
+        os.rename(staging_dir, local_dir)
+        self.on_progress({**stats, "done": True})
+        return stats
+
+    def _is_complete(self, staging_dir: str, f: RemoteFile) -> bool:
+        # files are only moved to their final name after being verified
+        path = os.path.join(staging_dir, f.name)
+        return os.path.exists(path) and os.path.getsize(path) == f.size
+
+    def _prepare(self, staging_dir: str, f: RemoteFile) -> set:
+        path = os.path.join(staging_dir, f.name) + INCOMPLETE_SUFFIX
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        done = set()
+        if os.path.exists(path) and os.path.getsize(path) == f.size:
+            try:
+                with open(path + CHUNKS_SUFFIX) as chunks:
+                    done = set(json.load(chunks))
+            except (OSError, ValueError):
+                pass
+        else:
+            with open(path, "wb") as partial:
+                partial.truncate(f.size)
+
+        self._done[f.name] = done
+        return done
+
+    def _fetch_chunk(self, staging_dir: str, f: RemoteFile, index: int, chunk: range):
+        path = os.path.join(staging_dir, f.name) + INCOMPLETE_SUFFIX
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        if f.size:
+            headers["Range"] = f"bytes={chunk.start}-{chunk.stop - 1}"
+
+        for attempt in range(MAX_RETRIES + 1):
+            written = 0
+            try:
+                with self._session.get(
+                    f.url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206 and len(chunk) != f.size:
+                        raise DownloadError(f"{f.url} doesn't support range requests")
+
+                    with open(path, "r+b") as partial:
+                        partial.seek(chunk.start)
+                        for data in response.iter_content(1024**2):
+                            partial.write(data)
+                            written += len(data)
+                            self._progress(len(data))
+
+                if written != len(chunk):
+                    raise DownloadError(
+                        f"Got {written} bytes of {f.name}[{chunk.start}:{chunk.stop}]"
+                    )
+                break
+            except (requests.RequestException, DownloadError) as e:
+                self._progress(-written)
+                if attempt == MAX_RETRIES:
+                    raise DownloadError(f"Failed to download {f.name}: {e}") from e
+                time.sleep(2**attempt)
+
+        with self._lock:
+            self._done[f.name].add(index)
+            with open(path + CHUNKS_SUFFIX, "w") as chunks:
+                json.dump(sorted(self._done[f.name]), chunks)
+
+    def _finish(self, staging_dir: str, f: RemoteFile):
+        path = os.path.join(staging_dir, f.name)
+        partial_path = path + INCOMPLETE_SUFFIX
+
+        size = os.path.getsize(partial_path)
+        if size != f.size:
+            raise DownloadError(f"{f.name} is {size} bytes, expected {f.size}")
+
+        if f.sha256 or f.git_sha1:
+            digest = _file_digest(partial_path, f.size, git_blob=not f.sha256)
+            if digest != (f.sha256 or f.git_sha1):
+                # the chunks can't be trusted, start the file over next time
+                os.remove(partial_path)
+                os.remove(partial_path + CHUNKS_SUFFIX)
+                raise DownloadError(f"{f.name} failed verification")
+
+        os.replace(partial_path, path)
+        if os.path.exists(partial_path + CHUNKS_SUFFIX):
+            os.remove(partial_path + CHUNKS_SUFFIX)
+
+    def _progress(self, size: int):
+        with self._lock:
+            self._downloaded += size
+            now = time.monotonic()
+            if now - self._last_report < 5:
+                return
+            self._last_report = now
+        self.on_progress(self._stats())
+
+    def _stats(self) -> dict:
+        seconds = time.monotonic() - self._started_at
+        return {
+            "bytes": self._downloaded + self._resumed,
+            "total_bytes": self._total,
+            "downloaded_bytes": self._downloaded,
+            "resumed_bytes": self._resumed,
+            "seconds": round(seconds, 3),
+            "mb_per_second": round(self._downloaded / 1024**2 / seconds, 2)
+            if seconds
+            else 0.0,
+        }
+
+
+def download_snapshot(repo_id: str, local_dir: str, **kwargs) -> dict:
+    return SnapshotDownloader().download(repo_id, local_dir, **kwargs)
+
+
+def _file_digest(path: str, size: int, git_blob: bool = False) -> str:
+    digest = hashlib.sha1() if git_blob else hashlib.sha256()
+    if git_blob:
+        digest.update(f"blob {size}\0".encode())
+    with open(path, "rb") as f:
+        while data := f.read(8 * 1024**2):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def _print_progress(stats: dict):
+    total = stats["total_bytes"] or 1
+    print(
+        f"Downloaded {stats['bytes'] / 1024**2:.0f}/{total / 1024**2:.0f}MB "
+        f"({100 * stats['bytes'] / total:.0f}%) at {stats['mb_per_second']}MB/s"
+    )
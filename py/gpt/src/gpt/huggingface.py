@@ -1,23 +1,29 @@
 import os
 
-from huggingface_hub import login, snapshot_download
+from huggingface_hub import login
+
+from .downloader import SnapshotDownloader
 
 
 class HuggingfaceClient:
-    def __init__(self, token, download_model_fn=snapshot_download, cache_dir=None):
+    def __init__(self, token, download_model_fn=None, cache_dir=None):
         self.token = token
         self.cache_dir = cache_dir
 
-        self._download_model = download_model_fn
+        self._download_model = (
+            download_model_fn or SnapshotDownloader(token=token).download
+        )
 
     def get_cache_dir(self):
         return self.cache_dir
 
+    def model_path(self, repo_id: str) -> str:
+        return os.path.join(self.cache_dir or ".", repo_id.replace("/", "--"))
+
     def download_model(self, repo_id: str):
         # login(self.token)
-        self._download_model(
+        return self._download_model(
             repo_id=repo_id,
+            local_dir=self.model_path(repo_id),
             # ignore_patterns="*.pt",
-            cache_dir=self.cache_dir,
-            token=self.token,
         )
@@ -1,19 +1,25 @@
+import math
 import os
 import time
-from threading import Thread
-from typing import Callable, Literal, Optional, TypedDict, Union
+from collections import deque
+from typing import (
+    Callable,
+    Deque,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    TypedDict,
+    Union,
+)
 
 import chevron
 import torch
 import transformers
 from datasets import load_dataset
-from huggingface_hub import (
-    _CACHED_NO_EXIST,
-    login,
-    scan_cache_dir,
-    try_to_load_from_cache,
-)
-from huggingface_hub.constants import HUGGINGFACE_HUB_CACHE
+from huggingface_hub import login
 from peft import (
     LoraConfig,
     PeftModel,
@@ -42,7 +48,37 @@ from transformers import (
 from transformers.integrations import WandbCallback
 
 from . import utils
+from .adapters import AdapterCache, AdapterRouter, adapter_name
+from .packing import (
+    CountingCollator,
+    PackedCollator,
+    PackingMode,
+    accepts_position_ids,
+    add_lengths,
+    enable_segment_attention,
+    pack_dataset,
+    packing_efficiency,
+)
+from .prefix_cache import PrefixCache
+from .preprocessing import (
+    SHUFFLE_BUFFER_SIZE,
+    PrefetchingDataset,
+    limit_tokens,
+    stream_tokenized_dataset,
+    tokenize_dataset,
+)
+from .profiling import StartupProfiler
+from .registry import template_hash, write_manifest
 from .reporter import CustomWandBCallback, LLMTrainerCallback, TrainingJobStep
+from .scheduler import GenerationScheduler, SchedulerStreamer
+from .snapshot import (
+    DTYPES,
+    Quantization,
+    has_snapshot,
+    load_snapshot,
+    save_snapshot,
+)
+from .speculative import NUM_DRAFT_TOKENS, SpeculativeDecoder
 
 MICRO_BATCH_SIZE = 4  # this could actually be 5 but i like powers of 2
 BATCH_SIZE = 256
@@ -54,6 +90,9 @@ CUTOFF_LEN = 256  # 256 accounts for about 96% of the data
 LORA_R = 8
 LORA_ALPHA = 16
 LORA_DROPOUT = 0.05
+# rows and prompt plus completion tokens in flight in generate_batch
+MAX_BATCH_ROWS = 32
+MAX_BATCH_TOKENS = 16384
 
 ## POTENTIAL ARGS
 # LORA_ALPHA = 8
@@ -65,59 +104,225 @@ class GenerationArgs(TypedDict):
     top_k: Optional[int]
     temperature: Optional[float]
     repetiton_penalty: Optional[float]
-    stopping_sequence: Optional[str]
+    stopping_sequence: Optional[Union[str, List[str]]]
+    stop_token_ids: Optional[List[List[int]]]
 
 
 class TrainerArgs(TypedDict):
     report_to_wandb: bool
+    preprocessing_cache_dir: Optional[str]
+    preprocessing_num_proc: Optional[int]
+    packing: PackingMode
+    streaming: bool
+    shuffle_buffer_size: Optional[int]
+    max_samples: Optional[int]
+    max_tokens: Optional[int]
+    max_steps: Optional[int]
 
 
 class LLM:
     model_type: Union[Literal["Llama"], Literal["Falcon"]]
     model: Optional[PreTrainedModel]
     tokenizer: Optional[PreTrainedTokenizer]
+    scheduler: Optional[GenerationScheduler]
+    speculative: Optional[SpeculativeDecoder] = None
+    adapters: AdapterCache
+    router: AdapterRouter
+    prefix_cache: PrefixCache
 
-    def load_model(self, model_path: str):
-        nf4_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_compute_dtype=torch.bfloat16,
+    def load_model(
+        self,
+        model_path: str,
+        quantization: Quantization = "nf4",
+        snapshot: bool = True,
+        profiler: Optional[StartupProfiler] = None,
+    ):
+        """
+        Loads the model quantized to `quantization`. With `snapshot`, the loaded
+        model is saved alongside the checkpoint the first time, and later loads
+        read it from there instead of converting the checkpoint again.
+        """
+        profiler = profiler or StartupProfiler()
+
+        self.model_path = model_path
+        self.quantization = quantization
+        self.model = None
+        if snapshot and has_snapshot(model_path, quantization):
+            try:
+                with profiler.phase("snapshot_load", quantization=quantization):
+                    self.model, self.tokenizer = load_snapshot(model_path, quantization)
+            except Exception as e:
+                print(f"Failed to load snapshot of {model_path}: {e}")
+
+        if self.model is None:
+            self.model = self._from_pretrained(model_path, quantization, profiler)
+            with profiler.phase("tokenizer"):
+                self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+            if snapshot:
+                try:
+                    with profiler.phase("snapshot_save"):
+                        save_snapshot(
+                            self.model, self.tokenizer, model_path, quantization
+                        )
+                except Exception as e:
+                    print(f"Failed to save snapshot of {model_path}: {e}")
+
+        self.adapters = AdapterCache()
+        self.router = AdapterRouter()
+        self.prefix_cache = PrefixCache()
+        self.scheduler = GenerationScheduler(
+            self.model,
+            self.tokenizer,
+            load_adapter=self._load_adapter,
+            route_adapters=self._route_adapters,
+            prefix_cache=self.prefix_cache,
         )
 
-        config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
+    def _from_pretrained(
+        self, model_path: str, quantization: Quantization, profiler: StartupProfiler
+    ) -> PreTrainedModel:
+        with profiler.phase("config"):
+            config = AutoConfig.from_pretrained(model_path, trust_remote_code=True)
         # if "mpt" in model_path:
         #     config.attn_config[
         #         "attn_impl"
         #     ] = "triton"  # change this to use triton-based FlashAttention
         #     config.init_device = "cuda:0"  # For fast initialization directly on GPU!
 
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_path,
-            config=config,
-            quantization_config=nf4_config,
-            trust_remote_code=True,
-            device_map="auto",
+        if quantization == "nf4":
+            nf4_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+            # bitsandbytes quantizes each weight as it is moved to the GPU
+            with profiler.phase("weights", quantization="nf4"):
+                return AutoModelForCausalLM.from_pretrained(
+                    model_path,
+                    config=config,
+                    quantization_config=nf4_config,
+                    trust_remote_code=True,
+                    device_map="auto",
+                )
+
+        with profiler.phase("weights"):
+            model = AutoModelForCausalLM.from_pretrained(
+                model_path,
+                config=config,
+                torch_dtype=DTYPES[quantization],
+                trust_remote_code=True,
+            )
+        if quantization == "int8":
+            with profiler.phase("quantization", quantization="int8"):
+                model = torch.ao.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+        return model.eval()
+
+    def load_draft_model(
+        self,
+        draft_path: str,
+        quantization: Optional[Quantization] = None,
+        num_draft_tokens: int = NUM_DRAFT_TOKENS,
+    ):
+        """
+        Loads a small model sharing the tokenizer of the main one, which proposes
+        tokens for `generate_streaming(..., speculative=True)`. It is quantized
+        like the main model unless `quantization` says otherwise.
+        """
+        draft_tokenizer = AutoTokenizer.from_pretrained(draft_path)
+        if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+            raise ValueError(f"{draft_path} doesn't share the model's tokenizer")
+
+        quantization = quantization or self.quantization
+        draft_model = self._from_pretrained(draft_path, quantization, StartupProfiler())
+        if quantization in ("bf16", "fp16", "fp32"):
+            draft_model = draft_model.to(self.model.device)
+
+        self.speculative = SpeculativeDecoder(
+            self.scheduler, draft_model, num_draft_tokens
         )
-        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
 
-    def apply_lora(self, lora_path: str):
+    def warmup(self):
+        """
+        Generates a single token, so the first request doesn't pay for lazy
+        initialization (CUDA kernels, the scheduler thread).
+        """
+        for _ in self.generate_streaming(
+            {"max_new_tokens": 1, "do_sample": False}, "Hello", echo_prompt=False
+        ):
+            pass
+
+    def apply_lora(self, lora_path: str, in_use: Iterable[str] = ()) -> str:
+        """
+        Makes the adapter at `lora_path` resident and returns its name. This does
+        not change which adapter the model runs with, that is decided per request
+        by passing `lora_path` to `generate_streaming`.
+        """
         if not self.model:
             raise Exception("Model not loaded")
 
-        self.model = PeftModel.from_pretrained(
-            self.model,
-            lora_path,
-            device_map={"": 0},
-            torch_dtype=torch.float32,
-        )
-        print("{} Lora Applied.".format(lora_path))
+        name = adapter_name(lora_path)
+        if not self.adapters.get(name):
+            if isinstance(self.model, PeftModel):
+                self.model.load_adapter(lora_path, adapter_name=name)
+            else:
+                self.model = PeftModel.from_pretrained(
+                    self.model,
+                    lora_path,
+                    adapter_name=name,
+                    device_map={"": 0},
+                    torch_dtype=torch.float32,
+                )
+
+            # peft looks up the config of its active adapter on every forward, so
+            # it must not be one of the evicted ones. The layers themselves are
+            # routed per row, this doesn't change what any request runs with.
+            self.model.set_adapter(name)
+            pinned = [adapter_name(path) for path in in_use]
+            for evicted in self.adapters.put(
+                name, self._adapter_bytes(name), pinned=pinned
+            ):
+                self.model.delete_adapter(evicted)
+
+            self.router.attach(self.model)
+            print("{} Lora Applied.".format(lora_path))
+
+        return name
 
     def remove_lora(self):
         if not self.model:
             raise Exception("Model not loaded")
 
+        self.router.detach()
         self.model = PeftModel.get_base_model(self.model)
+        self.adapters.clear()
+
+    def cache_stats(self) -> dict:
+        """
+        Counters of the caches kept across requests, since the model was loaded.
+        """
+        return {
+            "adapters": self.adapters.stats(),
+            "prefix_cache": self.prefix_cache.stats(),
+        }
+
+    def _adapter_bytes(self, name: str) -> int:
+        return sum(
+            p.numel() * p.element_size()
+            for n, p in self.model.named_parameters()
+            if f".{name}." in n
+        )
+
+    def _load_adapter(self, lora_path: str, in_use: Iterable[str]) -> PreTrainedModel:
+        self.apply_lora(lora_path, in_use)
+        return self.model
+
+    def _route_adapters(self, lora_paths: List[Optional[str]]):
+        return self.router.route(
+            [adapter_name(path) if path else None for path in lora_paths]
+        )
 
     def train(
         self,
@@ -127,8 +332,18 @@ class LLM:
         *,
         on_log: Callable[[str], None] = None,
         on_step: Callable[[TrainingJobStep, dict], None] = None,
+        on_metrics: Callable[[dict], None] = None,
         train_args: Optional[TrainerArgs] = None,
+        metadata: Optional[dict] = None,
     ):
+        """
+        Trains a LoRA adapter and saves it to `output_dir`, along with a manifest
+        of how it was trained for the finetune registry. `metadata` is added to
+        the manifest, e.g. the repo ids of the base model and dataset.
+
+        `on_metrics` receives the throughput and memory telemetry of every step
+        and a summary at the end (see `LLMTrainerCallback`).
+        """
         self.model.train()
 
         self.model = prepare_model_for_kbit_training(self.model)
@@ -151,16 +366,84 @@ class LLM:
 
         on_step(TrainingJobStep.PREPARING_DATASET)
 
-        data = load_dataset(dataset_path)
-        data = (
-            data["train"]
-            .select(range(20))
-            .map(lambda row: self.tokenizer(chevron.render(prompt_template, row)))
-        )
+        streaming = train_args.get("streaming", False)
+        max_samples = train_args.get("max_samples")
+        max_tokens = train_args.get("max_tokens")
+        if streaming:
+            data = stream_tokenized_dataset(
+                dataset_path,
+                prompt_template,
+                self.tokenizer,
+                max_samples=max_samples,
+                max_length=CUTOFF_LEN,
+                shuffle_buffer_size=(
+                    train_args.get("shuffle_buffer_size") or SHUFFLE_BUFFER_SIZE
+                ),
+            )
+        else:
+            data = tokenize_dataset(
+                dataset_path,
+                prompt_template,
+                self.tokenizer,
+                cache_dir=train_args.get("preprocessing_cache_dir"),
+                num_proc=train_args.get("preprocessing_num_proc"),
+                max_samples=max_samples,
+                max_length=CUTOFF_LEN,
+            )
+            if max_tokens is not None:
+                data = limit_tokens(data, max_tokens)
 
         self.tokenizer.pad_token = self.tokenizer.eos_token
 
-        callbacks = [LLMTrainerCallback(on_log=on_log, on_step=on_step)]
+        packing = train_args.get("packing")
+        if packing == "group_by_length" and streaming:
+            print("Length grouping needs the whole dataset, ignored when streaming")
+            packing = None
+
+        if packing == "pack":
+            data = pack_dataset(data, CUTOFF_LEN)
+            segment_attention = enable_segment_attention(model)
+            if not segment_attention:
+                print("Segment attention unsupported, packed examples share attention")
+            data_collator = PackedCollator(
+                self.tokenizer.pad_token_id,
+                segment_attention=segment_attention,
+                position_ids=accepts_position_ids(model),
+            )
+            if not streaming:
+                on_log and on_log(
+                    f"Packed into {len(data)} blocks of {CUTOFF_LEN} tokens, "
+                    f"{packing_efficiency(data, CUTOFF_LEN):.1%} filled"
+                )
+        else:
+            if packing == "group_by_length":
+                data = add_lengths(data)
+            data_collator = CountingCollator(self.tokenizer, mlm=False)
+
+        max_steps = train_args.get("max_steps") or -1
+        if streaming:
+            data = PrefetchingDataset(data, max_tokens=max_tokens)
+            # the trainer can't infer the length of a stream, so the budget
+            # sets the number of steps (assuming full blocks for max_tokens)
+            if max_steps < 0:
+                samples = max_samples or (
+                    max_tokens and math.ceil(max_tokens / CUTOFF_LEN)
+                )
+                if not samples:
+                    raise ValueError(
+                        "Streaming training needs max_steps, max_samples or max_tokens"
+                    )
+                max_steps = EPOCHS * math.ceil(
+                    samples / (MICRO_BATCH_SIZE * GRADIENT_ACCUMULATION_STEPS)
+                )
+
+        telemetry = LLMTrainerCallback(
+            on_log=on_log,
+            on_step=on_step,
+            on_metrics=on_metrics,
+            padding_stats=data_collator.stats,
+        )
+        callbacks = [telemetry]
         if train_args["report_to_wandb"]:
             callbacks.append(
                 CustomWandBCallback(
@@ -185,16 +468,229 @@ class LLM:
                 output_dir=output_dir,
                 save_total_limit=2,
                 run_name=f"{output_dir.split('/')[-1]}",
+                max_steps=max_steps,
+                group_by_length=packing == "group_by_length",
+                # packed blocks carry segment ids the model doesn't take directly
+                remove_unused_columns=packing != "pack",
             ),
             callbacks=callbacks,
-            data_collator=DataCollatorForLanguageModeling(self.tokenizer, mlm=False),
+            data_collator=data_collator,
         )
-        trainer.train()
+        result = trainer.train()
         model.save_pretrained(output_dir)
 
-    def generate_streaming(self, generation_args: GenerationArgs, prompt: str):
+        stats = data_collator.stats
+        on_log and on_log(
+            f"Padding efficiency {stats.efficiency:.1%} "
+            f"({stats.real_tokens} of {stats.padded_tokens} tokens)"
+        )
+
+        write_manifest(
+            output_dir,
+            {
+                "name": os.path.basename(output_dir.rstrip("/")),
+                "base_model": os.path.basename(self.model_path.rstrip("/")),
+                "dataset": dataset_path,
+                "rank": config.r,
+                "lora_alpha": config.lora_alpha,
+                "target_modules": list(config.target_modules),
+                "template_hash": template_hash(prompt_template),
+                "packing": packing,
+                "metrics": {
+                    "steps": result.global_step,
+                    **result.metrics,
+                    "padding_efficiency": stats.efficiency,
+                    "telemetry": telemetry.summary,
+                },
+                **(metadata or {}),
+            },
+        )
+        # only once the adapter is saved, the job's consumers go on to load it
+        on_step and on_step(TrainingJobStep.JOB_COMPLETED)
+
+    def generate_streaming(
+        self,
+        generation_args: GenerationArgs,
+        prompt: str,
+        lora_path: Optional[str] = None,
+        *,
+        echo_prompt: bool = True,
+        usage: Optional[dict] = None,
+        speculative: bool = False,
+    ):
+        """
+        Streams the prompt (unless `echo_prompt` is False) followed by the
+        generated text. If `usage` is given, it's filled with the prompt and
+        completion token counts and the timing of the request (see
+        `metrics.RequestTiming`) once the generation finishes.
+
+        With `speculative`, tokens are proposed by the draft model (see
+        `load_draft_model`) and verified by the model, and `usage` also gets the
+        share of proposed tokens which were accepted. The request then runs on
+        its own rather than in the shared batch, and requests with an adapter
+        always use the batch.
+        """
+        self.model.eval()
+
+        speculative = speculative and lora_path is None
+        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids
+        streamer, stop = self._submit(
+            generation_args, input_ids, lora_path, speculative
+        )
+        yield from self._stream(streamer, stop, echo_prompt, usage)
+
+        if usage is not None:
+            usage["caches"] = self.cache_stats()
+            if speculative:
+                request = streamer.request
+                usage["speculative"] = {
+                    "drafted_tokens": request.drafted,
+                    "accepted_tokens": request.accepted,
+                    "acceptance_rate": (
+                        request.accepted / request.drafted if request.drafted else None
+                    ),
+                }
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        generation_args: GenerationArgs,
+        lora_path: Optional[str] = None,
+        *,
+        max_batch_size: int = MAX_BATCH_ROWS,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
+        usage: Optional[List[dict]] = None,
+    ) -> List[str]:
+        """
+        Generates a completion for every prompt, returned in the order of
+        `prompts`, for offline work like evaluating a finetune.
+
+        Prompts go through the scheduler like streaming requests, so the model is
+        never held for longer than a decode step, and they're submitted longest
+        first so rows of similar lengths share the batch and pad each other's
+        cache little. Up to `max_batch_size` of them are in the batch at a time,
+        as long as their prompt and completion tokens stay within
+        `max_batch_tokens`, and the rest wait for earlier ones to finish. Each
+        completion is cut at its first stop sequence.
+
+        If `usage` is given, it's filled with the prompt and completion token
+        counts and the timing of every prompt.
+        """
         self.model.eval()
 
+        generation_config, _ = self._generation_config(generation_args)
+        encoded = [
+            self.tokenizer(prompt, return_tensors="pt").input_ids for prompt in prompts
+        ]
+        sizes = [
+            input_ids.shape[1]
+            + (
+                generation_config.max_new_tokens
+                or max(generation_config.max_length - input_ids.shape[1], 0)
+            )
+            for input_ids in encoded
+        ]
+        # a batch which doesn't fit in memory fails right away
+        order = sorted(range(len(prompts)), key=lambda i: sizes[i], reverse=True)
+
+        counts = [{} for _ in prompts]
+        completions: List[Optional[str]] = [None] * len(prompts)
+        in_flight: Deque[Tuple[int, SchedulerStreamer, Iterator[str]]] = deque()
+
+        def finish_oldest():
+            i, _, stream = in_flight.popleft()
+            completions[i] = "".join(stream)
+
+        try:
+            for i in order:
+                while in_flight and (
+                    len(in_flight) >= max_batch_size
+                    or sum(sizes[j] for j, _, _ in in_flight) + sizes[i]
+                    > max_batch_tokens
+                ):
+                    finish_oldest()
+                streamer, stop = self._submit(
+                    generation_args,
+                    encoded[i],
+                    lora_path,
+                    max_batch_size=max_batch_size,
+                )
+                in_flight.append(
+                    (i, streamer, self._stream(streamer, stop, False, counts[i]))
+                )
+            while in_flight:
+                finish_oldest()
+        finally:
+            # after an error, the prompts still queued aren't generated for nothing
+            for _, streamer, _ in in_flight:
+                streamer.cancel()
+
+        if usage is not None:
+            usage.extend(counts)
+        return completions
+
+    def _submit(
+        self,
+        generation_args: GenerationArgs,
+        input_ids: torch.Tensor,
+        lora_path: Optional[str] = None,
+        speculative: bool = False,
+        max_batch_size: Optional[int] = None,
+    ) -> Tuple[SchedulerStreamer, utils.Stop]:
+        generation_config, stop = self._generation_config(generation_args)
+
+        if speculative:
+            if self.speculative is None:
+                raise Exception("Draft model not loaded")
+            streamer = self.speculative.submit(input_ids, generation_config, stop)
+        else:
+            streamer = self.scheduler.submit(
+                input_ids,
+                generation_config,
+                stop,
+                adapter=lora_path,
+                max_batch_size=max_batch_size,
+            )
+        return streamer, stop
+
+    def _stream(
+        self,
+        streamer: SchedulerStreamer,
+        stop: utils.Stop,
+        echo_prompt: bool,
+        usage: Optional[dict],
+    ) -> Iterator[str]:
+        # the streamer echoes the prompt, which must not be checked for stops
+        input_ids = streamer.request.input_ids
+        prompt_text = self.tokenizer.decode(input_ids[0], skip_special_tokens=True)
+        skip = 0 if echo_prompt else len(prompt_text)
+        try:
+            for new_text in utils.trim_stop_sequences(
+                streamer, stop.stops, skip=len(prompt_text)
+            ):
+                if skip:
+                    skipped, new_text = new_text[:skip], new_text[skip:]
+                    skip -= len(skipped)
+                if new_text:
+                    yield new_text
+        finally:
+            streamer.cancel()
+
+        if usage is not None:
+            usage["prompt_tokens"] = input_ids.shape[1]
+            usage["completion_tokens"] = streamer.request.generated
+            usage["timing"] = streamer.request.timing.to_dict()
+
+    def _generation_config(
+        self, generation_args: GenerationArgs
+    ) -> Tuple[GenerationConfig, utils.Stop]:
+        generation_args = {**generation_args}
+        stop = utils.Stop(
+            self.tokenizer,
+            generation_args.pop("stopping_sequence", None),
+            generation_args.pop("stop_token_ids", None),
+        )
+
         generation_config = GenerationConfig(
             **{
                 "temperature": 0.7,
@@ -205,30 +701,4 @@ class LLM:
                 **generation_args,
             }
         )
-
-        tokenized = self.tokenizer(prompt, return_tensors="pt")
-        input_ids = tokenized.input_ids
-        input_ids = input_ids.to(self.model.device)
-
-        streamer = TextIteratorStreamer(self.tokenizer, skip_special_tokens=True)
-        generate_kwargs = dict(
-            input_ids=input_ids,
-            generation_config=generation_config,
-            return_dict_in_generate=True,
-            eos_token_id=self.tokenizer.eos_token_id,
-            pad_token_id=self.tokenizer.eos_token_id,
-            bos_token_id=self.tokenizer.bos_token_id,
-            attention_mask=tokenized.attention_mask,
-            output_scores=True,
-            streamer=streamer,
-            stopping_criteria=[
-                utils.Stop(self.tokenizer, generation_args["stopping_sequence"])
-            ],
-        )
-
-        thread = Thread(target=self.model.generate, kwargs=generate_kwargs)
-        thread.start()
-        for new_text in streamer:
-            yield new_text
-
-        thread.join()
+        return generation_config, stop
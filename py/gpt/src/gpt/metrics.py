@@ -0,0 +1,327 @@
+"""
+Latency and throughput metrics of generations, in the Prometheus text format.
+
+The decode loop records a handful of timestamps per request and counts the gaps
+between tokens into a small fixed-bucket histogram, so the cost per token is a
+clock read and a bisect. The summary travels back with the usage of the request
+and is merged into histograms labelled by repo id and adapter wherever the
+metrics are served. The usage also carries the counters of the model's caches,
+which are exported as they were last reported.
+"""
+
+import math
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2, 0.5, 1)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+RATE_BUCKETS = (1, 2.5, 5, 10, 15, 20, 30, 50, 100, 200)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, plus their total count and sum.
+    Not thread safe on its own, `MetricsRegistry` locks around it.
+    """
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        # the last slot counts observations above every bound (+Inf)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, summary: dict):
+        if tuple(summary["buckets"]) != self.buckets:
+            raise ValueError("Can't merge histograms with different buckets")
+        for i, count in enumerate(summary["counts"]):
+            self.counts[i] += count
+        self.count += summary["count"]
+        self.sum += summary["sum"]
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+
+class RequestTiming:
+    """
+    Timestamps of a single generation, filled in by the decode loop.
+    """
+
+    def __init__(self):
+        self.submitted_at = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.adapter_load: Optional[float] = None
+        self.inter_token = Histogram(INTER_TOKEN_BUCKETS)
+
+    def token(self):
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        else:
+            self.inter_token.observe(now - self.last_token_at)
+        self.last_token_at = now
+
+    def to_dict(self) -> dict:
+        def since(start, end):
+            return end - start if start is not None and end is not None else None
+
+        return {
+            "queue": since(self.submitted_at, self.admitted_at),
+            "adapter_load": self.adapter_load,
+            "time_to_first_token": since(self.submitted_at, self.first_token_at),
+            "generation": since(self.first_token_at, self.last_token_at),
+            "inter_token": self.inter_token.to_dict(),
+        }
+
+
+# name: (type, help, buckets)
+METRICS = {
+    "gpt_requests_total": ("counter", "Generation requests", None),
+    "gpt_request_errors_total": ("counter", "Generation requests which failed", None),
+    "gpt_queue_seconds": (
+        "histogram",
+        "Time from submission until the request joins the batch",
+        LATENCY_BUCKETS,
+    ),
+    "gpt_adapter_load_seconds": (
+        "histogram",
+        "Time spent making the adapter of the request resident",
+        LATENCY_BUCKETS,
+    ),
+    "gpt_time_to_first_token_seconds": (
+        "histogram",
+        "Time from submission until the first generated token",
+        LATENCY_BUCKETS,
+    ),
+    "gpt_inter_token_seconds": (
+        "histogram",
+        "Time between consecutive generated tokens",
+        INTER_TOKEN_BUCKETS,
+    ),
+    "gpt_generation_seconds": (
+        "histogram",
+        "Time from the first to the last generated token",
+        LATENCY_BUCKETS,
+    ),
+    "gpt_decode_tokens_per_second": (
+        "histogram",
+        "Generated tokens per second after the first token",
+        RATE_BUCKETS,
+    ),
+    "gpt_speculative_acceptance_rate": (
+        "histogram",
+        "Share of the draft model's tokens kept, with speculative decoding",
+        RATIO_BUCKETS,
+    ),
+    "gpt_prompt_tokens": ("histogram", "Prompt tokens per request", TOKEN_BUCKETS),
+    "gpt_completion_tokens": (
+        "histogram",
+        "Generated tokens per request",
+        TOKEN_BUCKETS,
+    ),
+    "gpt_adapter_cache_hits_total": (
+        "counter",
+        "Requests whose adapter was already resident",
+        None,
+    ),
+    "gpt_adapter_cache_misses_total": (
+        "counter",
+        "Requests whose adapter had to be loaded",
+        None,
+    ),
+    "gpt_adapter_cache_evictions_total": (
+        "counter",
+        "Adapters unloaded to stay within budget",
+        None,
+    ),
+    "gpt_adapter_cache_adapters": ("gauge", "Resident adapters", None),
+    "gpt_adapter_cache_bytes": ("gauge", "Size of the resident adapters", None),
+    "gpt_prefix_cache_lookups_total": (
+        "counter",
+        "Prompts looked up in the prefix cache",
+        None,
+    ),
+    "gpt_prefix_cache_hits_total": (
+        "counter",
+        "Prompts which reused a cached prefix",
+        None,
+    ),
+    "gpt_prefix_cache_prefill_tokens_total": (
+        "counter",
+        "Prompt tokens looked up in the prefix cache",
+        None,
+    ),
+    "gpt_prefix_cache_saved_tokens_total": (
+        "counter",
+        "Prompt tokens which weren't prefilled thanks to the prefix cache",
+        None,
+    ),
+    "gpt_prefix_cache_hit_rate": (
+        "gauge",
+        "Share of prompts which reused a cached prefix",
+        None,
+    ),
+    "gpt_prefix_cache_bytes": ("gauge", "Size of the cached past key values", None),
+}
+
+# usage["caches"] key: {stat: metric name}
+CACHE_METRICS = {
+    "adapters": {
+        "hits": "gpt_adapter_cache_hits_total",
+        "misses": "gpt_adapter_cache_misses_total",
+        "evictions": "gpt_adapter_cache_evictions_total",
+        "adapters": "gpt_adapter_cache_adapters",
+        "bytes": "gpt_adapter_cache_bytes",
+    },
+    "prefix_cache": {
+        "lookups": "gpt_prefix_cache_lookups_total",
+        "hits": "gpt_prefix_cache_hits_total",
+        "prefill_tokens": "gpt_prefix_cache_prefill_tokens_total",
+        "prefill_tokens_saved": "gpt_prefix_cache_saved_tokens_total",
+        "hit_rate": "gpt_prefix_cache_hit_rate",
+        "bytes": "gpt_prefix_cache_bytes",
+    },
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # counters and gauges
+        self._values: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = _labels(labels)
+        with self._lock:
+            counters = self._values.setdefault(name, {})
+            counters[key] = counters.get(key, 0) + value
+
+    def set(self, name: str, value: Optional[float], **labels: str):
+        if value is None:
+            return
+        with self._lock:
+            self._values.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: Optional[float], **labels: str):
+        if value is None:
+            return
+        with self._lock:
+            self._histogram(name, labels).observe(value)
+
+    def merge(self, name: str, summary: dict, **labels: str):
+        with self._lock:
+            self._histogram(name, labels).merge(summary)
+
+    def record_generation(self, usage: dict, **labels: str):
+        """
+        Records a finished generation from the usage returned by
+        `LLM.generate_streaming`.
+        """
+        self.inc("gpt_requests_total", **labels)
+        self.observe("gpt_prompt_tokens", usage.get("prompt_tokens"), **labels)
+        self.observe("gpt_completion_tokens", usage.get("completion_tokens"), **labels)
+        if usage.get("speculative"):
+            self.observe(
+                "gpt_speculative_acceptance_rate",
+                usage["speculative"]["acceptance_rate"],
+                **labels,
+            )
+
+        timing = usage.get("timing")
+        if not timing:
+            return
+        self.observe("gpt_queue_seconds", timing["queue"], **labels)
+        self.observe("gpt_adapter_load_seconds", timing["adapter_load"], **labels)
+        self.observe(
+            "gpt_time_to_first_token_seconds", timing["time_to_first_token"], **labels
+        )
+        self.observe("gpt_generation_seconds", timing["generation"], **labels)
+        self.merge("gpt_inter_token_seconds", timing["inter_token"], **labels)
+        if timing["generation"]:
+            self.observe(
+                "gpt_decode_tokens_per_second",
+                timing["inter_token"]["count"] / timing["generation"],
+                **labels,
+            )
+
+    def record_caches(self, caches: dict, **labels: str):
+        """
+        Records the cache stats of a model, `usage["caches"]` from
+        `LLM.generate_streaming`. They are totals since the container started, so
+        they replace the last values rather than adding up, and Prometheus sees a
+        counter reset when the container is replaced.
+        """
+        for cache, names in CACHE_METRICS.items():
+            stats = caches.get(cache) or {}
+            for stat, name in names.items():
+                self.set(name, stats.get(stat), **labels)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        with self._lock:
+            for name, (kind, help, _) in METRICS.items():
+                series = (
+                    self._histograms if kind == "histogram" else self._values
+                ).get(name)
+                if not series:
+                    continue
+
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    if kind != "histogram":
+                        lines.append(f"{name}{_format_labels(key)} {value}")
+                        continue
+
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + (math.inf,), value.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else repr(float(bound))
+                        lines.append(
+                            f"{name}_bucket{_format_labels(key, le=le)} {cumulative}"
+                        )
+                    lines.append(f"{name}_sum{_format_labels(key)} {value.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def _histogram(self, name: str, labels: dict) -> Histogram:
+        series = self._histograms.setdefault(name, {})
+        key = _labels(labels)
+        if key not in series:
+            series[key] = Histogram(METRICS[name][2])
+        return series[key]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: Labels, **extra: str) -> str:
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,229 @@
+"""
+Keeps the models and datasets on a volume within a byte budget.
+
+An index file at the root of the volume records the size and last access time
+of every model and dataset directory, so looking one up is a single small read
+rather than a walk of the volume. Once the total goes over the budget the least
+recently used entries are deleted, except those which are leased: a process
+using a model holds a lease on it, refreshed in the background, which expires
+if the process dies without releasing it.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+MODELS_DIR = "/models"
+# the budget can be set per deployment, e.g. MODELS_MAX_BYTES=200000000000
+MODEL_STORE_BYTES = int(os.environ.get("MODELS_MAX_BYTES", 400 * 1024**3))
+LEASE_TTL = 10 * 60
+
+INDEX_NAME = ".index.json"
+LEASES_DIR = ".leases"
+
+
+class ModelStore:
+    def __init__(
+        self,
+        root: str = MODELS_DIR,
+        max_bytes: int = MODEL_STORE_BYTES,
+        lease_ttl: float = LEASE_TTL,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lease_ttl = lease_ttl
+
+        self._owner = f"{socket.gethostname()}-{os.getpid()}"
+        self._leases: Dict[str, str] = {}
+        self._heartbeat: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def key(self, repo_id: str, repo_type: Optional[str] = None) -> str:
+        name = repo_id.replace("/", "--")
+        return f"datasets/{name}" if repo_type == "dataset" else name
+
+    def path(self, repo_id: str, repo_type: Optional[str] = None) -> str:
+        return os.path.join(self.root, self.key(repo_id, repo_type))
+
+    def lookup(self, repo_id: str, repo_type: Optional[str] = None) -> Optional[str]:
+        """
+        Returns the path of a downloaded model or dataset from the index, or None
+        if it isn't on the volume, and marks it as used.
+        """
+        key = self.key(repo_id, repo_type)
+        with self._index() as index:
+            entry = index.get(key)
+            if entry is None:
+                # directories from before the index are picked up on first use
+                if not os.path.isdir(self.path(repo_id, repo_type)):
+                    return None
+                entry = index[key] = {"size": self._size(key)}
+            entry["last_access"] = time.time()
+        return self.path(repo_id, repo_type)
+
+    def ensure(
+        self,
+        repo_id: str,
+        download: Callable[[str], None],
+        repo_type: Optional[str] = None,
+    ) -> str:
+        """
+        Returns the path of a model or dataset, calling `download` with the path
+        to fetch it if it isn't on the volume, then evicts other entries to stay
+        within the budget. The entry is leased until `release` is called.
+        """
+        self.acquire(repo_id, repo_type)
+        path = self.lookup(repo_id, repo_type)
+        if path is None:
+            path = self.path(repo_id, repo_type)
+            download(path)
+            self.add(repo_id, repo_type)
+        self.evict()
+        return path
+
+    def add(self, repo_id: str, repo_type: Optional[str] = None):
+        """
+        (Re)computes the size of an entry, e.g. after it's downloaded or a
+        snapshot is written into it.
+        """
+        key = self.key(repo_id, repo_type)
+        size = self._size(key)
+        with self._index() as index:
+            index[key] = {"size": size, "last_access": time.time()}
+
+    def remove(self, repo_id: str, repo_type: Optional[str] = None):
+        key = self.key(repo_id, repo_type)
+        with self._index() as index:
+            index.pop(key, None)
+        shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+    def usage(self) -> dict:
+        with self._index(write=False) as index:
+            return {
+                "bytes": sum(entry["size"] for entry in index.values()),
+                "max_bytes": self.max_bytes,
+                "entries": dict(index),
+            }
+
+    def evict(self) -> List[str]:
+        """
+        Deletes the least recently used entries which aren't leased until the
+        store is within its budget, and returns their keys.
+        """
+        evicted = []
+        with self._index() as index:
+            total = sum(entry["size"] for entry in index.values())
+            leased = self._leased()
+            for key in sorted(index, key=lambda key: index[key]["last_access"]):
+                if total <= self.max_bytes:
+                    break
+                if key in leased:
+                    continue
+
+                print(f"Evicting {key} ({index[key]['size'] / 1024**3:.1f}GB)")
+                shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+                total -= index.pop(key)["size"]
+                evicted.append(key)
+        return evicted
+
+    #### Leases
+
+    def acquire(self, repo_id: str, repo_type: Optional[str] = None):
+        key = self.key(repo_id, repo_type)
+        lease_path = os.path.join(
+            self.root, LEASES_DIR, f"{key.replace('/', '--')}@{self._owner}"
+        )
+        os.makedirs(os.path.dirname(lease_path), exist_ok=True)
+        with open(lease_path, "w") as f:
+            f.write(key)
+        self._leases[key] = lease_path
+
+        if self._heartbeat is None:
+            self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+            self._heartbeat.start()
+
+    def release(self, repo_id: str, repo_type: Optional[str] = None):
+        lease_path = self._leases.pop(self.key(repo_id, repo_type), None)
+        if lease_path and os.path.exists(lease_path):
+            os.remove(lease_path)
+
+    def close(self):
+        for key in list(self._leases):
+            lease_path = self._leases.pop(key)
+            if os.path.exists(lease_path):
+                os.remove(lease_path)
+        self._stopped.set()
+
+    def _renew(self):
+        while not self._stopped.wait(self.lease_ttl / 3):
+            for lease_path in list(self._leases.values()):
+                try:
+                    os.utime(lease_path)
+                except OSError:
+                    pass
+
+    def _leased(self) -> set:
+        leases_dir = os.path.join(self.root, LEASES_DIR)
+        if not os.path.isdir(leases_dir):
+            return set()
+
+        leased = set()
+        now = time.time()
+        for name in os.listdir(leases_dir):
+            lease_path = os.path.join(leases_dir, name)
+            try:
+                if now - os.path.getmtime(lease_path) > self.lease_ttl:
+                    # the process holding it is gone
+                    os.remove(lease_path)
+                    continue
+                with open(lease_path) as f:
+                    leased.add(f.read())
+            except OSError:
+                continue
+        return leased
+
+    #### Index
+
+    @contextmanager
+    def _index(self, write: bool = True):
+        # the volume is shared between containers, so updates are serialized with
+        # a lock file and the index is replaced atomically
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, f"{INDEX_NAME}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            try:
+                index = self._read_index()
+                yield index
+                if write:
+                    self._write_index(index)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self) -> Dict[str, dict]:
+        try:
+            with open(os.path.join(self.root, INDEX_NAME)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index: Dict[str, dict]):
+        path = os.path.join(self.root, INDEX_NAME)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _size(self, key: str) -> int:
+        size = 0
+        for root, _, files in os.walk(os.path.join(self.root, key)):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return size
@@ -0,0 +1,251 @@
+import inspect
+import time
+from typing import List, Literal, Optional, Union
+
+import torch
+from datasets import Dataset, IterableDataset
+from transformers import DataCollatorForLanguageModeling, PreTrainedModel
+
+from .preprocessing import PREPROCESSING_BATCH_SIZE, column_names
+
+PackingMode = Union[Literal["pack"], Literal["group_by_length"], None]
+
+
+class PaddingStats:
+    def __init__(self):
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        # when the last batch was collated, to tell data loading from compute
+        self.updated_at: Optional[float] = None
+
+    def update(self, real_tokens: int, padded_tokens: int):
+        self.real_tokens += real_tokens
+        self.padded_tokens += padded_tokens
+        self.updated_at = time.perf_counter()
+
+    @property
+    def efficiency(self) -> float:
+        return self.real_tokens / self.padded_tokens if self.padded_tokens else 1.0
+
+    def to_dict(self) -> dict:
+        return {
+            "real_tokens": self.real_tokens,
+            "padded_tokens": self.padded_tokens,
+            "padding_efficiency": self.efficiency,
+        }
+
+
+#### Length grouped batching
+
+
+def add_lengths(data: Dataset) -> Dataset:
+    """
+    Adds the `length` column used by `TrainingArguments(group_by_length=True)` so
+    the sampler doesn't have to measure every example itself.
+    """
+    return data.map(
+        lambda batch: {"length": [len(ids) for ids in batch["input_ids"]]},
+        batched=True,
+        batch_size=PREPROCESSING_BATCH_SIZE,
+    )
+
+
+class CountingCollator(DataCollatorForLanguageModeling):
+    """
+    `DataCollatorForLanguageModeling` which keeps track of how many of the
+    tokens in its batches are padding.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PaddingStats()
+
+    def torch_call(self, examples):
+        examples = [
+            {k: v for k, v in example.items() if k != "length"} for example in examples
+        ]
+        batch = super().torch_call(examples)
+        self.stats.update(
+            int(batch["attention_mask"].sum()), batch["attention_mask"].numel()
+        )
+        return batch
+
+
+#### Packing
+
+
+def pack_dataset(
+    data: Union[Dataset, IterableDataset], block_size: int
+) -> Union[Dataset, IterableDataset]:
+    """
+    Packs tokenized examples into blocks of at most `block_size` tokens. Examples
+    are never split, each one is placed into the first block of its map batch
+    with room for it (first fit decreasing), and is tagged with its own segment
+    id so attention and positions can be reset at its boundaries.
+    """
+
+    def pack(batch):
+        examples = sorted(
+            (ids[:block_size] for ids in batch["input_ids"]), key=len, reverse=True
+        )
+        blocks: List[List[List[int]]] = []
+        sizes: List[int] = []
+        for ids in examples:
+            for i, size in enumerate(sizes):
+                if size + len(ids) <= block_size:
+                    blocks[i].append(ids)
+                    sizes[i] += len(ids)
+                    break
+            else:
+                blocks.append([ids])
+                sizes.append(len(ids))
+
+        packed = {"input_ids": [], "segment_ids": [], "position_ids": []}
+        for block in blocks:
+            packed["input_ids"].append([t for ids in block for t in ids])
+            packed["segment_ids"].append(
+                [i + 1 for i, ids in enumerate(block) for _ in ids]
+            )
+            packed["position_ids"].append([p for ids in block for p in range(len(ids))])
+        return packed
+
+    return data.map(
+        pack,
+        batched=True,
+        batch_size=PREPROCESSING_BATCH_SIZE,
+        remove_columns=column_names(data),
+    )
+
+
+def packing_efficiency(data: Dataset, block_size: int) -> float:
+    tokens = sum(len(ids) for ids in data["input_ids"])
+    return tokens / (len(data) * block_size) if len(data) else 1.0
+
+
+class PackedCollator:
+    """
+    Pads packed blocks and builds labels which never ask the model to predict
+    the first token of an example from the end of the previous one.
+
+    When `segment_attention` is set, the attention mask carries the segment id
+    of every token (0 for padding) and must be read by a model patched with
+    `enable_segment_attention`. Position ids are only passed to models which
+    accept them.
+    """
+
+    def __init__(
+        self,
+        pad_token_id: int,
+        segment_attention: bool = True,
+        position_ids: bool = True,
+    ):
+        self.pad_token_id = pad_token_id
+        self.segment_attention = segment_attention
+        self.position_ids = position_ids
+        self.stats = PaddingStats()
+
+    def __call__(self, features: List[dict]) -> dict:
+        length = max(len(f["input_ids"]) for f in features)
+
+        def padded(key, value):
+            return [f[key] + [value] * (length - len(f[key])) for f in features]
+
+        input_ids = torch.tensor(padded("input_ids", self.pad_token_id))
+        segment_ids = torch.tensor(padded("segment_ids", 0))
+
+        labels = input_ids.clone()
+        labels[segment_ids == 0] = -100
+        # labels are shifted inside the model, so the first token of every
+        # segment would otherwise be predicted from the previous segment
+        boundaries = torch.zeros_like(segment_ids, dtype=torch.bool)
+        boundaries[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+        labels[boundaries] = -100
+
+        self.stats.update(int((segment_ids != 0).sum()), segment_ids.numel())
+
+        batch = {
+            "input_ids": input_ids,
+            "attention_mask": (
+                segment_ids if self.segment_attention else (segment_ids != 0).long()
+            ),
+            "labels": labels,
+        }
+        if self.position_ids:
+            batch["position_ids"] = torch.tensor(padded("position_ids", 0))
+        return batch
+
+
+def accepts_position_ids(model: PreTrainedModel) -> bool:
+    base_model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    return "position_ids" in inspect.signature(base_model.forward).parameters
+
+
+def enable_segment_attention(model: PreTrainedModel) -> bool:
+    """
+    Patches the attention mask preparation of the model so that a mask of segment
+    ids produces a block diagonal causal mask, i.e. packed examples can't attend
+    to each other. Regular 0/1 masks behave as before.
+
+    Returns False if the architecture isn't supported, in which case packed
+    examples attend across boundaries within a block.
+    """
+    patched = False
+    for module in model.modules():
+        # llama style models return an additive float mask
+        if hasattr(module, "_prepare_decoder_attention_mask"):
+            original = module._prepare_decoder_attention_mask
+
+            def prepare_decoder_attention_mask(
+                attention_mask,
+                input_shape,
+                inputs_embeds,
+                past_key_values_length,
+                original=original,
+            ):
+                if past_key_values_length or attention_mask.max() <= 1:
+                    return original(
+                        attention_mask,
+                        input_shape,
+                        inputs_embeds,
+                        past_key_values_length,
+                    )
+                allowed = _segment_mask(attention_mask)
+                mask = torch.zeros(
+                    allowed.shape, dtype=inputs_embeds.dtype, device=allowed.device
+                )
+                return mask.masked_fill(~allowed, torch.finfo(inputs_embeds.dtype).min)
+
+            module._prepare_decoder_attention_mask = prepare_decoder_attention_mask
+            patched = True
+
+        # falcon style models return a boolean mask of the positions to ignore
+        elif hasattr(module, "_prepare_attn_mask"):
+            original = module._prepare_attn_mask
+
+            def prepare_attn_mask(
+                attention_mask,
+                input_shape,
+                past_key_values_length,
+                original=original,
+            ):
+                if past_key_values_length or attention_mask.max() <= 1:
+                    return original(attention_mask, input_shape, past_key_values_length)
+                return ~_segment_mask(attention_mask)
+
+            module._prepare_attn_mask = prepare_attn_mask
+            patched = True
+
+    return patched
+
+
+def _segment_mask(segment_ids: torch.Tensor) -> torch.Tensor:
+    # (batch, 1, seq, seq) mask of the keys each query may attend to
+    length = segment_ids.shape[1]
+    causal = torch.ones(
+        (length, length), dtype=torch.bool, device=segment_ids.device
+    ).tril()
+    same = segment_ids[:, :, None] == segment_ids[:, None, :]
+    allowed = same & causal & (segment_ids[:, None, :] != 0)
+    # padding attends to itself only, so no row is fully masked
+    allowed |= torch.eye(length, dtype=torch.bool, device=segment_ids.device)
+    return allowed.unsqueeze(1)
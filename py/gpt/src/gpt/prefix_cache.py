@@ -0,0 +1,223 @@
+import time
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+import torch
+
+PREFIX_CACHE_BYTES = 4 * 1024**3
+
+
+class _Node:
+    def __init__(self, tokens: Tuple[int, ...], kv, parent: Optional["_Node"]):
+        # kv holds the cache for this node's own tokens only, the full prefix is
+        # rebuilt by concatenating the nodes on the path from the root
+        self.tokens = tokens
+        self.kv = kv
+        self.parent = parent
+        self.children: Dict[int, "_Node"] = {}
+        self.last_access = time.monotonic()
+        self.bytes = _kv_bytes(kv) if kv is not None else 0
+
+
+class PrefixCache:
+    """
+    Radix tree of past key values keyed by prompt token ids.
+
+    Prompts which share a preamble (a chat template, a finetune's prompt
+    template) reuse the cache for the longest prefix seen before, and only the
+    remaining tokens need to be prefilled. There is a separate tree per adapter,
+    since LoRA changes the keys and values. Leaves are evicted in least recently
+    used order once the cached tensors go over `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+        self._roots: Dict[Hashable, _Node] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.prefill_tokens = 0
+        self.prefill_tokens_saved = 0
+
+    def match(
+        self, key: Hashable, token_ids: Sequence[int]
+    ) -> Tuple[int, Optional[tuple]]:
+        """
+        Returns the length of the longest cached prefix of `token_ids` and its
+        past key values. At least one token is always left to be prefilled, so
+        that there are logits to sample from.
+        """
+        token_ids = tuple(token_ids)
+        self.lookups += 1
+        self.prefill_tokens += len(token_ids)
+
+        segments = []
+        length = 0
+        node = self._roots.get(key)
+        while node is not None and length < len(token_ids) - 1:
+            child = node.children.get(token_ids[length])
+            if child is None:
+                break
+
+            common = _common_length(child.tokens, token_ids[length:-1])
+            child.last_access = time.monotonic()
+            if common < len(child.tokens):
+                segments.append(_slice_kv(child.kv, 0, common))
+                length += common
+                break
+
+            segments.append(child.kv)
+            length += common
+            node = child
+
+        if not length:
+            return 0, None
+
+        self.hits += 1
+        self.prefill_tokens_saved += length
+        return length, _concat_kv(segments)
+
+    def insert(self, key: Hashable, token_ids: Sequence[int], past: tuple):
+        """
+        Stores the past key values for `token_ids`, keeping only the parts which
+        aren't already cached.
+        """
+        token_ids = tuple(token_ids)
+        node = self._roots.setdefault(key, _Node((), None, None))
+
+        length = 0
+        while length < len(token_ids):
+            child = node.children.get(token_ids[length])
+            if child is None:
+                leaf = _Node(
+                    token_ids[length:],
+                    _slice_kv(past, length, len(token_ids) - length, copy=True),
+                    node,
+                )
+                node.children[token_ids[length]] = leaf
+                self.bytes += leaf.bytes
+                break
+
+            common = _common_length(child.tokens, token_ids[length:])
+            child.last_access = time.monotonic()
+            if common < len(child.tokens):
+                child = self._split(child, common)
+
+            length += common
+            node = child
+
+        self._evict()
+
+    def _split(self, node: _Node, length: int) -> _Node:
+        # keep the first `length` tokens in a new parent, the rest in `node`
+        parent = _Node(
+            node.tokens[:length],
+            _slice_kv(node.kv, 0, length, copy=True),
+            node.parent,
+        )
+        parent.last_access = node.last_access
+        node.parent.children[node.tokens[0]] = parent
+
+        remaining = len(node.tokens) - length
+        node.kv = _slice_kv(node.kv, length, remaining, copy=True)
+        node.tokens = node.tokens[length:]
+        node.parent = parent
+        parent.children[node.tokens[0]] = node
+
+        self.bytes -= node.bytes
+        node.bytes = _kv_bytes(node.kv)
+        self.bytes += node.bytes + parent.bytes
+        return parent
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            leaves = [
+                node
+                for root in self._roots.values()
+                for node in _descendants(root)
+                if not node.children
+            ]
+            if not leaves:
+                break
+
+            leaf = min(leaves, key=lambda node: node.last_access)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.bytes -= leaf.bytes
+
+    def clear(self):
+        self._roots = {}
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "bytes": self.bytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "prefill_tokens": self.prefill_tokens,
+            "prefill_tokens_saved": self.prefill_tokens_saved,
+        }
+
+
+def _descendants(node: _Node) -> List[_Node]:
+    nodes = []
+    stack = list(node.children.values())
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children.values())
+    return nodes
+
+
+def _common_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+# Like the scheduler, caches are the legacy tuple-of-tuples format with the
+# sequence in the second to last dimension, or the last one for models which
+# store keys transposed. Values are never transposed, so they give the length.
+
+
+def _kv_length(kv) -> int:
+    return kv[0][1].shape[-2]
+
+
+def _seq_dim(t: torch.Tensor, length: int) -> int:
+    return -2 if t.shape[-2] == length else -1
+
+
+def _slice_kv(kv, start: int, length: int, copy: bool = False):
+    # copies drop the reference to the rest of the original tensor's storage
+    total = _kv_length(kv)
+    return tuple(
+        tuple(
+            t.narrow(_seq_dim(t, total), start, length).clone()
+            if copy
+            else t.narrow(_seq_dim(t, total), start, length)
+            for t in layer
+        )
+        for layer in kv
+    )
+
+
+def _concat_kv(segments: List[tuple]):
+    if len(segments) == 1:
+        return segments[0]
+
+    length = _kv_length(segments[0])
+    return tuple(
+        tuple(
+            torch.cat(tensors, dim=_seq_dim(tensors[0], length))
+            for tensors in zip(*layers)
+        )
+        for layers in zip(*segments)
+    )
+
+
+def _kv_bytes(kv) -> int:
+    return sum(t.numel() * t.element_size() for layer in kv for t in layer)
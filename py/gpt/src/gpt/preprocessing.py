@@ -0,0 +1,266 @@
+import hashlib
+import os
+import shutil
+from queue import Full, Queue
+from threading import Event, Thread
+from typing import List, Optional, Union
+
+import chevron
+import torch
+from chevron.tokenizer import tokenize
+from datasets import Dataset, IterableDataset, load_dataset, load_from_disk
+from datasets.distributed import split_dataset_by_node
+from transformers import PreTrainedTokenizer
+
+PREPROCESSING_BATCH_SIZE = 1000
+SHUFFLE_BUFFER_SIZE = 10_000
+PREFETCH_BUFFER_SIZE = 256
+
+
+class PromptRenderer:
+    """
+    Renders a Mustache prompt template over batches of dataset rows. The template
+    is parsed once up front rather than by every `chevron.render` call.
+    """
+
+    def __init__(
+        self,
+        prompt_template: str,
+        tokenizer: PreTrainedTokenizer,
+        max_length: Optional[int] = None,
+    ):
+        self.tokens = list(tokenize(prompt_template))
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+
+    def render(self, row: dict) -> str:
+        return chevron.render(self.tokens, row)
+
+    def render_batch(self, batch: dict) -> List[str]:
+        columns = list(batch.keys())
+        size = len(batch[columns[0]]) if columns else 0
+        return [
+            self.render({column: batch[column][i] for column in columns})
+            for i in range(size)
+        ]
+
+    def __call__(self, batch: dict) -> dict:
+        return self.tokenizer(
+            self.render_batch(batch),
+            truncation=self.max_length is not None,
+            max_length=self.max_length,
+        )
+
+
+def preprocessing_cache_key(
+    dataset_path: str,
+    prompt_template: str,
+    tokenizer: PreTrainedTokenizer,
+    max_samples: Optional[int] = None,
+    max_length: Optional[int] = None,
+) -> str:
+    key = hashlib.sha256()
+    for part in [
+        _dataset_revision(dataset_path),
+        prompt_template,
+        tokenizer.__class__.__name__,
+        tokenizer.name_or_path,
+        str(len(tokenizer)),
+        str(max_samples),
+        str(max_length),
+    ]:
+        key.update(part.encode())
+        key.update(b"\0")
+    return key.hexdigest()[:32]
+
+
+def tokenize_dataset(
+    dataset_path: str,
+    prompt_template: str,
+    tokenizer: PreTrainedTokenizer,
+    *,
+    cache_dir: Optional[str] = None,
+    num_proc: Optional[int] = None,
+    max_samples: Optional[int] = None,
+    max_length: Optional[int] = None,
+) -> Dataset:
+    """
+    Renders and tokenizes the train split of a dataset in batches.
+
+    With a `cache_dir`, the result is saved under a key made of the dataset
+    revision, the template and the tokenizer, and later calls with the same
+    inputs load it from disk without touching the raw dataset.
+    """
+    cache_path = None
+    if cache_dir:
+        key = preprocessing_cache_key(
+            dataset_path, prompt_template, tokenizer, max_samples, max_length
+        )
+        cache_path = os.path.join(cache_dir, key)
+        if os.path.exists(cache_path):
+            print(f"Loading preprocessed dataset from {cache_path}")
+            return load_from_disk(cache_path)
+
+    data = load_dataset(dataset_path)["train"]
+    if max_samples is not None:
+        data = data.select(range(min(max_samples, len(data))))
+
+    data = data.map(
+        PromptRenderer(prompt_template, tokenizer, max_length),
+        batched=True,
+        batch_size=PREPROCESSING_BATCH_SIZE,
+        num_proc=num_proc,
+        remove_columns=column_names(data),
+    )
+
+    if cache_path:
+        # write to a temporary directory first so a crash never leaves a
+        # partially written cache entry behind
+        tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+        data.save_to_disk(tmp_path)
+        if os.path.exists(cache_path):
+            shutil.rmtree(tmp_path)
+        else:
+            os.rename(tmp_path, cache_path)
+        data = load_from_disk(cache_path)
+
+    return data
+
+
+def stream_tokenized_dataset(
+    dataset_path: str,
+    prompt_template: str,
+    tokenizer: PreTrainedTokenizer,
+    *,
+    max_samples: Optional[int] = None,
+    max_length: Optional[int] = None,
+    shuffle_buffer_size: int = SHUFFLE_BUFFER_SIZE,
+    seed: int = 42,
+    rank: Optional[int] = None,
+    world_size: Optional[int] = None,
+) -> IterableDataset:
+    """
+    Lazily reads, shuffles, renders and tokenizes the train split of a dataset,
+    so memory use doesn't depend on the size of the dataset.
+
+    Shuffling uses a bounded buffer, and the stream is split deterministically
+    between processes (by default from the RANK and WORLD_SIZE variables set by
+    distributed launchers).
+    """
+    data = load_dataset(dataset_path, streaming=True)["train"]
+
+    rank = int(os.environ.get("RANK", 0)) if rank is None else rank
+    world_size = (
+        int(os.environ.get("WORLD_SIZE", 1)) if world_size is None else world_size
+    )
+    if world_size > 1:
+        data = split_dataset_by_node(data, rank=rank, world_size=world_size)
+
+    data = data.shuffle(seed=seed, buffer_size=shuffle_buffer_size)
+    if max_samples is not None:
+        data = data.take(max_samples)
+
+    return data.map(
+        PromptRenderer(prompt_template, tokenizer, max_length),
+        batched=True,
+        batch_size=PREPROCESSING_BATCH_SIZE,
+        remove_columns=column_names(data),
+    )
+
+
+def limit_tokens(data: Dataset, max_tokens: int) -> Dataset:
+    """
+    Keeps the leading examples of a tokenized dataset which fit in `max_tokens`.
+    """
+    total = 0
+    for count, ids in enumerate(data["input_ids"]):
+        total += len(ids)
+        if total > max_tokens:
+            return data.select(range(count))
+    return data
+
+
+class PrefetchingDataset(torch.utils.data.IterableDataset):
+    """
+    Iterates a (streaming) dataset on a background thread, keeping up to
+    `buffer_size` examples ready so that reading, rendering and tokenizing
+    overlap with training. Iteration stops once `max_tokens` would be exceeded.
+    """
+
+    def __init__(
+        self,
+        data: Union[Dataset, IterableDataset],
+        buffer_size: int = PREFETCH_BUFFER_SIZE,
+        max_tokens: Optional[int] = None,
+    ):
+        self.data = data
+        self.buffer_size = buffer_size
+        self.max_tokens = max_tokens
+
+    def set_epoch(self, epoch: int):
+        # reshuffles the underlying stream between epochs
+        if hasattr(self.data, "set_epoch"):
+            self.data.set_epoch(epoch)
+
+    def __iter__(self):
+        queue = Queue(maxsize=self.buffer_size)
+        stopped = Event()
+        done = object()
+
+        def put(item) -> bool:
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for example in self.data:
+                    if not put(example):
+                        return
+            except Exception as e:
+                put(e)
+            put(done)
+
+        Thread(target=produce, daemon=True).start()
+
+        tokens = 0
+        try:
+            while True:
+                item = queue.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+
+                tokens += len(item["input_ids"])
+                if self.max_tokens is not None and tokens > self.max_tokens:
+                    return
+                yield item
+        finally:
+            stopped.set()
+
+
+def column_names(data: Union[Dataset, IterableDataset]) -> List[str]:
+    # streamed datasets may not know their features until the first row is read
+    if data.column_names is not None:
+        return data.column_names
+    return list(next(iter(data)).keys())
+
+
+def _dataset_revision(dataset_path: str) -> str:
+    # local snapshots are identified by their files, hub ids by name
+    if not os.path.isdir(dataset_path):
+        return dataset_path
+
+    revision = hashlib.sha256()
+    for root, _, files in sorted(os.walk(dataset_path)):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            entry = f"{os.path.relpath(path, dataset_path)}:{stat.st_size}"
+            revision.update(f"{entry}:{stat.st_mtime_ns}\0".encode())
+    return revision.hexdigest()
@@ -0,0 +1,75 @@
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+
+class StartupProfiler:
+    """
+    Records the wall time and peak memory of each phase of bringing up a model
+    (downloading, loading weights, quantizing, warming up...), so slow cold
+    starts can be attributed to a phase.
+
+    Peak host memory is the process' peak resident set size at the end of the
+    phase, GPU memory is the peak allocated by torch during the phase.
+    """
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.phases: List[dict] = []
+
+    @contextmanager
+    def phase(self, name: str, **info):
+        cuda = imported_cuda()
+        if cuda:
+            cuda.reset_peak_memory_stats()
+
+        start = time.monotonic()
+        try:
+            yield info
+        finally:
+            self.phases.append(
+                {
+                    "name": name,
+                    "start": round(start - self.started_at, 3),
+                    "duration": round(time.monotonic() - start, 3),
+                    "peak_rss_mb": round(peak_rss_mb(), 1),
+                    "peak_cuda_mb": (
+                        round(cuda.max_memory_allocated() / 1024**2, 1)
+                        if cuda
+                        else None
+                    ),
+                    **info,
+                }
+            )
+
+    def report(self) -> dict:
+        end = max(
+            (phase["start"] + phase["duration"] for phase in self.phases), default=0.0
+        )
+        return {"total": round(end, 3), "phases": self.phases}
+
+    def print_report(self):
+        print(f"Startup profile: {json.dumps(self.report())}")
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of the process so far, in megabytes.
+    """
+    # kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def imported_cuda() -> Optional[object]:
+    """
+    `torch.cuda` if torch has been imported and a GPU is available, else None.
+    """
+    # torch may not be imported yet, and importing it would skew the first phase
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return torch.cuda
@@ -0,0 +1,222 @@
+"""
+Keeps track of the finetuned adapters on the finetunes volume.
+
+Every adapter directory holds a `finetune.json` manifest describing how it was
+trained, written when training finishes. The registry keeps a compact index of
+all manifests at the root of the volume, so listing adapters is a single read
+instead of a walk of the volume. Adding or removing an adapter only updates its
+own entry in the index.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+FINETUNES_DIR = "/finetunes"
+MANIFEST_NAME = "finetune.json"
+INDEX_NAME = ".registry.json"
+INDEX_VERSION = 1
+
+# what the listing returns for each adapter, the manifest has the rest
+INDEX_FIELDS = (
+    "name",
+    "base_model",
+    "dataset",
+    "size",
+    "rank",
+    "target_modules",
+    "template_hash",
+    "created_at",
+    "metrics",
+)
+
+
+def template_hash(prompt_template: str) -> str:
+    return hashlib.sha256(prompt_template.encode()).hexdigest()[:16]
+
+
+def write_manifest(adapter_dir: str, record: dict):
+    """
+    Writes the manifest of a trained adapter, `size` and `created_at` are filled
+    in from the adapter files.
+    """
+    record = {
+        "size": _adapter_size(adapter_dir),
+        "created_at": time.time(),
+        **record,
+    }
+    path = os.path.join(adapter_dir, MANIFEST_NAME)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(record, f)
+    os.replace(f"{path}.tmp", path)
+
+
+class FinetuneRegistry:
+    def __init__(self, root: str = FINETUNES_DIR):
+        self.root = root
+        # the parsed index and the mtime it was read at
+        self._cached: Optional[Dict[str, dict]] = None
+        self._cached_mtime: Optional[int] = None
+
+    def add(self, name: str) -> dict:
+        """
+        Indexes the adapter at `<root>/<name>`, which is expected to have a
+        manifest. Adapters trained before the registry get a minimal one.
+        """
+        entry = self._entry(name)
+        with self._index() as index:
+            index[name] = entry
+        return entry
+
+    def remove(self, name: str, delete: bool = True):
+        with self._index() as index:
+            index.pop(name, None)
+        if delete:
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def get(self, name: str) -> Optional[dict]:
+        """
+        Returns the full manifest of an adapter, or None if it isn't registered.
+        """
+        if name not in self._read():
+            return None
+        return _read_manifest(os.path.join(self.root, name))
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._read()
+
+    def list(
+        self,
+        base_model: Optional[str] = None,
+        dataset: Optional[str] = None,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> dict:
+        """
+        Returns the adapters matching the filters, newest first, as
+        `{"total": <matches>, "finetunes": <entries in the page>}`.
+        """
+        entries = [
+            entry
+            for entry in self._read().values()
+            if (base_model is None or entry["base_model"] == base_model)
+            and (dataset is None or entry["dataset"] == dataset)
+        ]
+        entries.sort(key=lambda entry: entry["created_at"] or 0, reverse=True)
+        end = None if limit is None else offset + limit
+        return {"total": len(entries), "finetunes": entries[offset:end]}
+
+    def sync(self) -> List[str]:
+        """
+        Reconciles the index with the adapters on the volume, for adapters which
+        were written or deleted without going through the registry. Returns the
+        names which changed.
+        """
+        on_disk = set()
+        for base in _listdir(self.root):
+            for name in _listdir(os.path.join(self.root, base)):
+                if os.path.exists(
+                    os.path.join(self.root, base, name, "adapter_config.json")
+                ):
+                    on_disk.add(f"{base}/{name}")
+
+        with self._index() as index:
+            added = on_disk - set(index)
+            removed = set(index) - on_disk
+            for name in removed:
+                del index[name]
+            for name in added:
+                index[name] = self._entry(name)
+        return sorted(added | removed)
+
+    def _entry(self, name: str) -> dict:
+        path = os.path.join(self.root, name)
+        manifest = _read_manifest(path)
+        if manifest is None:
+            base, _, _ = name.partition("/")
+            manifest = {
+                "base_model": base.replace("--", "/"),
+                "size": _adapter_size(path),
+                "created_at": os.path.getmtime(path),
+            }
+        # the name is where the adapter lives, not what it was trained as
+        return {**{field: manifest.get(field) for field in INDEX_FIELDS}, "name": name}
+
+    def _read(self) -> Dict[str, dict]:
+        path = os.path.join(self.root, INDEX_NAME)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            # first use on a volume with adapters from before the registry
+            self.sync()
+            return self._read()
+
+        if mtime != self._cached_mtime:
+            self._cached = _read_index(path)
+            self._cached_mtime = mtime
+        return self._cached
+
+    @contextmanager
+    def _index(self):
+        # training jobs and the web app update the index from different
+        # containers, so writes are serialized with a lock file
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, INDEX_NAME)
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = _read_index(path)
+                yield index
+                with open(f"{path}.tmp", "w") as f:
+                    json.dump(
+                        {"version": INDEX_VERSION, "finetunes": index},
+                        f,
+                        separators=(",", ":"),
+                    )
+                os.replace(f"{path}.tmp", path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_index(path: str) -> Dict[str, dict]:
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return index["finetunes"] if index.get("version") == INDEX_VERSION else {}
+
+
+def _read_manifest(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _adapter_size(path: str) -> int:
+    # the adapter weights and config, not the trainer checkpoints next to them
+    if not os.path.isdir(path):
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(path, name))
+        for name in os.listdir(path)
+        if name.startswith("adapter_")
+    )
+
+
+def _listdir(path: str) -> List[str]:
+    try:
+        return [
+            name
+            for name in os.listdir(path)
+            if not name.startswith(".") and os.path.isdir(os.path.join(path, name))
+        ]
+    except FileNotFoundError:
+        return []
@@ -1,6 +1,8 @@
+import json
 import os
+import time
 from enum import Enum
-from typing import Callable
+from typing import Callable, List, Optional, Tuple
 
 from transformers import (
     AutoConfig,
@@ -24,6 +26,9 @@ from transformers.trainer_callback import TrainerControl, TrainerState
 from transformers.training_args import TrainingArguments
 from transformers.utils import is_torch_tpu_available
 
+from .packing import PaddingStats
+from .profiling import imported_cuda, peak_rss_mb
+
 
 class TrainingJobStep(str, Enum):
     JOB_STARTED = "JOB_STARTED"
@@ -37,13 +42,42 @@ class TrainingJobStep(str, Enum):
 
 
 class LLMTrainerCallback(TrainerCallback):
+    """
+    Reports the progress of a training job. Besides the job steps and the
+    trainer's logs (as JSON), every optimizer step produces a telemetry record
+    through `on_metrics`:
+
+        step_time           seconds for the step, including data loading
+        samples_per_second
+        tokens_per_second   real tokens, and padded ones (what the GPU computed)
+        dataloader_wait     seconds spent fetching and collating batches
+        peak_cuda_mb        peak memory allocated by torch during the step
+        eta                 seconds left at the average step time so far
+
+    and a summary of the whole run when training ends. Token counts and data
+    loading times come from the `PaddingStats` of the collator, if given.
+    """
+
     def __init__(
         self,
         on_log: Callable[[str], None] = None,
         on_step: Callable[[TrainingJobStep], None] = None,
+        on_metrics: Callable[[dict], None] = None,
+        padding_stats: Optional[PaddingStats] = None,
     ):
         self._on_log = on_log
         self._on_step = on_step
+        self._on_metrics = on_metrics
+        self._padding_stats = padding_stats
+
+        self.records: List[dict] = []
+        self.summary: Optional[dict] = None
+        self._train_started_at = 0.0
+        self._step_started_at = 0.0
+        # end of the last forward/backward pass, data loading happens after it
+        self._compute_ended_at = 0.0
+        self._dataloader_wait = 0.0
+        self._tokens = (0, 0)
 
     def on_train_begin(
         self,
@@ -52,9 +86,86 @@ class LLMTrainerCallback(TrainerCallback):
         control: TrainerControl,
         **kwargs,
     ):
+        self._train_started_at = self._compute_ended_at = time.perf_counter()
+        self._step_started_at = self._train_started_at
+        self._tokens = self._token_counts()
         self._on_step and self._on_step(TrainingJobStep.TRAINING_STARTED)
         return super().on_train_begin(args, state, control, **kwargs)
 
+    def on_step_begin(
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        cuda = imported_cuda()
+        if cuda:
+            cuda.reset_peak_memory_stats()
+        return super().on_step_begin(args, state, control, **kwargs)
+
+    def on_substep_end(
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        self._micro_step_ended()
+        return super().on_substep_end(args, state, control, **kwargs)
+
+    def on_step_end(
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        self._micro_step_ended()
+        now = self._compute_ended_at
+        step_time = now - self._step_started_at
+
+        real, padded = self._token_counts()
+        real_tokens, padded_tokens = real - self._tokens[0], padded - self._tokens[1]
+        self._tokens = (real, padded)
+
+        samples = (
+            args.per_device_train_batch_size
+            * args.gradient_accumulation_steps
+            * args.world_size
+        )
+        elapsed = now - self._train_started_at
+        cuda = imported_cuda()
+        record = {
+            "type": "step",
+            "step": state.global_step,
+            "epoch": state.epoch,
+            "step_time": step_time,
+            "samples": samples,
+            "samples_per_second": samples / step_time if step_time else None,
+            "tokens_per_second": real_tokens / step_time if step_time else None,
+            "padded_tokens_per_second": (
+                padded_tokens / step_time if step_time else None
+            ),
+            "dataloader_wait": self._dataloader_wait,
+            "peak_cuda_mb": cuda.max_memory_allocated() / 1024**2 if cuda else None,
+            "peak_rss_mb": peak_rss_mb(),
+            # steps of a resumed run before this process aren't in elapsed
+            "eta": (
+                (state.max_steps - state.global_step)
+                * elapsed
+                / (len(self.records) + 1)
+                if state.max_steps > 0
+                else None
+            ),
+        }
+        self.records.append(record)
+        self._on_metrics and self._on_metrics(record)
+
+        self._step_started_at = now
+        self._dataloader_wait = 0.0
+        return super().on_step_end(args, state, control, **kwargs)
+
     def on_train_end(
         self,
         args: TrainingArguments,
@@ -62,7 +173,9 @@ class LLMTrainerCallback(TrainerCallback):
         control: TrainerControl,
         **kwargs,
     ):
-        self._on_step and self._on_step(TrainingJobStep.JOB_COMPLETED)
+        self.summary = self._summarize()
+        self._on_metrics and self._on_metrics(self.summary)
+        self._on_log and self._on_log(json.dumps(self.summary))
         return super().on_train_end(args, state, control, **kwargs)
 
     def on_epoch_end(
@@ -83,9 +196,52 @@ class LLMTrainerCallback(TrainerCallback):
         logs=None,
         **kwargs,
     ):
-        self._on_log and self._on_log(str(logs))
+        self._on_log and self._on_log(
+            json.dumps({"step": state.global_step, **(logs or {})}, default=str)
+        )
         return super().on_log(args, state, control, **kwargs)
 
+    def _micro_step_ended(self):
+        # with a single process data loader, the batch of the pass which just
+        # ended was loaded between the end of the previous pass and its collation
+        now = time.perf_counter()
+        collated_at = self._padding_stats and self._padding_stats.updated_at
+        if collated_at and collated_at > self._compute_ended_at:
+            self._dataloader_wait += collated_at - self._compute_ended_at
+        self._compute_ended_at = now
+
+    def _token_counts(self) -> Tuple[int, int]:
+        if self._padding_stats is None:
+            return 0, 0
+        return self._padding_stats.real_tokens, self._padding_stats.padded_tokens
+
+    def _summarize(self) -> dict:
+        steps = len(self.records)
+        train_time = self._compute_ended_at - self._train_started_at
+        real, padded = self._token_counts()
+        step_times = sorted(record["step_time"] for record in self.records)
+        peaks = [r["peak_cuda_mb"] for r in self.records if r["peak_cuda_mb"]]
+        wait = sum(record["dataloader_wait"] for record in self.records)
+        return {
+            "type": "summary",
+            "steps": steps,
+            "train_time": train_time,
+            "mean_step_time": train_time / steps if steps else None,
+            "median_step_time": step_times[steps // 2] if steps else None,
+            "samples_per_second": (
+                sum(record["samples"] for record in self.records) / train_time
+                if train_time
+                else None
+            ),
+            "tokens_per_second": real / train_time if train_time else None,
+            "padded_tokens_per_second": padded / train_time if train_time else None,
+            "padding_efficiency": real / padded if padded else None,
+            "dataloader_wait": wait,
+            "dataloader_wait_fraction": wait / train_time if train_time else None,
+            "peak_cuda_mb": max(peaks) if peaks else None,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
 
 class CustomWandBCallback(WandbCallback):
     def __init__(self, on_init: Callable[[str], None] = None):
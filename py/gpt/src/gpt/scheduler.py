@@ -0,0 +1,492 @@
+import inspect
+import time
+from collections import deque
+from contextlib import nullcontext
+from threading import Condition, Thread
+from typing import Callable, ContextManager, Deque, Iterable, List, Optional, Union
+
+import torch
+from transformers import (
+    GenerationConfig,
+    LogitsProcessorList,
+    PreTrainedModel,
+    PreTrainedTokenizer,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TextIteratorStreamer,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from . import utils
+from .metrics import RequestTiming
+from .prefix_cache import PrefixCache
+
+MAX_BATCH_SIZE = 8
+
+
+class SchedulerStreamer(TextIteratorStreamer):
+    """
+    Text iterator handed back to callers of `GenerationScheduler.submit`. Errors
+    raised by the decode loop are re-raised in the consuming thread.
+    """
+
+    def __init__(self, tokenizer, request: "GenerationRequest", **decode_kwargs):
+        super().__init__(tokenizer, skip_special_tokens=True, **decode_kwargs)
+        self.request = request
+
+    def fail(self, error: Exception):
+        self.text_queue.put(error, timeout=self.timeout)
+
+    def cancel(self):
+        self.request.cancelled = True
+
+    def __next__(self):
+        value = super().__next__()
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+
+class GenerationRequest:
+    def __init__(
+        self,
+        input_ids: torch.Tensor,
+        generation_config: GenerationConfig,
+        stop: utils.Stop,
+        eos_token_id: Union[int, List[int], None],
+        adapter: Optional[str] = None,
+        max_batch_size: Optional[int] = None,
+    ):
+        self.input_ids = input_ids
+        self.adapter = adapter
+        self.max_batch_size = max_batch_size
+        self.token_ids: List[int] = input_ids[0].tolist()
+        self.generation_config = generation_config
+        self.stop = stop
+        # generation configs may have several end of sequence tokens
+        if eos_token_id is None:
+            eos_token_id = []
+        self.eos_token_ids = set(
+            eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        )
+        # configs may cap the whole sequence with max_length instead
+        self.max_new_tokens = generation_config.max_new_tokens
+        if self.max_new_tokens is None:
+            self.max_new_tokens = generation_config.max_length - input_ids.shape[1]
+        self.processors = _logits_processors(generation_config)
+
+        # token_ids on the model's device, preallocated for the whole generation,
+        # which the logits processors read
+        self.ids: Optional[torch.Tensor] = None
+        self.next_token: Optional[int] = None
+        self.generated = 0
+        self.cancelled = False
+        self.streamer: Optional[SchedulerStreamer] = None
+        self.timing = RequestTiming()
+        # tokens proposed by a draft model and kept, with speculative decoding
+        self.drafted = 0
+        self.accepted = 0
+
+    def emit(self, token: int) -> bool:
+        """
+        Appends a generated token and streams it, returning whether the request
+        is finished.
+        """
+        self.token_ids.append(token)
+        self.next_token = token
+        self.generated += 1
+        self.timing.token()
+        self.streamer.put(torch.tensor([token]))
+
+        stopped = self.stop.step(0, [token])
+        return (
+            stopped
+            or self.cancelled
+            or token in self.eos_token_ids
+            or self.generated >= self.max_new_tokens
+        )
+
+
+class ModelLock:
+    """
+    First come first served lock on a model shared by several decode loops, so
+    none of them is starved by another re-acquiring it right away.
+    """
+
+    def __init__(self):
+        self._cv = Condition()
+        self._next_ticket = 0
+        self._serving = 0
+
+    def __enter__(self):
+        with self._cv:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._cv.wait_for(lambda: self._serving == ticket)
+
+    def __exit__(self, *exc):
+        with self._cv:
+            self._serving += 1
+            self._cv.notify_all()
+
+
+class GenerationScheduler:
+    """
+    Owns a model and runs a single decode loop for every streaming request.
+
+    New requests are prefilled and merged into the running batch between decode
+    steps, and finished ones are retired immediately, so concurrent callers share
+    each forward pass instead of waiting for the GPU one after another. The
+    per-row KV caches are left-padded to a common length and masked out.
+
+    Each request may name its own adapter, and rows with different adapters share
+    the same batch. `load_adapter` is called from the decode loop to make an
+    adapter resident (without evicting the ones still in use) and returns the
+    model to run, while `route_adapters` wraps every forward pass with the
+    adapter of each row.
+
+    With a `prefix_cache`, prompts only prefill the tokens after the longest
+    prefix whose past key values are already cached.
+
+    Models which don't take `position_ids` (Falcon) derive positions from the
+    length of the cache, which is wrong for left padded rows, so their requests
+    are decoded one at a time instead of being merged into a batch.
+    """
+
+    def __init__(
+        self,
+        model: PreTrainedModel,
+        tokenizer: PreTrainedTokenizer,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        load_adapter: Optional[Callable[[str, Iterable[str]], PreTrainedModel]] = None,
+        route_adapters: Optional[
+            Callable[[List[Optional[str]]], ContextManager]
+        ] = None,
+        prefix_cache: Optional[PrefixCache] = None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.load_adapter = load_adapter
+        self.route_adapters = route_adapters
+        self.prefix_cache = prefix_cache
+        self.merge_rows = _accepts_position_ids(model)
+
+        self._pending: Deque[GenerationRequest] = deque()
+        self._active: List[GenerationRequest] = []
+        self._past = None
+        self._attention_mask: Optional[torch.Tensor] = None
+
+        self._cv = Condition()
+        self._thread: Optional[Thread] = None
+        # held for every forward pass, other decoders share the model through it
+        self.lock = ModelLock()
+
+    def submit(
+        self,
+        input_ids: torch.Tensor,
+        generation_config: GenerationConfig,
+        stop: utils.Stop,
+        adapter: Optional[str] = None,
+        max_batch_size: Optional[int] = None,
+    ) -> SchedulerStreamer:
+        """
+        Queues a request, whose generated text is streamed by the returned
+        streamer. With `max_batch_size`, the batch grows up to that many rows
+        while the request is in it rather than the scheduler's own limit, e.g.
+        for offline batches where throughput matters more than latency.
+        """
+        eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+
+        request = GenerationRequest(
+            input_ids, generation_config, stop, eos_token_id, adapter, max_batch_size
+        )
+        request.streamer = SchedulerStreamer(self.tokenizer, request)
+        # echo the prompt, matching model.generate with a TextIteratorStreamer
+        request.streamer.put(input_ids.cpu())
+        stop.add_row(input_ids.shape[1])
+
+        with self._cv:
+            self._pending.append(request)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cv.notify_all()
+
+        return request.streamer
+
+    def _run(self):
+        while True:
+            with self._cv:
+                self._cv.wait_for(lambda: self._active or self._pending)
+                admitted = []
+                while self._pending:
+                    rows = self._active + admitted + [self._pending[0]]
+                    if len(rows) > self._capacity(rows):
+                        break
+                    admitted.append(self._pending.popleft())
+
+            try:
+                with self.lock, torch.no_grad():
+                    admitted = self._load_adapters(admitted)
+                    for request in admitted:
+                        self._admit(request)
+                    if self._active:
+                        self._step()
+            except Exception as e:
+                for request in {id(r): r for r in admitted + self._active}.values():
+                    request.streamer.fail(e)
+                self._active = []
+                self._past = None
+                self._attention_mask = None
+
+    def _capacity(self, requests: List[GenerationRequest]) -> int:
+        if not self.merge_rows:
+            return 1
+        return max([self.max_batch_size] + [r.max_batch_size or 0 for r in requests])
+
+    def adapters_in_use(self) -> set:
+        """
+        Adapters of the running batch, which must stay loaded. Only stable while
+        holding `lock`.
+        """
+        return {r.adapter for r in self._active if r.adapter}
+
+    def _load_adapters(self, admitted: List[GenerationRequest]):
+        in_use = self.adapters_in_use() | {r.adapter for r in admitted if r.adapter}
+        loaded = []
+        for request in admitted:
+            if request.adapter is not None:
+                start = time.perf_counter()
+                try:
+                    self.model = self.load_adapter(request.adapter, in_use)
+                except Exception as e:
+                    # a missing or broken adapter only fails its own request
+                    request.streamer.fail(e)
+                    continue
+                finally:
+                    request.timing.adapter_load = time.perf_counter() - start
+            loaded.append(request)
+        return loaded
+
+    def _forward(self, requests, input_ids, attention_mask, past_key_values=None):
+        inputs = self.model.prepare_inputs_for_generation(
+            input_ids,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            use_cache=True,
+        )
+        if past_key_values is not None and input_ids.shape[1] > 1:
+            # prepare_inputs_for_generation assumes a single new token once there
+            # is a cache, which isn't the case when prefilling after a cached prefix
+            inputs["input_ids"] = input_ids
+            if inputs.get("position_ids") is not None:
+                position_ids = attention_mask.long().cumsum(-1) - 1
+                position_ids.masked_fill_(attention_mask == 0, 1)
+                inputs["position_ids"] = position_ids[:, -input_ids.shape[1] :]
+
+        adapters = [request.adapter for request in requests]
+        routing = (
+            self.route_adapters(adapters)
+            if self.route_adapters and any(adapters)
+            else nullcontext()
+        )
+        with routing:
+            outputs = self.model(**inputs, return_dict=True)
+        return outputs.logits[:, -1, :].float(), outputs.past_key_values
+
+    def _admit(self, request: GenerationRequest):
+        if request.cancelled:
+            request.streamer.end()
+            return
+
+        request.timing.admitted_at = time.perf_counter()
+        input_ids = request.input_ids.to(self.model.device)
+        attention_mask = torch.ones_like(input_ids)
+        request.ids = torch.cat(
+            [input_ids, input_ids.new_zeros((1, max(request.max_new_tokens, 0)))], dim=1
+        )
+
+        cached, past = 0, None
+        if self.prefix_cache is not None:
+            cached, past = self.prefix_cache.match(request.adapter, request.token_ids)
+        logits, past = self._forward(
+            [request], input_ids[:, cached:], attention_mask, past
+        )
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(request.adapter, request.token_ids, past)
+
+        if request.emit(self._sample([request], logits)[0]):
+            request.streamer.end()
+            return
+
+        if not self._active:
+            self._past, self._attention_mask = past, attention_mask
+        else:
+            length = max(self._attention_mask.shape[1], input_ids.shape[1])
+            self._past = _concat_past(
+                [
+                    (self._past, self._attention_mask.shape[1]),
+                    (past, input_ids.shape[1]),
+                ],
+                length,
+            )
+            self._attention_mask = torch.cat(
+                [
+                    _left_pad(self._attention_mask, length, dim=1),
+                    _left_pad(attention_mask, length, dim=1),
+                ]
+            )
+        self._active.append(request)
+
+    def _step(self):
+        input_ids = torch.tensor(
+            [[request.next_token] for request in self._active],
+            device=self.model.device,
+        )
+        attention_mask = torch.cat(
+            [
+                self._attention_mask,
+                self._attention_mask.new_ones((len(self._active), 1)),
+            ],
+            dim=1,
+        )
+        logits, self._past = self._forward(
+            self._active, input_ids, attention_mask, self._past
+        )
+        self._attention_mask = attention_mask
+
+        keep = []
+        tokens = self._sample(self._active, logits)
+        for row, (request, token) in enumerate(zip(self._active, tokens)):
+            if request.emit(token):
+                request.streamer.end()
+            else:
+                keep.append(row)
+
+        if len(keep) < len(self._active):
+            self._retire(keep)
+
+    def _retire(self, keep: List[int]):
+        batch_size = len(self._active)
+        self._active = [self._active[row] for row in keep]
+        if not keep:
+            self._past = None
+            self._attention_mask = None
+            return
+
+        index = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask[index]
+        # drop leading columns which are padding for every remaining row
+        start = int(attention_mask.any(dim=0).int().argmax())
+        length = attention_mask.shape[1]
+
+        self._attention_mask = attention_mask[:, start:]
+        self._past = _map_past(
+            self._past,
+            lambda t: _select_rows(t, index, batch_size).narrow(
+                _seq_dim(t, length), start, length - start
+            ),
+        )
+
+    def _sample(
+        self, requests: List[GenerationRequest], logits: torch.Tensor
+    ) -> List[int]:
+        """
+        Picks the next token of every row, waiting on the device once for the
+        whole batch rather than once per row.
+        """
+        choices = []
+        for row, request in enumerate(requests):
+            length = len(request.token_ids)
+            scores = logits[row : row + 1]
+            if request.processors:
+                scores = request.processors(request.ids[:, :length], scores)
+            if request.generation_config.do_sample:
+                probs = torch.nn.functional.softmax(scores, dim=-1)
+                choice = torch.multinomial(probs, num_samples=1)[0]
+            else:
+                choice = torch.argmax(scores, dim=-1)
+
+            if length == request.ids.shape[1]:
+                request.ids = torch.cat([request.ids, torch.zeros_like(request.ids)], 1)
+            request.ids[0, length] = choice[0]
+            choices.append(choice)
+        return torch.cat(choices).tolist()
+
+
+def _accepts_position_ids(model: PreTrainedModel) -> bool:
+    # adapters wrap the model with a forward taking **kwargs
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    return "position_ids" in inspect.signature(model.forward).parameters
+
+
+def _logits_processors(generation_config: GenerationConfig) -> LogitsProcessorList:
+    processors = LogitsProcessorList()
+    if generation_config.repetition_penalty not in (None, 1.0):
+        processors.append(
+            RepetitionPenaltyLogitsProcessor(generation_config.repetition_penalty)
+        )
+    if generation_config.do_sample:
+        if generation_config.temperature not in (None, 1.0):
+            processors.append(TemperatureLogitsWarper(generation_config.temperature))
+        if generation_config.top_k not in (None, 0):
+            processors.append(TopKLogitsWarper(generation_config.top_k))
+        if generation_config.top_p is not None and generation_config.top_p < 1.0:
+            processors.append(TopPLogitsWarper(generation_config.top_p))
+    return processors
+
+
+#### KV cache helpers
+#
+# Caches are the legacy tuple-of-tuples format. The batch is always the leading
+# dimension, either on its own or fused with the heads (batch * heads, ...), and
+# the sequence is the second to last dimension (or the last one, for models
+# which store keys transposed).
+
+
+def _map_past(past, fn):
+    return tuple(tuple(fn(t) for t in layer) for layer in past)
+
+
+def _seq_dim(t: torch.Tensor, length: int) -> int:
+    return -2 if t.shape[-2] == length else -1
+
+
+def _left_pad(t: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+    pad = length - t.shape[dim]
+    if pad <= 0:
+        return t
+    shape = list(t.shape)
+    shape[dim] = pad
+    return torch.cat([t.new_zeros(shape), t], dim=dim)
+
+
+def _select_rows(t: torch.Tensor, index: torch.Tensor, batch_size: int):
+    rows = t.reshape(batch_size, t.shape[0] // batch_size, *t.shape[1:])
+    return rows[index.to(t.device)].flatten(0, 1)
+
+
+def _concat_past(parts, length: int):
+    """
+    Concatenates (past, seq_length) caches along the batch, left padding each one
+    to `length`.
+    """
+    layers = []
+    for layer_parts in zip(*[past for past, _ in parts]):
+        layer = []
+        for tensors in zip(*layer_parts):
+            layer.append(
+                torch.cat(
+                    [
+                        _left_pad(t, length, _seq_dim(t, seq_length) % t.dim())
+                        for t, (_, seq_length) in zip(tensors, parts)
+                    ]
+                )
+            )
+        layers.append(tuple(layer))
+    return tuple(layers)
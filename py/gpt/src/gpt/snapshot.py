@@ -0,0 +1,329 @@
+"""
+A snapshot is a model as it is after loading and quantizing, written next to the
+checkpoint it was made from so later loads skip the conversion:
+
+    <model_path>/.snapshots/<quantization>/
+        snapshot.json       what to rebuild: format, source revision, quantized modules
+        model.safetensors   every tensor, including the quantization statistics
+        config, generation config and tokenizer files
+        *.py                the modules of models with remote code (Falcon RW)
+
+Tensors are read through safetensors' memory map straight to their device.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Dict, Literal, Optional, Tuple, Union
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+from safetensors.torch import save_file
+from transformers import (
+    AutoConfig,
+    AutoModelForCausalLM,
+    AutoTokenizer,
+    BitsAndBytesConfig,
+    GenerationConfig,
+    PreTrainedModel,
+    PreTrainedTokenizer,
+)
+
+SNAPSHOT_VERSION = 1
+SNAPSHOTS_DIR = ".snapshots"
+
+# nf4 needs a GPU, the other formats load on the CPU
+Quantization = Union[
+    Literal["nf4"], Literal["int8"], Literal["bf16"], Literal["fp16"], Literal["fp32"]
+]
+
+DTYPES = {
+    "nf4": torch.bfloat16,
+    "int8": torch.float32,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+    "fp32": torch.float32,
+}
+
+
+def snapshot_path(model_path: str, quantization: Quantization) -> str:
+    return os.path.join(model_path, SNAPSHOTS_DIR, quantization)
+
+
+def has_snapshot(model_path: str, quantization: Quantization) -> bool:
+    manifest = _read_manifest(snapshot_path(model_path, quantization))
+    return (
+        manifest is not None
+        and manifest["version"] == SNAPSHOT_VERSION
+        and manifest["torch"] == torch.__version__
+        and manifest["source"] == _source_revision(model_path)
+    )
+
+
+def save_snapshot(
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizer,
+    model_path: str,
+    quantization: Quantization,
+):
+    path = snapshot_path(model_path, quantization)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    tensors: Dict[str, torch.Tensor] = {}
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "torch": torch.__version__,
+        "source": _source_revision(model_path),
+        "quantization": quantization,
+        "linear4bit": {},
+        "int8": {},
+        "aliases": {},
+    }
+
+    # dynamically quantized linears keep their weights packed, outside of the
+    # regular state dict entries
+    int8_modules = set()
+    for name, module in model.named_modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            int8_modules.add(name)
+            manifest["int8"][name] = _save_int8(module, name, tensors)
+
+    seen = {}
+    for key, value in model.state_dict(keep_vars=True).items():
+        if not isinstance(value, torch.Tensor) or any(
+            key.startswith(f"{name}.") for name in int8_modules
+        ):
+            continue
+
+        # tied weights are stored once
+        identity = (value.data_ptr(), value.dtype, tuple(value.shape))
+        if identity in seen:
+            manifest["aliases"][key] = seen[identity]
+            continue
+        seen[identity] = key
+
+        tensors[key] = value.data
+        if getattr(value, "quant_state", None) is not None:
+            manifest["linear4bit"][key] = {
+                "blocksize": value.blocksize,
+                "compress_statistics": value.compress_statistics,
+                "quant_type": value.quant_type,
+                "quant_state": _encode(
+                    value.quant_state, f"{key}.quant_state", tensors
+                ),
+            }
+
+    if quantization == "nf4":
+        quantization_config = model.config.quantization_config
+        manifest["quantization_config"] = (
+            quantization_config.to_dict()
+            if hasattr(quantization_config, "to_dict")
+            else quantization_config
+        )
+
+    save_file(
+        {key: t.detach().contiguous().cpu() for key, t in tensors.items()},
+        os.path.join(tmp_path, "model.safetensors"),
+        metadata={"format": "pt"},
+    )
+    model.config.save_pretrained(tmp_path)
+    if model.generation_config is not None:
+        model.generation_config.save_pretrained(tmp_path)
+    tokenizer.save_pretrained(tmp_path)
+    # the auto_map of the config points at these, relative to its directory
+    for name in os.listdir(model_path):
+        if name.endswith(".py"):
+            shutil.copy2(os.path.join(model_path, name), tmp_path)
+
+    # the manifest goes last, a snapshot without one is never loaded
+    with open(os.path.join(tmp_path, "snapshot.json"), "w") as f:
+        json.dump(manifest, f)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def load_snapshot(
+    model_path: str, quantization: Quantization
+) -> Tuple[PreTrainedModel, PreTrainedTokenizer]:
+    path = snapshot_path(model_path, quantization)
+    manifest = _read_manifest(path)
+    device = "cuda:0" if quantization == "nf4" else "cpu"
+
+    config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(
+            config, trust_remote_code=True, torch_dtype=DTYPES[quantization]
+        )
+
+    if quantization == "nf4":
+        from transformers.utils.bitsandbytes import replace_with_bnb_linear
+
+        quantization_config = BitsAndBytesConfig.from_dict(
+            manifest["quantization_config"]
+        )
+        model = replace_with_bnb_linear(
+            model,
+            modules_to_not_convert=quantization_config.llm_int8_skip_modules
+            or ["lm_head"],
+            quantization_config=quantization_config,
+        )
+        # what from_pretrained would set, peft and the trainer check these
+        model.is_loaded_in_4bit = True
+        model.is_quantized = True
+        model.config.quantization_config = quantization_config
+        model.hf_device_map = {"": 0}
+
+    with safe_open(
+        os.path.join(path, "model.safetensors"), framework="pt", device=device
+    ) as f:
+        for name, entry in manifest["int8"].items():
+            _load_int8(model, name, entry, f)
+
+        for key in f.keys():
+            if key in manifest["linear4bit"]:
+                _load_linear4bit(model, key, manifest["linear4bit"][key], f, device)
+            elif (
+                key.rsplit(".", 1)[0] not in manifest["int8"]
+                and ".quant_state." not in key
+            ):
+                set_module_tensor_to_device(model, key, device, value=f.get_tensor(key))
+
+    # tied weights point at the same tensor again
+    for key, target in manifest["aliases"].items():
+        target_module, target_name = _owner(model, target)
+        module, name = _owner(model, key)
+        if target_name in target_module._parameters:
+            module._parameters[name] = target_module._parameters[target_name]
+        else:
+            module._buffers[name] = target_module._buffers[target_name]
+
+    if os.path.exists(os.path.join(path, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(path)
+    model.eval()
+
+    return model, AutoTokenizer.from_pretrained(path)
+
+
+def _owner(model, key: str) -> Tuple[torch.nn.Module, str]:
+    module_name, _, name = key.rpartition(".")
+    return model.get_submodule(module_name), name
+
+
+def _load_linear4bit(model, key: str, entry: dict, f, device: str):
+    import bitsandbytes as bnb
+
+    module, param_name = _owner(model, key)
+    module._parameters[param_name] = bnb.nn.Params4bit(
+        f.get_tensor(key),
+        requires_grad=False,
+        quant_state=_decode(entry["quant_state"], f, device),
+        blocksize=entry["blocksize"],
+        compress_statistics=entry["compress_statistics"],
+        quant_type=entry["quant_type"],
+    )
+
+
+def _save_int8(module, name: str, tensors: Dict[str, torch.Tensor]) -> dict:
+    weight, bias = module._weight_bias()
+    tensors[f"{name}.weight"] = weight.int_repr()
+    if bias is not None:
+        tensors[f"{name}.bias"] = bias
+
+    entry = {
+        "in_features": module.in_features,
+        "out_features": module.out_features,
+        "bias": bias is not None,
+        "qscheme": str(weight.qscheme()).replace("torch.", ""),
+    }
+    if weight.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric):
+        tensors[f"{name}.scales"] = weight.q_per_channel_scales()
+        tensors[f"{name}.zero_points"] = weight.q_per_channel_zero_points()
+        entry["axis"] = weight.q_per_channel_axis()
+    else:
+        entry["scale"] = weight.q_scale()
+        entry["zero_point"] = weight.q_zero_point()
+    return entry
+
+
+def _load_int8(model, name: str, entry: dict, f):
+    int_repr = f.get_tensor(f"{name}.weight")
+    if "axis" in entry:
+        weight = torch._make_per_channel_quantized_tensor(
+            int_repr,
+            f.get_tensor(f"{name}.scales"),
+            f.get_tensor(f"{name}.zero_points"),
+            entry["axis"],
+        )
+    else:
+        weight = torch._make_per_tensor_quantized_tensor(
+            int_repr, entry["scale"], entry["zero_point"]
+        )
+
+    module = torch.ao.nn.quantized.dynamic.Linear(
+        entry["in_features"],
+        entry["out_features"],
+        bias_=entry["bias"],
+        dtype=torch.qint8,
+    )
+    module.set_weight_bias(
+        weight, f.get_tensor(f"{name}.bias") if entry["bias"] else None
+    )
+
+    parent, child_name = _owner(model, name)
+    setattr(parent, child_name, module)
+
+
+# quantization states are nested lists of tensors, sizes, dtypes and scalars
+
+
+def _encode(value, key: str, tensors: Dict[str, torch.Tensor]):
+    if isinstance(value, torch.Tensor):
+        tensors[key] = value
+        return {"tensor": key}
+    if isinstance(value, torch.Size):
+        return {"size": list(value)}
+    if isinstance(value, torch.dtype):
+        return {"dtype": str(value).replace("torch.", "")}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v, f"{key}.{i}", tensors) for i, v in enumerate(value)]
+    return value
+
+
+def _decode(value, f, device: str):
+    if isinstance(value, dict):
+        if "tensor" in value:
+            return f.get_tensor(value["tensor"]).to(device)
+        if "size" in value:
+            return torch.Size(value["size"])
+        if "dtype" in value:
+            return getattr(torch, value["dtype"])
+    if isinstance(value, list):
+        return [_decode(v, f, device) for v in value]
+    return value
+
+
+def _read_manifest(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(path, "snapshot.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _source_revision(model_path: str) -> str:
+    # the checkpoint files a snapshot was made from, so it is rebuilt if they change
+    revision = hashlib.sha256()
+    for root, dirs, files in os.walk(model_path):
+        dirs[:] = sorted(d for d in dirs if d != SNAPSHOTS_DIR)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            entry = f"{os.path.relpath(path, model_path)}:{stat.st_size}"
+            revision.update(f"{entry}:{stat.st_mtime_ns}\0".encode())
+    return revision.hexdigest()
@@ -0,0 +1,223 @@
+"""
+Speculative decoding: a small draft model proposes a few tokens one at a time,
+and the target model scores all of them in a single forward pass. The longest
+prefix of the proposal the target agrees with is kept, plus one token from the
+target itself, so each target pass yields between 1 and `num_draft_tokens + 1`
+tokens while the output stays that of the target alone.
+
+With greedy decoding a draft token is kept if it is the target's argmax. With
+sampling, a draft token x is kept with probability min(1, p(x) / q(x)) and on
+rejection a token is sampled from max(0, p - q), which leaves the distribution of
+the output unchanged (Leviathan et al., 2023).
+"""
+
+import time
+from threading import Thread
+from typing import List, Optional, Tuple
+
+import torch
+from transformers import GenerationConfig, PreTrainedModel
+
+from . import utils
+from .scheduler import (
+    GenerationRequest,
+    GenerationScheduler,
+    SchedulerStreamer,
+    _map_past,
+    _seq_dim,
+)
+
+NUM_DRAFT_TOKENS = 4
+
+
+class SpeculativeDecoder:
+    """
+    Runs requests with speculative decoding against the model of a
+    `GenerationScheduler`, taking turns with its decode loop through the
+    scheduler's lock. Each request is decoded on its own, in its own thread,
+    and streams through the same `SchedulerStreamer` as scheduled requests.
+    """
+
+    def __init__(
+        self,
+        scheduler: GenerationScheduler,
+        draft_model: PreTrainedModel,
+        num_draft_tokens: int = NUM_DRAFT_TOKENS,
+    ):
+        self.scheduler = scheduler
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+
+    def submit(
+        self,
+        input_ids: torch.Tensor,
+        generation_config: GenerationConfig,
+        stop: utils.Stop,
+    ) -> SchedulerStreamer:
+        eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.scheduler.tokenizer.eos_token_id
+
+        request = GenerationRequest(input_ids, generation_config, stop, eos_token_id)
+        request.streamer = SchedulerStreamer(self.scheduler.tokenizer, request)
+        request.streamer.put(input_ids.cpu())
+        stop.add_row(input_ids.shape[1])
+
+        Thread(target=self._run, args=(request,), daemon=True).start()
+        return request.streamer
+
+    def _run(self, request: GenerationRequest):
+        try:
+            with torch.no_grad():
+                self._decode(request)
+        except Exception as e:
+            request.streamer.fail(e)
+        else:
+            request.streamer.end()
+
+    def _decode(self, request: GenerationRequest):
+        target = _Model(self.scheduler.model)
+        draft = _Model(self.draft_model)
+
+        with self.scheduler.lock:
+            request.timing.admitted_at = time.perf_counter()
+            logits = target.forward(request.token_ids)
+            if request.emit(self._choose(request, request.token_ids, logits[-1])):
+                return
+
+        while True:
+            with self.scheduler.lock:
+                # the draft catches up on the tokens it hasn't seen, then guesses
+                tokens = request.token_ids
+                proposal: List[int] = []
+                draft_scores: List[torch.Tensor] = []
+                logits = draft.forward(tokens[draft.length :])
+                for i in range(self.num_draft_tokens):
+                    scores = _scores(request, tokens + proposal, logits[-1])
+                    token = _pick(request, scores)
+                    proposal.append(token)
+                    draft_scores.append(scores)
+                    if i + 1 < self.num_draft_tokens:
+                        logits = draft.forward([token])
+
+                # the target scores its last token and every proposed one at once
+                logits = target.forward(tokens[target.length :] + proposal)
+                offset = logits.shape[0] - len(proposal) - 1
+
+                accepted = 0
+                for i, token in enumerate(proposal):
+                    scores = _scores(request, tokens + proposal[:i], logits[offset + i])
+                    kept, correction = self._verify(
+                        request, scores, draft_scores[i], token
+                    )
+                    if not kept:
+                        break
+                    accepted += 1
+                else:
+                    correction = None
+
+                request.drafted += len(proposal)
+                request.accepted += accepted
+                committed = len(tokens)
+                new_tokens = proposal[:accepted]
+                if correction is None:
+                    # everything was accepted, the target's next token comes free
+                    correction = self._choose(
+                        request, tokens + new_tokens, logits[offset + accepted]
+                    )
+
+                for token in new_tokens + [correction]:
+                    if request.emit(token):
+                        return
+
+                # drop the cache entries of rejected tokens, the correction is fed
+                # on the next round
+                target.truncate(committed + accepted)
+                draft.truncate(min(draft.length, committed + accepted))
+
+    def _choose(
+        self, request: GenerationRequest, token_ids: List[int], logits: torch.Tensor
+    ) -> int:
+        return _pick(request, _scores(request, token_ids, logits))
+
+    def _verify(
+        self,
+        request: GenerationRequest,
+        scores: torch.Tensor,
+        draft_scores: torch.Tensor,
+        token: int,
+    ) -> Tuple[bool, Optional[int]]:
+        """
+        Returns whether the target keeps a draft token, and the token to use in
+        its place if it doesn't.
+        """
+        if not request.generation_config.do_sample:
+            choice = int(torch.argmax(scores))
+            return choice == token, None if choice == token else choice
+
+        vocab_size = min(scores.shape[-1], draft_scores.shape[-1])
+        p = torch.softmax(scores[..., :vocab_size], dim=-1)[0]
+        q = torch.softmax(draft_scores[..., :vocab_size].to(p.device), dim=-1)[0]
+        if token < vocab_size and torch.rand(()) * q[token] < p[token]:
+            return True, None
+
+        residual = torch.clamp(p - q, min=0)
+        if residual.sum() <= 0:
+            residual = p
+        return False, int(torch.multinomial(residual / residual.sum(), 1))
+
+
+class _Model:
+    """
+    A model with a single row KV cache, for feeding it tokens incrementally.
+    """
+
+    def __init__(self, model: PreTrainedModel):
+        self.model = model
+        self.past = None
+        self.length = 0
+
+    def forward(self, token_ids: List[int]) -> torch.Tensor:
+        """
+        Feeds tokens after the cached ones, returning the logits at each of them.
+        """
+        if not token_ids:
+            raise ValueError("Nothing to feed the model")
+
+        input_ids = torch.tensor([token_ids], device=self.model.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=torch.ones(
+                (1, self.length + len(token_ids)), device=self.model.device
+            ),
+            past_key_values=self.past,
+            use_cache=True,
+            return_dict=True,
+        )
+        self.past = outputs.past_key_values
+        self.length += len(token_ids)
+        return outputs.logits[0].float()
+
+    def truncate(self, length: int):
+        if length >= self.length:
+            return
+        current = self.length
+        self.past = _map_past(
+            self.past, lambda t: t.narrow(_seq_dim(t, current), 0, length)
+        )
+        self.length = length
+
+
+def _scores(
+    request: GenerationRequest, token_ids: List[int], logits: torch.Tensor
+) -> torch.Tensor:
+    # processors may modify the scores in place, logits are reused across calls
+    input_ids = torch.tensor([token_ids], device=logits.device)
+    return request.processors(input_ids, logits.unsqueeze(0).clone())
+
+
+def _pick(request: GenerationRequest, scores: torch.Tensor) -> int:
+    if request.generation_config.do_sample:
+        probs = torch.softmax(scores, dim=-1)
+        return int(torch.multinomial(probs, num_samples=1)[0, 0])
+    return int(torch.argmax(scores, dim=-1)[0])
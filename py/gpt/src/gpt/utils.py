@@ -1,5 +1,7 @@
+from collections import deque
 from queue import Queue
 from threading import Thread
+from typing import Deque, Iterable, Iterator, List, Optional, Union
 
 from transformers import StoppingCriteria
 
@@ -59,10 +61,140 @@ class Iteratorize:
 
 
 class Stop(StoppingCriteria):
-    def __init__(self, tokenizer, stop="### Human:"):
+    """
+    Stopping criteria which tracks every row of the batch independently.
+
+    Rather than decoding the whole sequence on each step, only a rolling window
+    of the most recently generated token ids is kept per row, so the cost of a
+    check does not grow with the prompt or the output.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        stop: Union[str, List[str], None] = "### Human:",
+        stop_token_ids: Optional[List[List[int]]] = None,
+        prompt_length: Optional[int] = None,
+    ):
         self.tokenizer = tokenizer
-        self.stop = stop
+        if isinstance(stop, str):
+            stop = [stop]
+        self.stops = [s for s in (stop or []) if s]
+        self.stop_token_ids = [list(ids) for ids in (stop_token_ids or []) if ids]
+        self.prompt_length = prompt_length
+
+        # every non-special token decodes to at least one byte (byte fallback
+        # tokens to a single one), so a window one longer than the longest stop
+        # string in bytes always covers a full match
+        self.window = (
+            max(
+                [len(s.encode("utf-8")) + 1 for s in self.stops]
+                + [len(ids) for ids in self.stop_token_ids]
+                + [1]
+            )
+            + 2
+        )
+
+        self.seen: List[int] = []
+        self.windows: List[Deque[int]] = []
+        self.finished: List[bool] = []
+
+    def add_row(self, seen: int = 0) -> int:
+        self.seen.append(seen)
+        self.windows.append(deque(maxlen=self.window))
+        self.finished.append(False)
+        return len(self.finished) - 1
+
+    def step(self, row: int, token_ids: List[int]) -> bool:
+        """
+        Feeds newly generated token ids for a single row, returning whether
+        that row has hit a stop sequence.
+        """
+        if self.finished[row]:
+            return True
+
+        window = self.windows[row]
+        for token_id in token_ids:
+            window.append(token_id)
+            if self._matches_ids(window):
+                self.finished[row] = True
+                return True
+
+        self.seen[row] += len(token_ids)
+        if self.stops and token_ids:
+            text = self.tokenizer.decode(list(window), skip_special_tokens=True)
+            if any(stop in text for stop in self.stops):
+                self.finished[row] = True
+
+        return self.finished[row]
+
+    def _matches_ids(self, window: Deque[int]) -> bool:
+        tail = list(window)
+        return any(tail[-len(ids) :] == ids for ids in self.stop_token_ids)
 
     def __call__(self, input_ids, *args, **kwargs) -> bool:
-        prediction = self.tokenizer.decode(input_ids[0], skip_special_tokens=True)
-        return prediction.endswith(self.stop)
+        if not self.finished:
+            # the first call happens after the first token has been generated
+            seen = (
+                self.prompt_length
+                if self.prompt_length is not None
+                else input_ids.shape[1] - 1
+            )
+            for _ in range(input_ids.shape[0]):
+                self.add_row(seen)
+
+        for row in range(input_ids.shape[0]):
+            if not self.finished[row]:
+                self.step(row, input_ids[row, self.seen[row] :].tolist())
+
+        return all(self.finished)
+
+
+def trim_stop_sequences(
+    texts: Iterable[str], stops: List[str], skip: int = 0
+) -> Iterator[str]:
+    """
+    Filters a stream of text chunks so that none of `stops` are ever emitted.
+
+    Text which could be the beginning of a stop sequence is held back until it
+    can be ruled out, and the stream ends right before the first full match. The
+    first `skip` characters (usually the echoed prompt) are passed through as is.
+    """
+    stops = [s for s in stops if s]
+    if not stops:
+        yield from texts
+        return
+
+    buffer = ""
+    for text in texts:
+        if skip:
+            passthrough, text = text[:skip], text[skip:]
+            skip -= len(passthrough)
+            if passthrough:
+                yield passthrough
+
+        buffer += text
+
+        matches = [i for i in (buffer.find(s) for s in stops) if i != -1]
+        if matches:
+            end = min(matches)
+            if end:
+                yield buffer[:end]
+            return
+
+        held = _partial_stop_length(buffer, stops)
+        if len(buffer) > held:
+            yield buffer[: len(buffer) - held]
+            buffer = buffer[len(buffer) - held :]
+
+    if buffer:
+        yield buffer
+
+
+def _partial_stop_length(text: str, stops: List[str]) -> int:
+    # length of the longest suffix of text which is a proper prefix of a stop
+    for length in range(min(len(text), max(len(s) for s in stops) - 1), 0, -1):
+        suffix = text[-length:]
+        if any(s.startswith(suffix) for s in stops):
+            return length
+    return 0
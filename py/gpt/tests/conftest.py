@@ -0,0 +1,54 @@
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+from transformers import AutoModelForCausalLM
+
+from gpt.benchmark import build_tiny_model
+from gpt.llm import LLM
+
+
+@pytest.fixture(scope="session")
+def model_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("model"))
+    build_tiny_model(path)
+    return path
+
+
+@pytest.fixture(scope="session")
+def draft_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("draft"))
+    build_tiny_model(path, seed=1)
+    return path
+
+
+@pytest.fixture(scope="session")
+def llm(model_path):
+    llm = LLM()
+    llm.load_model(model_path, quantization="fp32", snapshot=False)
+    return llm
+
+
+@pytest.fixture(scope="session")
+def adapter_paths(model_path, tmp_path_factory):
+    # LoRA adapters with random weights, so each one changes the output
+    paths = []
+    for seed in range(2):
+        model = get_peft_model(
+            AutoModelForCausalLM.from_pretrained(model_path),
+            LoraConfig(
+                r=4,
+                lora_alpha=8,
+                target_modules=["q_proj", "v_proj"],
+                task_type="CAUSAL_LM",
+            ),
+        )
+        torch.manual_seed(seed)
+        with torch.no_grad():
+            for name, param in model.named_parameters():
+                if "lora_B" in name:
+                    param.normal_(std=0.5)
+
+        path = str(tmp_path_factory.mktemp("adapters") / f"adapter{seed}")
+        model.save_pretrained(path)
+        paths.append(path)
+    return paths
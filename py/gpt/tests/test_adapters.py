@@ -0,0 +1,81 @@
+import pytest
+
+from gpt.adapters import AdapterCache
+from gpt.llm import LLM
+
+GENERATION_ARGS = {"max_new_tokens": 12, "do_sample": False}
+PROMPT = "w1 w2 w3 w4"
+
+
+@pytest.fixture(scope="module")
+def lora_llm(model_path):
+    llm = LLM()
+    llm.load_model(model_path, quantization="fp32", snapshot=False)
+    return llm
+
+
+def generate(llm, lora_path=None, prompt=PROMPT):
+    return "".join(
+        llm.generate_streaming(GENERATION_ARGS, prompt, lora_path, echo_prompt=False)
+    )
+
+
+def submit(llm, prompt, lora_path):
+    generation_config, stop = llm._generation_config(GENERATION_ARGS)
+    input_ids = llm.tokenizer(prompt, return_tensors="pt").input_ids
+    return llm.scheduler.submit(input_ids, generation_config, stop, adapter=lora_path)
+
+
+def test_generates_after_evicting_an_adapter(model_path, adapter_paths):
+    llm = LLM()
+    llm.load_model(model_path, quantization="fp32", snapshot=False)
+    llm.adapters = AdapterCache(max_adapters=1)
+
+    base = generate(llm)
+    first, second = [generate(llm, path) for path in adapter_paths]
+    assert llm.adapters.stats()["evictions"] == 1
+    assert len({base, first, second}) == 3
+
+    # the evicted adapter was the first one loaded, which peft had as active
+    assert generate(llm) == base
+    assert generate(llm, adapter_paths[0]) == first
+    assert llm.adapters.stats()["evictions"] == 2
+
+
+def test_rows_of_a_mixed_batch_use_their_own_adapter(lora_llm, adapter_paths):
+    rows = [
+        (prompt, lora_path)
+        for prompt in ["w1 w2 w3 w4", "w5", "w9 w8 w7 w6 w5 w4 w3"]
+        for lora_path in [None, *adapter_paths]
+    ]
+    # every row is queued before the decode loop runs, so they share a batch
+    with lora_llm.scheduler.lock:
+        streamers = [submit(lora_llm, prompt, lora_path) for prompt, lora_path in rows]
+    mixed = [
+        "".join(streamer)[len(prompt) :]
+        for streamer, (prompt, _) in zip(streamers, rows)
+    ]
+
+    solo = [generate(lora_llm, lora_path, prompt) for prompt, lora_path in rows]
+    assert mixed == solo
+    assert len(set(solo)) == len(rows)
+
+
+def test_cache_evicts_least_recently_used_adapters_which_arent_pinned():
+    cache = AdapterCache(max_adapters=2, max_bytes=100)
+    assert cache.put("a", 10) == []
+    assert cache.put("b", 10) == []
+    assert cache.get("a")
+
+    assert cache.put("c", 10) == ["b"]
+    assert cache.put("d", 10, pinned=["a"]) == ["c"]
+    # over the byte budget, only pinned adapters are left to evict
+    assert cache.put("e", 95, pinned=["a", "d"]) == []
+    assert "e" in cache and len(cache) == 3
+    assert cache.stats() == {
+        "adapters": 3,
+        "bytes": 115,
+        "hits": 1,
+        "misses": 0,
+        "evictions": 2,
+    }
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from gpt import downloader
+from gpt.downloader import DownloadError, RemoteFile, SnapshotDownloader
+
+CHUNK_SIZE = 1000
+
+
+class Server:
+    """
+    Local stand-in for the hub's file server, answering range requests and
+    recording them. Requests for the chunks starting at an offset in `failing`
+    get a 500.
+    """
+
+    def __init__(self, files: dict):
+        self.files = files
+        self.requests = []
+        self.failing = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                data = server.files[self.path.lstrip("/")]
+                start, end = 0, len(data) - 1
+                if "Range" in self.headers:
+                    start, end = map(int, self.headers["Range"][6:].split("-"))
+                server.requests.append((self.path.lstrip("/"), start))
+
+                if start in server.failing:
+                    self.send_response(500)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                body = data[start : end + 1]
+                self.send_response(206 if "Range" in self.headers else 200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def remote_file(self, name: str, lfs: bool = True, **kwargs) -> RemoteFile:
+        data = self.files[name]
+        return RemoteFile(
+            name,
+            f"{self.url}/{name}",
+            len(data),
+            **(
+                {"sha256": hashlib.sha256(data).hexdigest()}
+                if lfs
+                else {"git_sha1": git_blob_id(data)}
+            ),
+            **kwargs,
+        )
+
+
+def git_blob_id(data: bytes) -> str:
+    return hashlib.sha1(f"blob {len(data)}\0".encode() + data).hexdigest()
+
+
+@pytest.fixture
+def server():
+    files = {
+        "model.safetensors": os.urandom(5 * CHUNK_SIZE + 123),
+        "config.json": b'{"model_type": "llama"}',
+    }
+    server = Server(files)
+    yield server
+    server.server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def no_retry_backoff(monkeypatch):
+    monkeypatch.setattr(downloader.time, "sleep", lambda seconds: None)
+
+
+def snapshot_downloader(**kwargs) -> SnapshotDownloader:
+    return SnapshotDownloader(
+        token="token", chunk_size=CHUNK_SIZE, on_progress=lambda stats: None, **kwargs
+    )
+
+
+def test_downloads_files_in_chunks(server, tmp_path):
+    local_dir = str(tmp_path / "model")
+    files = [
+        server.remote_file("model.safetensors"),
+        server.remote_file("config.json", lfs=False),
+    ]
+
+    stats = snapshot_downloader().download("repo", local_dir, files=files)
+
+    for name, data in server.files.items():
+        with open(os.path.join(local_dir, name), "rb") as f:
+            assert f.read() == data
+    assert sorted(os.listdir(local_dir)) == [
+        ".download.json",
+        "config.json",
+        "model.safetensors",
+    ]
+    assert stats["downloaded_bytes"] == sum(map(len, server.files.values()))
+    assert len(server.requests) == 6 + 1
+
+    # an existing directory is a complete download
+    assert snapshot_downloader().download("repo", local_dir, files=files) == {
+        "cached": True
+    }
+
+
+def test_resumes_from_the_chunks_on_disk(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "MAX_RETRIES", 1)
+    local_dir = str(tmp_path / "model")
+    files = [server.remote_file("model.safetensors")]
+
+    server.failing = {3 * CHUNK_SIZE}
+    with pytest.raises(DownloadError):
+        snapshot_downloader(max_workers=1).download("repo", local_dir, files=files)
+    assert not os.path.exists(local_dir)
+
+    server.failing = set()
+    server.requests = []
+    stats = snapshot_downloader().download("repo", local_dir, files=files)
+
+    assert server.requests == [("model.safetensors", 3 * CHUNK_SIZE)]
+    assert stats["resumed_bytes"] == 5 * CHUNK_SIZE + 123 - CHUNK_SIZE
+    with open(os.path.join(local_dir, "model.safetensors"), "rb") as f:
+        assert f.read() == server.files["model.safetensors"]
+
+
+def test_rejects_files_which_fail_verification(server, tmp_path):
+    local_dir = str(tmp_path / "model")
+    remote_file = server.remote_file("model.safetensors")
+    remote_file.sha256 = "0" * 64
+
+    with pytest.raises(DownloadError, match="verification"):
+        snapshot_downloader().download("repo", local_dir, files=[remote_file])
+    assert not os.path.exists(local_dir)
+
+    # the chunks of a corrupt file aren't resumed
+    staging_dir = f"{local_dir}{downloader.STAGING_SUFFIX}"
+    assert not any(name.startswith("model") for name in os.listdir(staging_dir))
+
+
+def test_writes_a_manifest(server, tmp_path):
+    local_dir = str(tmp_path / "model")
+    files = [server.remote_file("config.json", lfs=False, commit="abc123")]
+    snapshot_downloader().download("repo", local_dir, files=files, revision="main")
+
+    with open(os.path.join(local_dir, downloader.MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    assert manifest["repo_id"] == "repo"
+    # the commit the files were pinned to, not the branch
+    assert manifest["revision"] == "abc123"
+    assert manifest["files"]["config.json"] == {
+        "size": len(server.files["config.json"]),
+        "sha256": None,
+        "git_sha1": git_blob_id(server.files["config.json"]),
+    }
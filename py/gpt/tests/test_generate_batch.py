@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+from gpt.benchmark import random_text
+
+GENERATION_ARGS = {"max_new_tokens": 24, "do_sample": False}
+
+
+def prompts(count: int):
+    rng = random.Random(2)
+    return [random_text(rng.randint(1, 40), rng) for _ in range(count)]
+
+
+def generate_streaming(llm, prompt, generation_args):
+    usage = {}
+    text = "".join(
+        llm.generate_streaming(generation_args, prompt, echo_prompt=False, usage=usage)
+    )
+    return text, usage
+
+
+@pytest.mark.parametrize(
+    "limits",
+    [{}, {"max_batch_size": 3}, {"max_batch_tokens": 100}, {"max_batch_size": 1}],
+)
+def test_batch_output_matches_streaming_output(llm, limits):
+    texts = prompts(10)
+    usage = []
+    completions = llm.generate_batch(texts, GENERATION_ARGS, usage=usage, **limits)
+
+    for text, completion, count in zip(texts, completions, usage):
+        streamed, streamed_usage = generate_streaming(llm, text, GENERATION_ARGS)
+        assert completion == streamed
+        assert count["prompt_tokens"] == streamed_usage["prompt_tokens"]
+        assert count["completion_tokens"] == streamed_usage["completion_tokens"]
+
+
+def test_completions_end_before_their_stop(llm):
+    texts = prompts(6)
+    # a word from the middle of each completion, so every row stops elsewhere
+    full = llm.generate_batch(texts, GENERATION_ARGS)
+    stops = [completion.split()[len(completion.split()) // 2] for completion in full]
+
+    for text, stop, completion in zip(texts, stops, full):
+        usage = []
+        generation_args = {**GENERATION_ARGS, "stopping_sequence": stop}
+        [trimmed] = llm.generate_batch([text], generation_args, usage=usage)
+
+        assert trimmed == completion[: completion.index(stop)]
+        streamed, streamed_usage = generate_streaming(llm, text, generation_args)
+        assert trimmed == streamed
+        assert usage[0]["completion_tokens"] < GENERATION_ARGS["max_new_tokens"]
+        assert usage[0]["completion_tokens"] == streamed_usage["completion_tokens"]
@@ -0,0 +1,137 @@
+import random
+
+import pytest
+import torch
+from transformers import FalconConfig, FalconForCausalLM
+
+from gpt import utils
+from gpt.benchmark import VOCAB_SIZE, random_text
+from gpt.scheduler import GenerationScheduler
+
+GENERATION_ARGS = {"max_new_tokens": 24, "do_sample": False}
+
+
+def prompts(count: int):
+    rng = random.Random(0)
+    return [random_text(rng.randint(1, 40), rng) for _ in range(count)]
+
+
+def submit(llm, scheduler, prompt, generation_args=GENERATION_ARGS):
+    generation_config, stop = llm._generation_config(generation_args)
+    input_ids = llm.tokenizer(prompt, return_tensors="pt").input_ids
+    return scheduler.submit(input_ids, generation_config, stop)
+
+
+def generate(llm, scheduler, texts, generation_args=GENERATION_ARGS):
+    # every request is queued before the decode loop can run a step, so they
+    # end up sharing the batch
+    with scheduler.lock:
+        streamers = [submit(llm, scheduler, text, generation_args) for text in texts]
+    return ["".join(streamer) for streamer in streamers]
+
+
+def generate_solo(llm, scheduler, texts, generation_args=GENERATION_ARGS):
+    return ["".join(submit(llm, scheduler, text, generation_args)) for text in texts]
+
+
+@pytest.mark.parametrize(
+    "generation_args",
+    [GENERATION_ARGS, {**GENERATION_ARGS, "repetition_penalty": 1.5}],
+)
+def test_batched_output_matches_solo_output(llm, generation_args):
+    texts = prompts(8)
+    solo = generate_solo(llm, llm.scheduler, texts, generation_args)
+    assert llm.scheduler.merge_rows
+    assert generate(llm, llm.scheduler, texts, generation_args) == solo
+
+
+def test_models_without_position_ids_decode_one_row_at_a_time(llm):
+    torch.manual_seed(0)
+    model = FalconForCausalLM(
+        FalconConfig(
+            vocab_size=VOCAB_SIZE,
+            hidden_size=64,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            alibi=False,
+            bos_token_id=llm.tokenizer.bos_token_id,
+            eos_token_id=llm.tokenizer.eos_token_id,
+        )
+    ).eval()
+    scheduler = GenerationScheduler(model, llm.tokenizer)
+    assert not scheduler.merge_rows
+
+    texts = prompts(4)
+    solo = generate_solo(llm, scheduler, texts)
+    assert generate(llm, scheduler, texts) == solo
+
+
+def test_stop_sequences_end_only_their_own_row(llm):
+    texts = prompts(4)
+    solo = generate_solo(llm, llm.scheduler, texts)
+    # a stop taken from the middle of the first completion
+    stop = solo[0][len(texts[0]) :].split()[3]
+    args = {**GENERATION_ARGS, "stopping_sequence": stop}
+
+    stopped = generate(llm, llm.scheduler, texts, args)
+    assert stop in stopped[0] and len(stopped[0]) < len(solo[0])
+    for text, expected in zip(stopped[1:], solo[1:]):
+        assert expected.startswith(text)
+
+
+def test_generations_capped_by_max_length(llm):
+    text = prompts(1)[0]
+    generation_config, stop = llm._generation_config(GENERATION_ARGS)
+    generation_config.max_new_tokens = None
+    input_ids = llm.tokenizer(text, return_tensors="pt").input_ids
+    generation_config.max_length = input_ids.shape[1] + 5
+
+    streamer = llm.scheduler.submit(input_ids, generation_config, stop)
+    "".join(streamer)
+    assert streamer.request.generated == 5
+
+
+def test_any_of_several_eos_tokens_ends_a_generation(llm):
+    text = prompts(1)[0]
+    input_ids = llm.tokenizer(text, return_tensors="pt").input_ids
+    streamer = submit(llm, llm.scheduler, text)
+    "".join(streamer)
+    generated = streamer.request.token_ids[input_ids.shape[1] :]
+
+    generation_config, stop = llm._generation_config(GENERATION_ARGS)
+    generation_config.eos_token_id = [llm.tokenizer.eos_token_id, generated[3]]
+    streamer = llm.scheduler.submit(input_ids, generation_config, stop)
+    "".join(streamer)
+    end = generated.index(generated[3]) + 1
+    assert streamer.request.token_ids[input_ids.shape[1] :] == generated[:end]
+
+
+def test_requests_can_grow_the_batch_past_the_scheduler_limit(llm):
+    texts = prompts(12)
+    solo = generate_solo(llm, llm.scheduler, texts)
+
+    scheduler = llm.scheduler
+    sizes = []
+    step = scheduler._step
+
+    def record_step():
+        sizes.append(len(scheduler._active))
+        step()
+
+    scheduler._step = record_step
+    try:
+        with scheduler.lock:
+            streamers = [
+                scheduler.submit(
+                    llm.tokenizer(text, return_tensors="pt").input_ids,
+                    *llm._generation_config(GENERATION_ARGS),
+                    max_batch_size=len(texts),
+                )
+                for text in texts
+            ]
+        batched = ["".join(streamer) for streamer in streamers]
+    finally:
+        del scheduler._step
+
+    assert max(sizes) == len(texts) > scheduler.max_batch_size
+    assert batched == solo
@@ -0,0 +1,86 @@
+import json
+import os
+import shutil
+
+import pytest
+import torch
+
+from gpt.benchmark import build_tiny_model
+from gpt.llm import LLM
+from gpt.snapshot import has_snapshot, load_snapshot
+
+# a model only loadable with trust_remote_code, like Falcon RW
+CONFIGURATION = """
+from transformers import LlamaConfig
+
+
+class TinyRemoteConfig(LlamaConfig):
+    model_type = "tiny_remote"
+"""
+
+MODELING = """
+from transformers import LlamaForCausalLM
+
+from .configuration_tiny_remote import TinyRemoteConfig
+
+
+class TinyRemoteForCausalLM(LlamaForCausalLM):
+    config_class = TinyRemoteConfig
+"""
+
+
+@pytest.fixture
+def remote_code_model_path(tmp_path):
+    path = str(tmp_path / "remote")
+    build_tiny_model(path)
+    with open(os.path.join(path, "configuration_tiny_remote.py"), "w") as f:
+        f.write(CONFIGURATION)
+    with open(os.path.join(path, "modeling_tiny_remote.py"), "w") as f:
+        f.write(MODELING)
+
+    with open(os.path.join(path, "config.json")) as f:
+        config = json.load(f)
+    config["model_type"] = "tiny_remote"
+    config["architectures"] = ["TinyRemoteForCausalLM"]
+    config["auto_map"] = {
+        "AutoConfig": "configuration_tiny_remote.TinyRemoteConfig",
+        "AutoModelForCausalLM": "modeling_tiny_remote.TinyRemoteForCausalLM",
+    }
+    with open(os.path.join(path, "config.json"), "w") as f:
+        json.dump(config, f)
+    return path
+
+
+def logits(llm: LLM) -> torch.Tensor:
+    input_ids = llm.tokenizer("w1 w2 w3", return_tensors="pt").input_ids
+    with torch.no_grad():
+        return llm.model(input_ids=input_ids).logits
+
+
+@pytest.mark.parametrize("quantization", ["fp32", "int8"])
+def test_snapshot_loads_the_same_model(model_path, tmp_path, quantization):
+    path = str(tmp_path / "model")
+    shutil.copytree(model_path, path)
+
+    first = LLM()
+    first.load_model(path, quantization=quantization)
+    assert has_snapshot(path, quantization)
+
+    second = LLM()
+    second.load_model(path, quantization=quantization)
+    assert torch.allclose(logits(first), logits(second))
+
+
+def test_snapshot_of_remote_code_model(remote_code_model_path):
+    first = LLM()
+    first.load_model(remote_code_model_path, quantization="fp32")
+    assert type(first.model).__name__ == "TinyRemoteForCausalLM"
+    assert has_snapshot(remote_code_model_path, "fp32")
+
+    # loads without falling back to the checkpoint
+    model, _ = load_snapshot(remote_code_model_path, "fp32")
+    assert type(model).__name__ == "TinyRemoteForCausalLM"
+
+    second = LLM()
+    second.load_model(remote_code_model_path, quantization="fp32")
+    assert torch.allclose(logits(first), logits(second))
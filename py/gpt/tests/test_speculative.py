@@ -0,0 +1,69 @@
+import random
+import shutil
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM
+
+from gpt.benchmark import random_text
+from gpt.llm import LLM
+
+GENERATION_ARGS = {"max_new_tokens": 32, "do_sample": False}
+
+
+@pytest.fixture(scope="module")
+def perturbed_path(model_path, tmp_path_factory):
+    # a draft which agrees with the model on some tokens but not all of them
+    path = str(tmp_path_factory.mktemp("perturbed"))
+    shutil.copytree(model_path, path, dirs_exist_ok=True)
+    model = AutoModelForCausalLM.from_pretrained(model_path)
+    torch.manual_seed(0)
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(torch.randn_like(param) * param.std() * 0.05)
+    model.save_pretrained(path)
+    return path
+
+
+@pytest.fixture(scope="module", params=["same", "perturbed", "unrelated"])
+def speculative_llm(request, model_path, draft_path):
+    drafts = {
+        "same": model_path,
+        "perturbed": request.getfixturevalue("perturbed_path"),
+        "unrelated": draft_path,
+    }
+    llm = LLM()
+    llm.load_model(model_path, quantization="fp32", snapshot=False)
+    llm.load_draft_model(drafts[request.param])
+    return request.param, llm
+
+
+def prompts(count: int):
+    rng = random.Random(1)
+    return [random_text(rng.randint(1, 40), rng) for _ in range(count)]
+
+
+def generate(llm, prompt, **kwargs):
+    usage = {}
+    text = "".join(
+        llm.generate_streaming(GENERATION_ARGS, prompt, usage=usage, **kwargs)
+    )
+    return text, usage
+
+
+def test_greedy_output_matches_plain_decoding(speculative_llm):
+    draft, llm = speculative_llm
+    accepted = drafted = 0
+    for prompt in prompts(6):
+        plain, plain_usage = generate(llm, prompt)
+        speculative, usage = generate(llm, prompt, speculative=True)
+
+        assert speculative == plain
+        assert usage["completion_tokens"] == plain_usage["completion_tokens"]
+        accepted += usage["speculative"]["accepted_tokens"]
+        drafted += usage["speculative"]["drafted_tokens"]
+
+    if draft == "same":
+        assert accepted == drafted
+    elif draft == "perturbed":
+        assert 0 < accepted < drafted
@@ -0,0 +1,48 @@
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from gpt import utils
+
+
+def byte_tokenizer():
+    # one token per byte, like the byte fallback of sentencepiece tokenizers
+    alphabet = pre_tokenizers.ByteLevel.alphabet()
+    tokenizer = Tokenizer(
+        models.BPE({c: i for i, c in enumerate(sorted(alphabet))}, [])
+    )
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer)
+
+
+def test_stop_matches_multibyte_stop_strings():
+    tokenizer = byte_tokenizer()
+    stop = utils.Stop(tokenizer, "日本")
+    row = stop.add_row()
+
+    token_ids = tokenizer.encode("hello 日本 world")
+    assert len(tokenizer.encode("日本")) == 6
+
+    stopped_at = None
+    for i, token_id in enumerate(token_ids):
+        if stop.step(row, [token_id]):
+            stopped_at = i
+            break
+    assert tokenizer.decode(token_ids[: stopped_at + 1]) == "hello 日本"
+
+
+def test_stop_matches_token_ids_per_row():
+    tokenizer = byte_tokenizer()
+    stop = utils.Stop(tokenizer, None, [[1, 2]])
+    first, second = stop.add_row(), stop.add_row()
+
+    assert not stop.step(first, [1])
+    assert not stop.step(second, [2, 1])
+    assert stop.step(first, [2])
+    assert not stop.step(second, [3])
+
+
+def test_trim_stop_sequences_holds_back_partial_matches():
+    chunks = ["Hello ###", " Hu", "man: bye"]
+    assert "".join(utils.trim_stop_sequences(chunks, ["### Human:"])) == "Hello "
+    assert "".join(utils.trim_stop_sequences(["a ##", "b"], ["### Human:"])) == "a ##b"
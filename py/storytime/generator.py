@@ -1,12 +1,21 @@
+import json
+import os
 import pprint
+import threading
+import time
 from abc import abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
-from typing import Callable, Dict, List, Optional
+from queue import Queue
+from typing import Callable, Dict, Iterator, List, Optional
 
 import guidance
 from dotenv import load_dotenv
-from modal import Image, Secret, Stub, web_endpoint
+from fastapi.responses import StreamingResponse
+from modal import Image, Secret, SharedVolume, Stub, web_endpoint
 from pydantic import BaseModel
+from src.cache import DiskCache, content_hash, to_json
+from src.programs import PROGRAMS, ProgramTiming
 from src.prompts import (
     CHARACTER_BIOS,
     CHARACTER_DESCRIPTORS,
@@ -21,15 +30,17 @@ guidance.llm = guidance.llms.OpenAI("gpt-3.5-turbo")
 
 image = Image.debian_slim().pip_install_from_requirements("requirements.txt")
 stub = Stub(image=image, name="storytime")
+cache_volume = SharedVolume().persist("storytime-cache")
+
+CACHE_DIR = '/cache'
 
 #### Workflow Framework
 
 '''
-This is a very basic implementation of a "workflow". It's just a linear series of steps that run in order, without 
-any parallelization or tracking of dependencies.
-
-I'd like to find/write a simple lib to model and run workflows as more of a directed graph structure, but that's not
-really required atm.
+This is a very basic implementation of a "workflow". Steps declare the state keys they read and write, and are run as a
+directed graph: a step starts as soon as the steps producing its inputs have finished, so independent steps run
+concurrently (up to `max_concurrency` at a time). Steps which don't declare their keys wait for everything before
+them, like a plain linear series.
 '''
 
 @dataclass
@@ -37,6 +48,10 @@ class WorkflowState:
     state: Dict[str, any] = field(default_factory=dict)
 
 class WorkflowStep:
+    # state keys the step reads and writes, None meaning any key
+    input_keys: Optional[List[str]] = None
+    output_keys: Optional[List[str]] = None
+
     @abstractmethod
     def __init__(self, id, *args, **kwargs):
         pass
@@ -45,83 +60,368 @@ class WorkflowStep:
     def execute(self, state: WorkflowState) -> None:
         pass
 
+    def fingerprint(self) -> Optional[dict]:
+        '''
+        The configuration which determines the step's outputs given its inputs, or None if the results shouldn't be
+        cached.
+        '''
+        return None
+
+    # extra timings of the step's last run, for the workflow report
+    def stats(self) -> dict:
+        return {}
+
+    @property
+    def name(self) -> str:
+        return f"{type(self).__name__}({', '.join(self.output_keys or [])})"
+
+@dataclass
+class StepTiming:
+    name: str
+    start: float
+    end: float
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
 class Workflow:
-    state: WorkflowState = WorkflowState()
+    state: WorkflowState
     steps: List[WorkflowStep]
-
-    def __init__(self, steps: List[WorkflowStep], initial_state: Optional[WorkflowState] = None):
-        if initial_state:
-            self.state = initial_state
+    timings: List[Optional[StepTiming]]
+
+    def __init__(
+        self,
+        steps: List[WorkflowStep],
+        initial_state: Optional[WorkflowState] = None,
+        max_concurrency: int = 4,
+        cache: Optional[DiskCache] = None,
+        checkpoint_path: Optional[str] = None,
+        on_step: Optional[Callable[[WorkflowStep, WorkflowState], None]] = None,
+    ):
+        self.state = initial_state or WorkflowState()
         self.steps = steps
+        self.max_concurrency = max_concurrency
+        self.dependencies = [
+            {j for j in range(i) if _depends_on(step, steps[j])} for i, step in enumerate(steps)
+        ]
+        self.timings = [None] * len(steps)
+        # step results are reused across runs with the same inputs
+        self.cache = cache
+        # the state is saved here after every step, and a run with the same initial state resumes from it
+        self.checkpoint_path = checkpoint_path
+        self.inputs_hash = content_hash(self.state.state)
+        # called as soon as each step finishes, e.g. to stream partial results
+        self.on_step = on_step
 
     def run(self):
-        for step in self.steps:
-            step.execute(self.state)
+        self._started = time.monotonic()
+        done = self._resume()
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            try:
+                while len(done) < len(self.steps):
+                    for i in range(len(self.steps)):
+                        if i not in done and i not in running.values() and self.dependencies[i] <= done:
+                            running[pool.submit(self._execute, i)] = i
+
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+                        i = running.pop(future)
+                        done.add(i)
+                        if self.on_step:
+                            self.on_step(self.steps[i], self.state)
+                    self._checkpoint(done)
+            except BaseException:
+                for future in running:
+                    future.cancel()
+                raise
+
         return self.state.state
 
+    def _execute(self, i: int):
+        start = time.monotonic() - self._started
+        step = self.steps[i]
+        self.execute(step)
+        self.timings[i] = StepTiming(step.name, start, time.monotonic() - self._started)
+
+    def execute(self, step: WorkflowStep, state: Optional[WorkflowState] = None):
+        '''
+        Executes a single step on `state` (the workflow's own by default), reusing the cached result of a previous
+        execution on the same inputs.
+        '''
+        if state is None:
+            state = self.state
+
+        key = self._cache_key(step, state)
+        cached = key and self.cache.get(key)
+        if cached:
+            state.state.update(cached)
+        else:
+            step.execute(state)
+            if key:
+                self.cache.put(key, {k: state.state[k] for k in step.output_keys})
+
+    def _cache_key(self, step: WorkflowStep, state: WorkflowState) -> Optional[str]:
+        fingerprint = step.fingerprint()
+        if self.cache is None or fingerprint is None or step.output_keys is None:
+            return None
+        return content_hash(type(step).__name__, fingerprint, _read(state, step.input_keys))
+
+    def _resume(self) -> set:
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return set()
+
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+        # a checkpoint of a different workflow, or of the same one run on other inputs, is ignored
+        if checkpoint['steps'] != [step.name for step in self.steps] or checkpoint.get('inputs') != self.inputs_hash:
+            print(f"Ignoring {self.checkpoint_path}, which is for a different request")
+            return set()
+
+        print(f"Resuming from {self.checkpoint_path} after {len(checkpoint['done'])} steps")
+        self.state.state.update(checkpoint['state'])
+        return set(checkpoint['done'])
+
+    def _checkpoint(self, done: set):
+        if not self.checkpoint_path:
+            return
+
+        os.makedirs(os.path.dirname(self.checkpoint_path) or '.', exist_ok=True)
+        tmp_path = f'{self.checkpoint_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(to_json({
+                'steps': [step.name for step in self.steps],
+                'inputs': self.inputs_hash,
+                'done': sorted(done),
+                'state': self.state.state,
+            }))
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def critical_path(self) -> List[StepTiming]:
+        # the chain of dependencies which determined when the last step finished
+        finished = [i for i, timing in enumerate(self.timings) if timing]
+        if not finished:
+            return []
+
+        path = [max(finished, key=lambda i: self.timings[i].end)]
+        while True:
+            deps = [j for j in self.dependencies[path[-1]] if self.timings[j]]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda j: self.timings[j].end))
+
+        return [self.timings[i] for i in reversed(path)]
+
+    def report(self) -> dict:
+        timings = [timing for timing in self.timings if timing]
+        return {
+            'total': max((timing.end for timing in timings), default=0.0),
+            'steps': [
+                {
+                    'name': timing.name,
+                    'start': round(timing.start, 3),
+                    'duration': round(timing.duration, 3),
+                    **step.stats(),
+                }
+                for step, timing in zip(self.steps, self.timings) if timing
+            ],
+            'critical_path': [timing.name for timing in self.critical_path()],
+        }
+
+def _depends_on(step: WorkflowStep, prev: WorkflowStep) -> bool:
+    if None in (step.input_keys, step.output_keys, prev.input_keys, prev.output_keys):
+        return True
+
+    # read after write, write after write and write after read
+    return bool(
+        set(prev.output_keys) & (set(step.input_keys) | set(step.output_keys))
+        or set(prev.input_keys) & set(step.output_keys)
+    )
+
 
 #### Generic Workflow Steps
 
+MAX_IN_FLIGHT = 4
+SDXL = "stability-ai/sdxl:2b017d9b67edd2ee1401238df49d75da53c523f36e363881e057f5dc3ed3c5b2"
+
+def map_concurrently(fn: Callable, inputs: List, max_in_flight: int = MAX_IN_FLIGHT, retries: int = 2, timeout: Optional[float] = None) -> List:
+    '''
+    Calls `fn` on every input with up to `max_in_flight` calls at a time, returning the results in input order. Calls
+    which fail or take longer than `timeout` seconds are retried up to `retries` times, so one slow element doesn't hold
+    up the rest of the list. A timed out call keeps its slot until it actually returns, so retries never push the
+    number of calls in flight over `max_in_flight`.
+    '''
+    if not inputs:
+        return []
+
+    slots = threading.BoundedSemaphore(max_in_flight)
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        return list(pool.map(lambda input: call_with_retries(fn, input, retries, timeout, slots), inputs))
+
+def call_with_retries(fn: Callable, input, retries: int = 2, timeout: Optional[float] = None, slots: Optional[threading.Semaphore] = None):
+    for attempt in range(retries + 1):
+        try:
+            return _call_with_timeout(fn, input, timeout, slots)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f'Retrying after attempt {attempt + 1} failed: {e!r}')
+            time.sleep(min(2 ** attempt, 10))
+
+def _call_with_timeout(fn: Callable, input, timeout: Optional[float], slots: Optional[threading.Semaphore] = None):
+    # the slot is taken for the call itself, not while waiting on it
+    if slots:
+        slots.acquire()
+
+    if timeout is None:
+        try:
+            return fn(input)
+        finally:
+            if slots:
+                slots.release()
+
+    # the call can't be interrupted, so a timed out call is left to finish in the background
+    result = {}
+    def run():
+        try:
+            result['value'] = fn(input)
+        except Exception as e:
+            result['error'] = e
+        finally:
+            if slots:
+                slots.release()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f'Timed out after {timeout}s')
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
 class GuidanceLLMStep(WorkflowStep):
-    def __init__(self, output_key: str, prompt_template: str):
+    def __init__(self, output_key: str, prompt_template: str, input_keys: Optional[List[str]] = None):
         self.output_key = output_key
         self.prompt_template = prompt_template
+        self.input_keys = input_keys
+        self.output_keys = [output_key]
+        self.timing = ProgramTiming()
+
+    def fingerprint(self):
+        return {'output_key': self.output_key, 'prompt_template': self.prompt_template}
+
+    def stats(self):
+        return self.timing.to_dict()
 
     def execute(self, state: WorkflowState):
-        fn = guidance(self.prompt_template)
-        output = fn(**state.state)
+        output = PROGRAMS.run(self.prompt_template, self.timing, **_read(state, self.input_keys))
 
         state.state[self.output_key] = output[self.output_key]
 
-# runs guidance on a _list_ of inputs, returning a _list_ of their outputs (i.e. many calls to the LLM)
+# the state passed to guidance, restricted to the keys a step declared
+def _read(state: WorkflowState, keys: Optional[List[str]]) -> dict:
+    if keys is None:
+        return {**state.state}
+    return {key: state.state[key] for key in keys}
+
+# runs guidance on a _list_ of inputs, returning a _list_ of their outputs (i.e. many calls to the LLM, made concurrently)
 class GuidanceLLMListStep(WorkflowStep):
-    def __init__(self, input_key: str, elem_name: str, output_key: str, prompt_template: str):
+    def __init__(
+        self,
+        input_key: str,
+        elem_name: str,
+        output_key: str,
+        prompt_template: str,
+        context_keys: Optional[List[str]] = None,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        retries: int = 2,
+        timeout: Optional[float] = 60,
+    ):
         self.input_key = input_key
         self.elem_name = elem_name
         self.output_key = output_key
         self.prompt_template = prompt_template
+        # other state keys the template reads, besides the list element
+        self.context_keys = context_keys
+        self.input_keys = None if context_keys is None else [input_key, *context_keys]
+        self.output_keys = [output_key]
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.timeout = timeout
+        self.timing = ProgramTiming()
     
+    def fingerprint(self):
+        return {
+            'input_key': self.input_key,
+            'elem_name': self.elem_name,
+            'output_key': self.output_key,
+            'prompt_template': self.prompt_template,
+        }
+
+    def stats(self):
+        return self.timing.to_dict()
+
     def execute(self, state: WorkflowState):
-        result = []
         inputs = state.state[self.input_key]
+        context = _read(state, self.input_keys)
 
-        for input in inputs:
-            fn = guidance(self.prompt_template)
-            args = {**state.state}
-            args[self.elem_name] = input
-            output = fn(**args)
-            result.append(output[self.output_key])
+        state.state[self.output_key] = map_concurrently(
+            lambda input: self.run_one(context, input), inputs, self.max_in_flight, self.retries, self.timeout
+        )
 
-        state.state[self.output_key] = result
+    # runs the template on a single element, with `context` holding the rest of the state it reads
+    def run_one(self, context: dict, input):
+        output = PROGRAMS.run(self.prompt_template, self.timing, **{**context, self.elem_name: input})
+        return output[self.output_key]
 
 
 class ReplicateImageGeneratorStep(WorkflowStep):
-    def __init__(self, input_key: str, output_key: str, prompt_suffix: Optional[str] = None):
+    def __init__(
+        self,
+        input_key: str,
+        output_key: str,
+        prompt_suffix: Optional[str] = None,
+        max_in_flight: int = MAX_IN_FLIGHT,
+        retries: int = 2,
+        timeout: Optional[float] = 120,
+        generate: Optional[Callable[[str], any]] = None,
+    ):
         self.input_key = input_key
         self.output_key = output_key
         self.prompt_suffix = prompt_suffix
-
-    def execute(self, state):
+        self.input_keys = [input_key]
+        self.output_keys = [output_key]
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.timeout = timeout
+        # defaults to SDXL on replicate
+        self.generate = generate or self._replicate
+
+    def fingerprint(self):
+        # replicate deletes its outputs after about an hour, cached urls would outlive the images they point at
+        return None
+
+    def _replicate(self, prompt: str):
         import replicate
 
+        return replicate.run(SDXL, input={"prompt": prompt})
+
+    def execute(self, state):
         input = state.state[self.input_key] 
         prompts = input if isinstance(input, list) else [input]
 
-        result = []
-
-        for prompt in prompts:
-            # bit of a hack, this is not very generalized...
-            if prompt == 'SKIP':
-                result.append(None)
-                continue
+        state.state[self.output_key] = map_concurrently(self.run_one, prompts, self.max_in_flight, self.retries, self.timeout)
 
-            res = replicate.run(
-                "stability-ai/sdxl:2b017d9b67edd2ee1401238df49d75da53c523f36e363881e057f5dc3ed3c5b2",
-                input={"prompt": f"{prompt}{self.prompt_suffix if self.prompt_suffix else ''}"}
-            )
-            result.append(res)
-        
-        state.state[self.output_key] = result
+    def run_one(self, prompt: str):
+        # bit of a hack, this is not very generalized...
+        if prompt == 'SKIP':
+            return None
+        return self.generate(f"{prompt}{self.prompt_suffix if self.prompt_suffix else ''}")
 
 
 #### Storytime Specific
@@ -130,6 +430,9 @@ class ReplicateImageGeneratorStep(WorkflowStep):
 # so we have to manually parse the response. If gpt-3.5-turbo-instruct ever comes out it may be worth switching to for 
 # more power from guidance.
 class SplitCharactersStep(WorkflowStep):
+    input_keys = ['full_characters']
+    output_keys = ['full_characters']
+
     def __init__(self):
         pass
 
@@ -149,6 +452,9 @@ class SplitCharactersStep(WorkflowStep):
         state.state['full_characters'] = characters
 
 class SplitStoryStep(WorkflowStep):
+    input_keys = ['story']
+    output_keys = ['paragraphs']
+
     def __init__(self):
         pass
 
@@ -179,32 +485,54 @@ class Character(BaseModel):
 class StoryRequest(BaseModel):
     subject: str
     characters: List[Character]
+    # retrying a failed request with the same run id resumes it from its last completed step
+    run_id: Optional[str] = None
 
 
-@stub.function(secret=Secret.from_dotenv())
-@web_endpoint(method="POST")
-async def generate_story(story_request: StoryRequest):
-    INITIAL_STATE = WorkflowState(state={
-            'characters': story_request.characters,
-            'subject': story_request.subject
-    })
-
-    steps = [
-        GuidanceLLMStep('outline', OUTLINE),
-        GuidanceLLMStep('story', OUTLINE + STORY),
-        GuidanceLLMStep('title', OUTLINE + STORY + TITLE),
-        GuidanceLLMStep('full_characters', CHARACTER_BIOS),
+# once the story is written, the title, the character descriptors and the paragraphs are produced concurrently
+def story_steps() -> List[WorkflowStep]:
+    return [
+        GuidanceLLMStep('outline', OUTLINE, ['characters', 'subject']),
+        GuidanceLLMStep('story', OUTLINE + STORY, ['characters', 'subject', 'outline']),
+        GuidanceLLMStep('title', OUTLINE + STORY + TITLE, ['characters', 'subject', 'outline', 'story']),
+        GuidanceLLMStep('full_characters', CHARACTER_BIOS, ['characters', 'story']),
         SplitCharactersStep(),
-        GuidanceLLMStep('descriptors', CHARACTER_DESCRIPTORS),
+        GuidanceLLMStep('descriptors', CHARACTER_DESCRIPTORS, ['full_characters']),
         SplitStoryStep(),
-        GuidanceLLMListStep('paragraphs', 'paragraph', 'image_prompts', GENERATE_IMAGE_PROMPT),
+        GuidanceLLMListStep('paragraphs', 'paragraph', 'image_prompts', GENERATE_IMAGE_PROMPT, ['descriptors']),
         ReplicateImageGeneratorStep('image_prompts', 'images', ' in the style of a children\'s book illustration')
     ]
 
-    workflow = Workflow(steps, initial_state=INITIAL_STATE)
+def run_checkpoint_path(story_request: StoryRequest) -> Optional[str]:
+    if not story_request.run_id:
+        return None
+    return os.path.join(CACHE_DIR, 'runs', f'{os.path.basename(story_request.run_id)}.json')
+
+def initial_state(story_request: StoryRequest) -> WorkflowState:
+    return WorkflowState(state={
+            'characters': story_request.characters,
+            'subject': story_request.subject
+    })
+
+# set up and checked when the container starts, rather than by the first request
+PROGRAMS.warm(step.prompt_template for step in story_steps() if hasattr(step, 'prompt_template'))
+
+
+@stub.function(secret=Secret.from_dotenv(), shared_volumes={CACHE_DIR: cache_volume})
+@web_endpoint(method="POST")
+async def generate_story(story_request: StoryRequest):
+    checkpoint_path = run_checkpoint_path(story_request)
+    cache = DiskCache(os.path.join(CACHE_DIR, 'steps'))
+    workflow = Workflow(story_steps(), initial_state=initial_state(story_request), cache=cache, checkpoint_path=checkpoint_path)
     state = workflow.run()
 
+    if checkpoint_path:
+        os.remove(checkpoint_path)
+
     pprint.pprint(state)
+    pprint.pprint(workflow.report())
+    pprint.pprint(cache.stats())
+    pprint.pprint(PROGRAMS.stats())
 
     return {
         'title': state['title'],
@@ -212,4 +540,75 @@ async def generate_story(story_request: StoryRequest):
             'content': content,
             'image': image,
         } for content, image in list(zip(state['paragraphs'], state['images']))],
-    }
\ No newline at end of file
+    }
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f'event: {event}\ndata: {to_json(data)}\n\n'
+
+def stream_story(story_request: StoryRequest) -> Iterator[str]:
+    '''
+    Yields server-sent events for the title as soon as it is written, then for every page (in the order they're ready,
+    tagged with their index) as soon as its text and image are. The last two steps run per paragraph rather than over
+    the whole list, so the image for the first page is generated while the prompts for later pages are still being
+    written. Each page goes through the workflow's cache, so pages which were already made are only read back.
+    '''
+    *steps, prompts_step, images_step = story_steps()
+    events = Queue()
+    started = time.monotonic()
+    checkpoint_path = run_checkpoint_path(story_request)
+
+    def on_step(step: WorkflowStep, state: WorkflowState):
+        if 'title' in (step.output_keys or []):
+            events.put(sse_event('title', {'title': state.state['title']}))
+
+    workflow = Workflow(
+        steps,
+        initial_state=initial_state(story_request),
+        cache=DiskCache(os.path.join(CACHE_DIR, 'steps')),
+        checkpoint_path=checkpoint_path,
+        on_step=on_step,
+    )
+
+    def page(index: int, paragraph: str, context: dict):
+        # both steps run on a list holding just this page's paragraph
+        page_state = WorkflowState(state={**context, prompts_step.input_key: [paragraph]})
+        workflow.execute(prompts_step, page_state)
+        workflow.execute(images_step, page_state)
+        events.put(sse_event('page', {
+            'index': index,
+            'content': paragraph,
+            'image': page_state.state[images_step.output_key][0],
+            'elapsed': time.monotonic() - started,
+        }))
+
+    def run():
+        try:
+            state = workflow.state
+            workflow.run()
+
+            paragraphs = state.state[prompts_step.input_key]
+            context = _read(state, prompts_step.input_keys)
+            with ThreadPoolExecutor(max_workers=images_step.max_in_flight) as pool:
+                pages = [pool.submit(page, i, paragraph, context) for i, paragraph in enumerate(paragraphs)]
+                for future in pages:
+                    future.result()
+
+            if checkpoint_path:
+                os.remove(checkpoint_path)
+
+            pprint.pprint(workflow.report())
+            events.put(sse_event('done', {'pages': len(paragraphs), 'elapsed': time.monotonic() - started}))
+        except Exception as e:
+            events.put(sse_event('error', {'error': str(e)}))
+        events.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    while (event := events.get()) is not None:
+        yield event
+
+
+@stub.function(secret=Secret.from_dotenv(), shared_volumes={CACHE_DIR: cache_volume})
+@web_endpoint(method="POST")
+async def generate_story_streaming(story_request: StoryRequest):
+    return StreamingResponse(stream_story(story_request), media_type='text/event-stream')
@@ -0,0 +1,101 @@
+'''
+Step results are stored as json files named by the hash of what produced them, i.e. the type and configuration of the
+step and the slice of the state it reads. The least recently used files are deleted once the store goes over its size
+limit, and entries older than the ttl are ignored.
+'''
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Optional
+
+from pydantic import BaseModel
+
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_TTL = 7 * 24 * 60 * 60
+
+def to_json(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, default=_encode)
+
+def _encode(value: Any):
+    if isinstance(value, BaseModel):
+        return value.dict()
+    raise TypeError(f'{type(value).__name__} is not serializable')
+
+def content_hash(*parts: Any) -> str:
+    return hashlib.sha256(to_json(parts).encode()).hexdigest()
+
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int = CACHE_MAX_BYTES, ttl: float = CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        if time.time() - entry['created'] > self.ttl:
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        # the modification time orders entries for eviction
+        os.utime(path)
+        self.hits += 1
+        return entry['value']
+
+    def put(self, key: str, value: Any):
+        path = self._path(key)
+        tmp_path = f'{path}.tmp-{threading.get_ident()}'
+        with open(tmp_path, 'w') as f:
+            f.write(to_json({'created': time.time(), 'value': value}))
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(os.path.join(self.directory, name))
+                total -= size
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
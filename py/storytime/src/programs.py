@@ -0,0 +1,73 @@
+'''
+Process-wide cache of guidance programs keyed by their template text.
+
+Each template is turned into a `guidance.Program` once, ideally at startup with `warm`, and every call runs a copy of
+that program with its own variables. guidance 0.0.64 still parses the template inside its executor on every call and
+is left as is, so the parse isn't cached: the cache measures what it costs once per template (checking the template's
+syntax at startup on the way), and the timings report that share of each call's execution as `parse`.
+'''
+
+import threading
+import time
+from typing import Dict, Iterable
+
+import guidance
+from guidance._grammar import grammar
+
+class ProgramTiming:
+    def __init__(self):
+        # execute includes guidance parsing the template, parse is the estimate of that part
+        self.parse = 0.0
+        self.execute = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def add(self, parse: float, execute: float):
+        with self._lock:
+            self.parse += parse
+            self.execute += execute
+            self.calls += 1
+
+    def to_dict(self) -> dict:
+        return {'parse': round(self.parse, 3), 'execute': round(self.execute, 3), 'calls': self.calls}
+
+class ProgramCache:
+    def __init__(self):
+        self._programs: Dict[str, guidance.Program] = {}
+        self._lock = threading.Lock()
+        self.parse_times: Dict[str, float] = {}
+        self.hits = 0
+
+    def get(self, template: str) -> guidance.Program:
+        program = self._programs.get(template)
+        if program is not None:
+            self.hits += 1
+            return program
+
+        with self._lock:
+            if template not in self._programs:
+                start = time.monotonic()
+                grammar.parse_string(template)
+                self.parse_times[template] = time.monotonic() - start
+                self._programs[template] = guidance(template)
+            return self._programs[template]
+
+    def warm(self, templates: Iterable[str]):
+        for template in templates:
+            self.get(template)
+
+    def run(self, template: str, timing: ProgramTiming, **kwargs):
+        program = self.get(template)
+        start = time.monotonic()
+        output = program(**kwargs)
+        timing.add(self.parse_times[template], time.monotonic() - start)
+        return output
+
+    def stats(self) -> dict:
+        return {
+            'programs': len(self._programs),
+            'parse_time': round(sum(self.parse_times.values()), 3),
+            'hits': self.hits,
+        }
+
+PROGRAMS = ProgramCache()
@@ -0,0 +1,10 @@
+import os
+import sys
+
+import guidance
+
+# generator.py is run from its own directory, with its modules imported as the `src` package
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+# importing it sets up an OpenAI model, tests run guidance programs against its mock instead
+guidance.llms.OpenAI = lambda *args, **kwargs: guidance.llms.Mock()
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import guidance
+import pytest
+
+import generator
+from generator import GuidanceLLMListStep, ReplicateImageGeneratorStep, WorkflowState, map_concurrently
+
+
+@pytest.fixture(autouse=True)
+def no_retry_backoff(monkeypatch):
+    # the fakes wait on events rather than sleeping
+    monkeypatch.setattr(generator.time, 'sleep', lambda seconds: None)
+
+
+class Calls:
+    '''
+    Fake backend recording its calls, failing or stalling the attempts listed in `fail` and `stall` (by input and
+    attempt number), and the peak number of calls running at once.
+    '''
+
+    def __init__(self, fail=(), stall=(), delay=0.01):
+        self.fail = set(fail)
+        self.stall = set(stall)
+        self.delay = delay
+        self.attempts = {}
+        self.running = 0
+        self.peak = 0
+        self.released = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, input):
+        with self._lock:
+            attempt = self.attempts[input] = self.attempts.get(input, 0) + 1
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            if (input, attempt) in self.stall:
+                self.released.wait(5)
+            else:
+                threading.Event().wait(self.delay * (hash(input) % 5))
+            if (input, attempt) in self.fail:
+                raise ValueError(f'{input} failed')
+            return f'<{input}>'
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+def test_results_keep_the_input_order():
+    inputs = [str(i) for i in range(20)]
+    assert map_concurrently(Calls(), inputs, max_in_flight=4) == [f'<{i}>' for i in inputs]
+    assert map_concurrently(Calls(), []) == []
+
+
+def test_failed_elements_are_retried_on_their_own():
+    calls = Calls(fail=[('b', 1), ('c', 1), ('c', 2)])
+    assert map_concurrently(calls, ['a', 'b', 'c'], retries=2) == ['<a>', '<b>', '<c>']
+    assert calls.attempts == {'a': 1, 'b': 2, 'c': 3}
+
+    with pytest.raises(ValueError, match='c failed'):
+        map_concurrently(Calls(fail=[('c', 1), ('c', 2)]), ['a', 'b', 'c'], retries=1)
+
+
+def test_stalled_calls_time_out_and_are_retried():
+    calls = Calls(stall=[('b', 1)])
+    try:
+        assert map_concurrently(calls, ['a', 'b'], retries=1, timeout=0.2) == ['<a>', '<b>']
+        assert calls.attempts == {'a': 1, 'b': 2}
+
+        with pytest.raises(TimeoutError):
+            map_concurrently(Calls(stall=[('a', 1)]), ['a'], retries=0, timeout=0.2)
+    finally:
+        calls.released.set()
+
+
+def test_calls_in_flight_stay_within_the_limit():
+    inputs = [str(i) for i in range(12)]
+    calls = Calls(stall=[(i, 1) for i in inputs[:3]])
+
+    # the stalled calls time out but keep their slots until they return
+    threading.Timer(0.5, calls.released.set).start()
+    results = map_concurrently(calls, inputs, max_in_flight=3, retries=1, timeout=0.1)
+
+    assert results == [f'<{i}>' for i in inputs]
+    assert calls.peak <= 3
+
+
+def test_image_step_generates_every_prompt_with_its_suffix():
+    calls = Calls()
+    step = ReplicateImageGeneratorStep('prompts', 'images', prompt_suffix=', watercolor', generate=calls)
+    state = WorkflowState(state={'prompts': ['a cat', 'SKIP', 'a dog']})
+
+    step.execute(state)
+
+    assert state.state['images'] == ['<a cat, watercolor>', None, '<a dog, watercolor>']
+    assert step.fingerprint() is None
+
+
+def test_list_step_runs_its_program_on_every_element(monkeypatch):
+    monkeypatch.setattr(guidance, 'llm', guidance.llms.Mock({'Name a red fruit: ': 'apple', 'Name a yellow fruit: ': 'banana'}))
+    step = GuidanceLLMListStep('colors', 'color', 'fruit', "Name a {{color}} fruit: {{gen 'fruit'}}", context_keys=[])
+    state = WorkflowState(state={'colors': ['red', 'yellow', 'red']})
+
+    step.execute(state)
+
+    assert state.state['fruit'] == ['apple', 'banana', 'apple']
+    assert step.stats()['calls'] == 3